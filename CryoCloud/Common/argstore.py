@@ -0,0 +1,177 @@
+"""
+Compact storage of job args and retvals.
+
+Large top level values of args (like __post__, __c__, docker volumes or file
+lists) are often identical for thousands of jobs, in particular for split
+fan-outs. They are stored once in job_blobs keyed by their hash, and the job
+row only keeps a reference in "__refs__". Rows and blobs above a size limit
+are compressed with zstd if available, otherwise zlib. Plain JSON written by
+older versions is still read as is.
+"""
+import copy
+import json
+import zlib
+import hashlib
+import threading
+
+try:
+    import zstandard
+except:
+    zstandard = None
+
+CODEC_ZLIB = b"\x01"
+CODEC_ZSTD = b"\x02"
+
+# Values with a JSON encoding at least this big are shared by hash
+SHARE_MIN_SIZE = 256
+
+# Data at least this big is compressed
+COMPRESS_MIN_SIZE = 512
+
+# Number of blobs kept in memory pr process, they never change so no need to expire
+CACHE_SIZE = 1000
+
+REFS = "__refs__"
+
+BLOBS_SQL = """CREATE TABLE IF NOT EXISTS job_blobs (
+                hash CHAR(40) PRIMARY KEY,
+                data MEDIUMBLOB,
+                last_used DOUBLE
+            )"""
+
+# How a backend inserts a blob or marks an existing one as used
+UPSERT_MYSQL = "ON DUPLICATE KEY UPDATE last_used=VALUES(last_used)"
+UPSERT_SQLITE = "ON CONFLICT(hash) DO UPDATE SET last_used=excluded.last_used"
+
+
+def encode(text):
+    """
+    Encode a JSON string for storage, compressing it if it is big
+    """
+    data = text.encode("utf-8")
+    if len(data) < COMPRESS_MIN_SIZE:
+        return text
+    if zstandard:
+        return CODEC_ZSTD + zstandard.ZstdCompressor().compress(data)
+    return CODEC_ZLIB + zlib.compress(data)
+
+
+def decode(raw):
+    """
+    Decode stored data back to a JSON string
+    """
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        return raw
+    raw = bytes(raw)
+    if raw[:1] == CODEC_ZLIB:
+        return zlib.decompress(raw[1:]).decode("utf-8")
+    if raw[:1] == CODEC_ZSTD:
+        if not zstandard:
+            raise Exception("Data is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(raw[1:]).decode("utf-8")
+    return raw.decode("utf-8")
+
+
+class ArgStore:
+
+    def __init__(self, db, upsert=UPSERT_MYSQL):
+        self._db = db
+        self._upsert = upsert
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._pending = {}
+
+    def pack(self, doc, share=True):
+        """
+        Returns what to store in the job row for doc. Shared values are
+        queued and must be written with flush() before the row is
+        """
+        if doc is None:
+            return None
+        if share and isinstance(doc, dict):
+            packed = {}
+            refs = {}
+            for key, value in doc.items():
+                text = json.dumps(value, sort_keys=True)
+                if len(text) < SHARE_MIN_SIZE:
+                    packed[key] = value
+                    continue
+                h = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                refs[key] = h
+                with self._lock:
+                    self._pending[h] = text
+                    self._remember(h, json.loads(text))
+            if refs:
+                packed[REFS] = refs
+            doc = packed
+        return encode(json.dumps(doc))
+
+    def flush(self, now):
+        """
+        Write queued shared values. Existing ones are only marked as used, which
+        is what keeps cleanup() from removing them while jobs refer to them
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        SQL = "INSERT INTO job_blobs (hash, data, last_used) VALUES "
+        SQL += ",".join(["(%s, %s, %s)"] * len(pending))
+        SQL += " " + self._upsert
+        args = []
+        for h, text in pending.items():
+            args.extend([h, encode(text), now])
+        self._db._execute(SQL, args)
+
+    def unpack(self, raw):
+        return self.unpack_many([raw])[0]
+
+    def unpack_many(self, raws):
+        """
+        Reassemble many stored docs, fetching any unknown shared values in one go
+        """
+        docs = []
+        needed = set()
+        for raw in raws:
+            text = decode(raw)
+            doc = json.loads(text) if text else None
+            if isinstance(doc, dict) and REFS in doc:
+                needed.update(doc[REFS].values())
+            docs.append(doc)
+        if not needed:
+            return docs
+
+        with self._lock:
+            values = {h: self._cache[h] for h in needed if h in self._cache}
+        missing = [h for h in needed if h not in values]
+        if missing:
+            SQL = "SELECT hash, data FROM job_blobs WHERE hash IN (" + ",".join(["%s"] * len(missing)) + ")"
+            c = self._db._execute(SQL, missing)
+            with self._lock:
+                for h, data in c.fetchall():
+                    values[h] = json.loads(decode(data))
+                    self._remember(h, values[h])
+
+        for doc in docs:
+            if isinstance(doc, dict) and REFS in doc:
+                for key, h in doc.pop(REFS).items():
+                    if h not in values:
+                        raise Exception("Missing shared argument '%s' (%s)" % (key, h))
+                    doc[key] = copy.deepcopy(values[h])  # Callers may modify it
+        return docs
+
+    def cleanup(self, before):
+        """
+        Remove shared values not used since before
+        """
+        self._db._execute("DELETE FROM job_blobs WHERE last_used < %s", [before])
+
+    def _remember(self, h, value):
+        """
+        Must hold the lock
+        """
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache = {}
+        self._cache[h] = value
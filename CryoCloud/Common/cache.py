@@ -20,12 +20,16 @@ try:
 except:
     print("Missing argcomplete, autocomplete not available")
 
+from CryoCloud.Common.dbpool import PooledDB
+
 # Might want to use this for other reasons?
 try:
     from CryoCore.Core.InternalDB import mysql as db
+    pooled = True
 except:
     print("*** WARNING: Using sqlite backup DB")
     from CryoCore.Core.Sqlite import sqlite as db
+    pooled = False
 
 def sort_dict(item: dict):
     """
@@ -117,7 +121,7 @@ class DummyCryoCache():
         pass
 
 
-class CryoCache(db):
+class CryoCache(PooledDB, db):
 
     def __init__(self, name="CryoCache"):
 
@@ -128,6 +132,8 @@ class CryoCache(db):
         try:
             # raise Exception("test")
             db.__init__(self, name, self.cfg)
+            if pooled:
+                self._init_pool(name)
         except:
             # DB is bad
             print("BAD database, using dummy cache")
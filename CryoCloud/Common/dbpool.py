@@ -0,0 +1,250 @@
+"""
+Connection pool for the MySQL databases (JobDB and CryoCache).
+
+CryoCore's mysql class has one connection that every thread of a process
+shares. PooledDB is mixed in before it and runs statements on a pool of
+connections instead: each statement checks out a connection of its own, hot
+statements are prepared on the server once pr connection, and connections
+that have gone away are reopened a bounded number of times. The pool is
+configured as <name>.pool_size, 0 uses the shared connection as before.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from CryoCore import API
+
+try:
+    import mysql.connector as connector
+except ImportError:
+    connector = None
+
+# Errors that leave the connection unusable. The statement was not run on the
+# first ones (server has gone away, lost connection), so those are retried
+LOST_ERRNOS = (2006, 2055, 2013)
+RECONNECT_ERRNOS = (2006, 2055)
+
+# Connections idle for this long are pinged before use
+PING_AFTER = 30.0
+
+
+class Result:
+    """
+    The rows and counts of a statement, read before the connection is
+    returned to the pool
+    """
+
+    def __init__(self, rows, rowcount, lastrowid):
+        self._rows = rows
+        self._pos = 0
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+class _Connection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.prepared = OrderedDict()
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except:
+            pass
+
+
+class ConnectionPool:
+    """
+    At most size connections, made by connect() when needed. Prepared
+    statements are kept for the prepared_max most recently used statements
+    pr connection
+    """
+
+    def __init__(self, connect, size=8, retries=3, prepared_max=64):
+        self._connect = connect
+        self._size = size
+        self._retries = retries
+        self._prepared_max = prepared_max
+        self._idle = []
+        self._num = 0
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._metrics = {"checkouts": 0, "waits": 0, "wait_time": 0.0, "connections": 0,
+                         "reconnects": 0, "prepares": 0}
+
+    def get_metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics["open"] = self._num
+            metrics["idle"] = len(self._idle)
+        return metrics
+
+    def _count(self, metric, value=1):
+        with self._cond:
+            self._metrics[metric] += value
+
+    def _checkout(self):
+        with self._cond:
+            if os.getpid() != self._pid:
+                # Forked, the connections belong to the parent, don't close them
+                self._idle = []
+                self._num = 0
+                self._pid = os.getpid()
+            self._metrics["checkouts"] += 1
+            if not self._idle and self._num >= self._size:
+                self._metrics["waits"] += 1
+                start = time.time()
+                while not self._idle and self._num >= self._size:
+                    self._cond.wait()
+                self._metrics["wait_time"] += time.time() - start
+            if self._idle:
+                return self._idle.pop()
+            self._num += 1
+
+        try:
+            conn = _Connection(self._connect())
+        except:
+            self._discard(None)
+            raise
+        self._count("connections")
+        return conn
+
+    def _checkin(self, conn):
+        conn.last_used = time.time()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _discard(self, conn):
+        if conn:
+            conn.close()
+        with self._cond:
+            self._num -= 1
+            self._cond.notify()
+
+    def execute(self, SQL, args=None, prepare=False):
+        """
+        Run a statement on a pooled connection, with prepare it is prepared
+        on the server the first time it is run on the connection
+        """
+        attempt = 0
+        while True:
+            conn = self._checkout()
+            try:
+                if time.time() - conn.last_used > PING_AFTER:
+                    conn.conn.ping()
+                result = self._run(conn, SQL, args, prepare)
+            except Exception as e:
+                errno = getattr(e, "errno", None)
+                if errno in LOST_ERRNOS:
+                    self._discard(conn)
+                else:
+                    self._checkin(conn)
+                if errno not in RECONNECT_ERRNOS or attempt >= self._retries:
+                    raise
+                # Connection is gone, try a new one
+                self._count("reconnects")
+                time.sleep(min(0.1 * 2 ** attempt, 2.0))
+                attempt += 1
+                continue
+            self._checkin(conn)
+            return result
+
+    def _run(self, conn, SQL, args, prepare):
+        if prepare:
+            cursor = conn.prepared.pop(SQL, None)
+            if cursor is None:
+                cursor = conn.conn.cursor(prepared=True)
+                self._count("prepares")
+            conn.prepared[SQL] = cursor
+            while len(conn.prepared) > self._prepared_max:
+                conn.prepared.popitem(last=False)[1].close()
+            cursor.execute(SQL, args or ())
+            rows = cursor.fetchall() if cursor.with_rows else []
+            return Result(rows, cursor.rowcount, cursor.lastrowid)
+
+        cursor = conn.conn.cursor(buffered=True)
+        try:
+            if SQL.lstrip()[:4].upper() == "CALL":
+                # Stored procedures also return a status, the rows are the first result with rows
+                rows = []
+                rowcount = 0
+                for r in cursor.execute(SQL, args or (), multi=True):
+                    if r.with_rows and not rows:
+                        rows = r.fetchall()
+                        rowcount = r.rowcount
+                return Result(rows, rowcount, cursor.lastrowid)
+            cursor.execute(SQL, args or ())
+            rows = cursor.fetchall() if cursor.with_rows else []
+            return Result(rows, cursor.rowcount, cursor.lastrowid)
+        finally:
+            cursor.close()
+
+
+def _connect_params(cfg, db_name):
+    """
+    Database settings in cfg override the CryoCore ones
+    """
+    params = {}
+    defaults = API.get_config_db()
+    for key in ["db_host", "db_user", "db_password", "db_name"]:
+        params[key[3:]] = cfg[key] if cfg[key] else defaults[key]
+    if db_name:
+        params["name"] = db_name
+    return {"host": params["host"], "user": params["user"], "password": params["password"],
+            "database": params["name"], "autocommit": True}
+
+
+class PooledDB:
+    """
+    Mixin for subclasses of CryoCore's mysql, list it first. Call
+    _init_pool() after mysql.__init__()
+    """
+
+    def _init_pool(self, name, db_name=None):
+        self._pool = None
+        cfg = API.get_config(name)
+        cfg.set_default("pool_size", 8)
+        cfg.set_default("pool_retries", 3)
+        if connector is None or not int(cfg["pool_size"]):
+            return
+        try:
+            params = _connect_params(cfg, db_name)
+        except Exception as e:
+            self.log.warning("No connection pool, missing database config: %s" % e)
+            return
+        self._pool = ConnectionPool(lambda: connector.connect(**params),
+                                    size=int(cfg["pool_size"]), retries=int(cfg["pool_retries"]))
+
+    def _execute(self, SQL, args=None, insist_direct=False, prepare=False):
+        if getattr(self, "_pool", None) is None:
+            return super()._execute(SQL, args, insist_direct=insist_direct)
+        return self._pool.execute(SQL, args, prepare=prepare)
+
+    def get_pool_metrics(self):
+        """
+        Checkouts, waits (and seconds waited) for a free connection,
+        connections made, reconnects and statements prepared
+        """
+        if getattr(self, "_pool", None) is None:
+            return {}
+        return self._pool.get_metrics()
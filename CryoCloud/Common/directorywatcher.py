@@ -74,6 +74,12 @@ class Dispatcher(pyinotify.ProcessEvent):
 
     def process_IN_CREATE(self, event):
         # print("Monitored - file added", event)
+        if self._watcher.paused():
+            # Keep it until discovery is resumed
+            event.mtime = getattr(event, "mtime", 0)
+            self._watcher.addUnstable(event)
+            return
+
         info = self._make_info(event)
 
         if not self._watcher.isStable(info):
@@ -144,7 +150,11 @@ class FakeEvent():
 class DirectoryWatcher(threading.Thread):
     def __init__(self, runid, target, onAdd=None, onModify=None, 
                  onRemove=None, onError=None, onIdle=None,
-                 stabilize=0, recursive=False, noDB=False):
+                 stabilize=0, recursive=False, noDB=False, admit=None):
+        """
+        If admit is given, it's called before files are added, discovery
+        is paused while it returns False
+        """
         threading.Thread.__init__(self)
         self.stabilize = stabilize
         self.runid = runid
@@ -153,12 +163,14 @@ class DirectoryWatcher(threading.Thread):
         self._stop_event = threading.Event()
         self._lock = threading.Lock()
         self._unstable = {}
+        self._admit = admit
+        self._paused = threading.Event()
 
         wm = pyinotify.WatchManager()
         if noDB:
             self._db = None
         else:
-            self._db = jobdb.JobDB("directorywatcher", None)
+            self._db = jobdb.get_jobdb("directorywatcher", None)
 
         self.monitor = Dispatcher(target, self)
         if onAdd:
@@ -245,6 +257,24 @@ class DirectoryWatcher(threading.Thread):
         """
         self._stop_event.set()
 
+    def pause(self):
+        """
+        Pause discovery, files are kept until resumed
+        """
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def paused(self):
+        if self._paused.is_set():
+            return True
+        try:
+            return bool(self._admit and not self._admit())
+        except:
+            CryoCore.API.get_log("DirectoryWatcher").exception("Admission check failed")
+            return False
+
     def run(self):
         next_check = 0
         while not CryoCore.API.api_stop_event.is_set() and not self._stop_event.is_set():
@@ -255,6 +285,8 @@ class DirectoryWatcher(threading.Thread):
             if time.time() < next_check:
                 continue
             next_check = time.time() + 0.25
+            if self.paused():
+                continue
             try:
                 q = []
                 with self._lock:
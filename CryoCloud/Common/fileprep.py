@@ -23,6 +23,14 @@ DEBUG = False
 os.environ['S3_USE_SIGV4'] = 'True'  # For minio S3
 
 
+class TransferError(Exception):
+    """
+    Copying to or from another host failed, likely because it was busy or
+    unavailable, so the job can be retried later
+    """
+    retryable = True
+
+
 def _unzip_member(fn, filename, dest):
     with open(fn, 'rb') as f:
         zf = zipfile.ZipFile(f)
@@ -215,6 +223,7 @@ class FilePrepare:
         total_size = 0
         fileList = []
         last_error = ""
+        retryable = False
         # First we check if the files exists
         for url in urls:
             for i in range(0, 2):
@@ -226,12 +235,13 @@ class FilePrepare:
                         break
                 except Exception as e:
                     last_error = str(e)
+                    retryable = getattr(e, "retryable", False)
                     s = None
                     self.log.exception("Failed to fix url, retrying: %s" % str(e))
                     time.sleep(random.random() * 2)
             if not s:
                 self.log.exception("Failed to fix url %s" % url)
-                raise Exception("Failed to fix url %s: %s" % (url, last_error))
+                raise (TransferError if retryable else Exception)("Failed to fix url %s: %s" % (url, last_error))
             fileList.extend(s["fileList"])
             total_size += s["size"]
         return {"fileList": fileList, "size": total_size}
@@ -318,7 +328,8 @@ class FilePrepare:
             elif u.scheme in ["http", "https"]:
                 r = requests.get(url)
                 if r.status_code != 200:
-                    raise Exception("Failed to get %s: %s %s" % (url, r.status_code, r.reason))
+                    raise (TransferError if r.status_code >= 500 or r.status_code == 429 else Exception)(
+                        "Failed to get %s: %s %s" % (url, r.status_code, r.reason))
             elif u.scheme == "s3":
                 self.copy_s3(u.netloc, bucket, file, local_file)
                 fileList.append(local_file)
@@ -384,7 +395,7 @@ class FilePrepare:
             outs, errs = p.communicate(timeout=5.0)
 
         if p.poll() != 0:
-            raise Exception("Failed copying %s/%s: %s" %
+            raise TransferError("Failed copying %s/%s: %s" %
                             (host, filename, errs.decode("utf-8")))
 
         # Rename
@@ -431,7 +442,7 @@ class FilePrepare:
             outs, errs = p.communicate(timeout=5.0)
 
         if p.poll() != 0:
-            raise Exception("Failed copying %s to %s/%s: %s" %
+            raise TransferError("Failed copying %s to %s/%s: %s" %
                             (local_file, host, target, errs.decode("utf-8")))
 
     def write_s3(self, server, bucket, local_file, remote_file):
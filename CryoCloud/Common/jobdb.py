@@ -1,11 +1,16 @@
 from __future__ import print_function
 import time
 import random
-import json
 import threading
+from collections import OrderedDict
 
 from CryoCore import API
 from CryoCore.Core.InternalDB import mysql
+from CryoCloud.Common.jobnotify import JobNotifier, JobListener
+from CryoCloud.Common import argstore
+from CryoCloud.Common import profilestats
+from CryoCloud.Common import noderegistry
+from CryoCloud.Common.dbpool import PooledDB
 
 
 PRI_HIGH = 100
@@ -26,6 +31,25 @@ STATE_TIMEOUT = 5
 STATE_CANCELLED = 6
 STATE_DISABLED = 7
 
+# is_blocked of a job waiting for the jobs it depends on, see add_job()
+BLOCKED_DEPENDS = 2
+
+# Why a job waiting for a parent that did not complete ends, see add_job()
+PARENT_ENDED = {
+    STATE_FAILED: "failed",
+    STATE_TIMEOUT: "timed out",
+    STATE_CANCELLED: "was cancelled"
+}
+
+# is_blocked of a job waiting for the rest of its gang, see release_gang()
+BLOCKED_GANG = 3
+
+# Failed jobs that are retried wait as pending with is_blocked set to this until not_before
+BLOCKED_RETRY = 4
+
+# is_blocked of a job in a step with max_parallel waiting for a free slot, see set_max_parallel()
+BLOCKED_PARALLEL = 5
+
 TASK_TYPE = {
     TYPE_NORMAL: "Worker",
     TYPE_ADMIN: "AdminWorker",
@@ -40,159 +64,372 @@ PRI_STRING = {
     PRI_BULK: "bulk"
 }
 
+# How long (seconds) a worker trusts its view of the highest pending priority pr module
+PRIORITY_CACHE_TIME = 5.0
+
+# How often idle workers poll for jobs when they get job notifications, and when they don't
+NOTIFY_POLL_INTERVAL = 15.0
+POLL_INTERVAL = 2.5
+
+# Job and profile updates are written behind by a background thread, and sent together
+# after this many seconds or as soon as this many rows are queued
+UPDATE_FLUSH_INTERVAL = 0.005
+UPDATE_FLUSH_ROWS = 100
+
+# Jobs added with multiple=True are inserted together after this many seconds, or as soon
+# as this many are queued, and idle workers are notified when they are in
+ADD_FLUSH_INTERVAL = 0.05
+ADD_FLUSH_ROWS = 500
+
+# Applies a derived table u of (itemid, module, state, ts, worker, node, memory_max, cpu_time)
+# to profile the way a single profile update does
+PROFILE_UPDATE_SET = """profile.state=u.state,
+        profile.waittime=IF(u.state=%(allocated)d, u.ts-profile.addtime, profile.waittime),
+        profile.worker=IF(u.state=%(allocated)d, u.worker, profile.worker),
+        profile.node=IF(u.state=%(allocated)d, u.node, profile.node),
+        profile.totaltime=IF(u.state=%(allocated)d, profile.totaltime, u.ts-profile.addtime),
+        profile.processtime=IF(u.state=%(allocated)d, profile.processtime, u.ts-profile.addtime-profile.waittime),
+        profile.errors=profile.errors+(u.state=%(failed)d),
+        profile.timeouts=profile.timeouts+(u.state=%(timeout)d),
+        profile.cancelled=profile.cancelled+(u.state=%(cancelled)d),
+        profile.memory_max=IFNULL(u.memory_max, profile.memory_max),
+        profile.cpu_time=IFNULL(u.cpu_time, profile.cpu_time)""" % {
+    "allocated": STATE_ALLOCATED, "failed": STATE_FAILED, "timeout": STATE_TIMEOUT, "cancelled": STATE_CANCELLED}
+
+# Profile statistics of this head are merged into the shared ones this often, and the
+# shared ones are reread this often. Profiles that never finish are forgotten beyond
+# PROFILE_OPEN_MAX. Shared statistics are weighed down to PROFILE_STATS_MAX_RUNS runs,
+# and removed if not updated for PROFILE_STATS_MAX_AGE seconds
+PROFILE_STATS_INTERVAL = 60
+PROFILE_STATS_REFRESH = 300
+PROFILE_OPEN_MAX = 100000
+PROFILE_STATS_MAX_RUNS = 10000
+PROFILE_STATS_MAX_AGE = 30 * 86400
+
+# Estimates pr module, priority and datasize bucket are reused for this many seconds
+ESTIMATE_CACHE_TIME = 10.0
+
+# Outcome of a profile in a final state, see profilestats.ProfileStats.add()
+PROFILE_OUTCOME = {
+    STATE_COMPLETED: "completed",
+    STATE_FAILED: "errors",
+    STATE_TIMEOUT: "timeouts",
+    STATE_CANCELLED: "cancelled"
+}
 
-class JobDB(mysql):
-
-    def __init__(self, runname, module, steps=1, auto_cleanup=True):
+# With fair share, claimers pick runs based on their allocations during this many seconds.
+# Their view of the allocations is refreshed after SHARE_REFRESH_CLAIMS jobs, so the
+# allocations of other claimers are seen before the shares drift far off.
+SHARE_WINDOW = 300
+SHARE_REFRESH_CLAIMS = 10
+
+# Pending jobs are claimed as if they had AGING_STEP more priority for every AGING_INTERVAL
+# seconds they have waited, up to AGING_CAP more (CryoCloud.JobDB.aging_*, interval 0
+# disables aging), so bulk jobs are not starved by a steady stream of normal ones. The
+# aged priority is computed when claiming, jobs keep the priority they were given.
+AGING_INTERVAL = 600
+AGING_STEP = 10
+AGING_CAP = 50
+AGED_PRIORITY_MYSQL = "(priority + IF(p_age_interval > 0, " +\
+    "LEAST(p_age_cap, FLOOR((p_now - tsadded) / p_age_interval) * p_age_step), 0))"
+
+# Allocated jobs hold a lease for this many seconds (CryoCloud.JobDB.lease_time), which
+# workers renew from when they get them until they are done. Jobs whose lease ran out are
+# timed out, and the worker that held them may no longer update them (see update_job()).
+LEASE_TIME = 120
+
+# Jobs can request cpus, memory and scratch space (MB), see add_job(). Workers that give
+# allocate_job() the remaining budget of their node only get jobs that fit in it.
+RESOURCES = ["cpus", "memory", "scratch"]
+DEFAULT_RESOURCES = {"cpus": 1, "memory": 0, "scratch": 0}
+
+# Jobs that fail with an error the worker considers transient are retried up to
+# max_retries times (CryoCloud.JobDB.max_retries unless given to add_job()). They wait
+# RETRY_DELAY * 2^retries seconds, at most RETRY_MAX_DELAY, +-50% jitter (retry_delay and
+# retry_max_delay). Workers release retries that are due when they claim jobs, found by
+# the job_retry index, so the head is not involved.
+MAX_RETRIES = 3
+RETRY_DELAY = 10
+RETRY_MAX_DELAY = 600
+
+# Steps with max_parallel have a row in step_slots counting their jobs that hold a slot
+# (jobs.slot=1) and are not finished. Claims give free slots to BLOCKED_PARALLEL jobs in
+# the claim transaction, and triggers give them back when the jobs finish or are removed,
+# so the limit holds without the head counting jobs or unblocking them. A retried job keeps
+# its slot. SLOT_CHANGE is how much a state change adds to running for a job with a slot.
+SLOT_CHANGE = "((OLD.state>=%(completed)d AND OLD.state<%(disabled)d) - (NEW.state>=%(completed)d AND NEW.state<%(disabled)d))" % {
+    "completed": STATE_COMPLETED, "disabled": STATE_DISABLED}
+SLOTS_UPSERT_MYSQL = "ON DUPLICATE KEY UPDATE max_parallel=VALUES(max_parallel)"
+SLOTS_UPSERT_SQLITE = "ON CONFLICT(runid, step) DO UPDATE SET max_parallel=excluded.max_parallel"
+
+# Job claiming is done in a stored procedure in order to get a single round trip and a
+# single transaction pr allocation. Bump the version whenever the body changes, old
+# workers will keep using the old one until they are upgraded.
+ALLOCATE_PROCEDURE = "cc_allocate_v8"
+
+ALLOCATE_SQL = """CREATE PROCEDURE %(name)s (
+        IN p_type TINYINT, IN p_node VARCHAR(128), IN p_modules TEXT,
+        IN p_prefer VARCHAR(256), IN p_min_prio INT, IN p_strict TINYINT,
+        IN p_worker INT, IN p_nonce INT, IN p_max INT, IN p_now DOUBLE, IN p_run INT,
+        IN p_lease DOUBLE, IN p_cpus INT, IN p_memory INT, IN p_scratch INT,
+        IN p_age_interval DOUBLE, IN p_age_step INT, IN p_age_cap INT)
+    BEGIN
+        DECLARE v_prefer VARCHAR(256) DEFAULT p_prefer;
+        DECLARE v_run INT DEFAULT p_run;
+        DECLARE v_done TINYINT DEFAULT 0;
+        DECLARE v_slot_run INT;
+        DECLARE v_slot_step INT;
+        DECLARE v_free INT;
+        DECLARE v_granted INT;
+        DECLARE slots CURSOR FOR
+            SELECT runid, step, max_parallel - running FROM step_slots
+             WHERE running<max_parallel AND EXISTS (
+                   SELECT 1 FROM jobs WHERE jobs.runid=step_slots.runid AND jobs.step=step_slots.step
+                      AND is_blocked=%(parallel)d AND state=%(pending)d)
+               FOR UPDATE SKIP LOCKED;
+        DECLARE CONTINUE HANDLER FOR NOT FOUND SET v_done = 1;
+        DECLARE EXIT HANDLER FOR SQLEXCEPTION BEGIN ROLLBACK; RESIGNAL; END;
+
+        -- Retries that are due, in its own statement so the claim doesn't wait for other workers
+        UPDATE jobs SET is_blocked=0 WHERE is_blocked=%(retry)d AND not_before<=p_now;
+
+        START TRANSACTION;
+        -- Free slots of steps with max_parallel go to their waiting jobs, see step_slots
+        OPEN slots;
+        free_slots: LOOP
+            FETCH slots INTO v_slot_run, v_slot_step, v_free;
+            IF v_done THEN
+                LEAVE free_slots;
+            END IF;
+            UPDATE jobs SET is_blocked=0, slot=1
+             WHERE runid=v_slot_run AND step=v_slot_step AND is_blocked=%(parallel)d AND state=%(pending)d
+             ORDER BY %(aged)s DESC, tsadded LIMIT v_free;
+            SET v_granted = ROW_COUNT();
+            UPDATE step_slots SET running=running + v_granted WHERE runid=v_slot_run AND step=v_slot_step;
+        END LOOP;
+        CLOSE slots;
+
+        claim: LOOP
+            UPDATE jobs JOIN (
+                SELECT jobid FROM jobs
+                 WHERE state=%(pending)d AND type=p_type AND is_blocked=0
+                   AND (node IS NULL OR node=p_node)
+                   AND (p_modules IS NULL OR FIND_IN_SET(module, p_modules) > 0)
+                   AND (local_until IS NULL OR local_until<p_now OR FIND_IN_SET(p_node, prefer_nodes) > 0)
+                   AND (v_prefer IS NULL OR (module=v_prefer AND %(aged)s>p_min_prio))
+                   AND (v_run IS NULL OR runid=v_run)
+                   AND (p_cpus IS NULL OR req_cpus<=p_cpus)
+                   AND (p_memory IS NULL OR req_memory<=p_memory)
+                   AND (p_scratch IS NULL OR req_scratch<=p_scratch)
+                 ORDER BY %(aged)s DESC, tsadded LIMIT p_max
+                 FOR UPDATE SKIP LOCKED) AS candidates USING (jobid)
+               SET state=%(allocated)d, tsallocated=p_now, node=p_node, worker=p_worker, nonce=p_nonce,
+                   lease_until=p_now + IF(expiretime IS NOT NULL AND expiretime<p_lease, expiretime, p_lease);
+            IF ROW_COUNT() > 0 THEN
+                LEAVE claim;
+            ELSEIF v_run IS NOT NULL THEN
+                SET v_run = NULL;  -- Nothing in the fair share run, take any run
+            ELSEIF v_prefer IS NOT NULL AND NOT p_strict THEN
+                SET v_prefer = NULL, v_run = p_run;  -- Nothing preferred available, go generic
+            ELSE
+                LEAVE claim;
+            END IF;
+        END LOOP;
+        COMMIT;
+
+        SELECT jobid, step, taskid, type, priority, args, runname, jobs.module, modulepath,
+               runs.module, steps, workdir, itemid, runid, req_cpus, req_memory, req_scratch
+          FROM jobs JOIN runs USING (runid)
+         WHERE nonce=p_nonce AND worker=p_worker AND state=%(allocated)d;
+    END""" % {"name": ALLOCATE_PROCEDURE, "pending": STATE_PENDING, "allocated": STATE_ALLOCATED,
+            "retry": BLOCKED_RETRY, "parallel": BLOCKED_PARALLEL, "aged": AGED_PRIORITY_MYSQL}
+
+# Finished jobs are moved from jobs to jobs_history in small transactions, so the jobs
+# table only holds pending, allocated and recently finished jobs. Returns the number moved.
+ARCHIVE_PROCEDURE = "cc_archive_v1"
+
+ARCHIVE_SQL = """CREATE PROCEDURE %(name)s (IN p_age INT, IN p_max INT)
+    BEGIN
+        DECLARE v_before TIMESTAMP(6) DEFAULT NOW(6) - INTERVAL p_age SECOND;
+        DECLARE v_last BIGINT DEFAULT NULL;
+        DECLARE v_moved INT DEFAULT 0;
+        DECLARE EXIT HANDLER FOR SQLEXCEPTION BEGIN ROLLBACK; RESIGNAL; END;
+
+        START TRANSACTION;
+        SELECT MAX(jobid) INTO v_last FROM (
+            SELECT jobid FROM jobs
+             WHERE state>=%(completed)d AND state<%(disabled)d AND tschange<v_before
+             ORDER BY jobid LIMIT p_max) AS batch;
+        IF v_last IS NOT NULL THEN
+            INSERT IGNORE INTO jobs_history SELECT * FROM jobs
+             WHERE jobid<=v_last AND state>=%(completed)d AND state<%(disabled)d AND tschange<v_before;
+            DELETE jobs FROM jobs JOIN jobs_history USING (jobid)
+             WHERE jobs.jobid<=v_last AND jobs.state>=%(completed)d AND jobs.state<%(disabled)d
+               AND jobs.tschange<v_before;
+            SET v_moved = ROW_COUNT();
+        END IF;
+        COMMIT;
+        SELECT v_moved;
+    END""" % {"name": ARCHIVE_PROCEDURE, "completed": STATE_COMPLETED, "disabled": STATE_DISABLED}
+
+# Every state change of a job is logged in job_events by triggers, giving the head a
+# monotonic cursor (seq) to read changes from. They also give back the slots of jobs in
+# steps with max_parallel, see step_slots. Old trigger versions are dropped.
+EVENT_TRIGGERS = ["jobs_events_insert_v1", "jobs_events_update_v2", "jobs_slots_delete_v1"]
+OLD_EVENT_TRIGGERS = ["jobs_events_update_v1"]
+
+EVENT_SQLS = [
+    """CREATE TRIGGER jobs_events_insert_v1 AFTER INSERT ON jobs FOR EACH ROW
+    BEGIN
+        IF NEW.state <> %(pending)d THEN
+            INSERT INTO job_events (runid, jobid, state) VALUES (NEW.runid, NEW.jobid, NEW.state);
+        END IF;
+    END""" % {"pending": STATE_PENDING},
+    """CREATE TRIGGER jobs_events_update_v2 AFTER UPDATE ON jobs FOR EACH ROW
+    BEGIN
+        IF NEW.state <> OLD.state THEN
+            INSERT INTO job_events (runid, jobid, state) VALUES (NEW.runid, NEW.jobid, NEW.state);
+            IF OLD.slot THEN
+                UPDATE step_slots SET running=running + %(change)s WHERE runid=OLD.runid AND step=OLD.step;
+            END IF;
+        END IF;
+    END""" % {"change": SLOT_CHANGE},
+    """CREATE TRIGGER jobs_slots_delete_v1 AFTER DELETE ON jobs FOR EACH ROW
+    BEGIN
+        IF OLD.slot AND (OLD.state<%(completed)d OR OLD.state>=%(disabled)d) THEN
+            UPDATE step_slots SET running=running - 1 WHERE runid=OLD.runid AND step=OLD.step;
+        END IF;
+    END""" % {"completed": STATE_COMPLETED, "disabled": STATE_DISABLED}
+]
+
+
+DEPS_SQL = """CREATE TABLE IF NOT EXISTS job_deps (
+                runid INT NOT NULL,
+                taskid INT NOT NULL,
+                parent INT NOT NULL,
+                PRIMARY KEY (runid, parent, taskid)
+            )"""
+
+STEP_SLOTS_SQL = """CREATE TABLE IF NOT EXISTS step_slots (
+                runid INT NOT NULL,
+                step INT NOT NULL,
+                max_parallel INT NOT NULL,
+                running INT DEFAULT 0,
+                PRIMARY KEY (runid, step)
+            )"""
+
+
+def job_retval(taskid, key=None):
+    """
+    Placeholder in the args of a job that depends on job taskid, replaced by
+    its retval (or the value at key, dots separate levels) when the job is
+    released
+    """
+    return {"__retval__": taskid, "key": key}
+
+
+def fill_retvals(args, retvals):
+    """
+    Replace job_retval() placeholders in args with values from retvals, a map
+    of taskid to retval
+    """
+    if isinstance(args, dict):
+        if "__retval__" in args:
+            value = retvals.get(args["__retval__"])
+            if args.get("key"):
+                for k in args["key"].split("."):
+                    value = value.get(k) if isinstance(value, dict) else None
+            return value
+        return {k: fill_retvals(v, retvals) for k, v in args.items()}
+    if isinstance(args, list):
+        return [fill_retvals(v, retvals) for v in args]
+    return args
+
+
+class JobDBBase:
+    """
+    The backend independent part of the job db. Backends provide _execute()
+    (prepare=True marks hot statements worth preparing) and the schema, and implement the parts that need their own SQL dialect:
+    _claim(), _get_update_rows(), _unblock(), _update_batch(),
+    _commit_profiles(), archive_jobs() and cleanup(), and
+    _BLOB_UPSERT, _STATS_UPSERT, _NODE_UPSERT, _SLOTS_UPSERT and _NOW_SECONDS.
+    """
+
+    def __init__(self, runname, module):
         self._runname = random.randint(0, 2147483647)  # Just ignore the runname for now
         self._actual_runname = runname
         self._module = module
-        mysql.__init__(self, "JobDB", db_name="JobDB")
 
-        if not runname and not module:
-            return  # Is a worker, can only allocate/update jobs
+        # Cached max priority pr module, used for allocation with preferred modules
+        self._max_priority = {}
+        self._max_priority_ts = 0
 
-        # Multi-insert
-        self._addlist = []
-        self._addtimer = None
-        self._addLock = threading.Lock()
-        self._taskid = 1
+        # Fair share between runs, see _get_share_run()
+        self._share_cfg = API.get_config("CryoCloud.JobDB")
+        self._share_cfg.set_default("fair_share", False)
+        self._share_runs = {}
+        self._share_ts = 0
+        self._share_claims = 0
 
-        # Add owner, comments, dates etc to run
-        statements = [
-            """CREATE TABLE IF NOT EXISTS runs (
-                runid INT PRIMARY KEY AUTO_INCREMENT,
-                runname VARCHAR(128) UNIQUE,
-                module VARCHAR(256),
-                steps INT DEFAULT 1
-            )""",
-            """CREATE TABLE IF NOT EXISTS jobs (
-                    jobid BIGINT PRIMARY KEY AUTO_INCREMENT,
-                    runid INT NOT NULL,
-                    step INT DEFAULT 0,
-                    taskid INT DEFAULT 0,
-                    type TINYINT,
-                    priority INT DEFAULT 50,
-                    state TINYINT,
-                    tsadded DOUBLE,
-                    tsallocated DOUBLE DEFAULT NULL,
-                    expiretime SMALLINT,
-                    node VARCHAR(128) DEFAULT NULL,
-                    worker INT UNSIGNED DEFAULT NULL,
-                    retval MEDIUMBLOB DEFAULT NULL,
-                    module VARCHAR(256) DEFAULT NULL,
-                    modulepath TEXT DEFAULT NULL,
-                    workdir TEXT DEFAULT NULL,
-                    args MEDIUMBLOB DEFAULT NULL,
-                    nonce INT DEFAULT 0,
-                    itemid BIGINT DEFAULT 0,
-                    max_memory BIGINT UNSIGNED DEFAULT 0,
-                    cpu_time FLOAT DEFAULT 0,
-                    is_blocked TINYINT DEFAULT 0,
-                    tschange TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)
-            )""",
-            """CREATE TABLE IF NOT EXISTS filewatch (
-                fileid INT PRIMARY KEY AUTO_INCREMENT,
-                rootpath VARCHAR(256) NOT NULL,
-                relpath VARCHAR(256) NOT NULL,
-                mtime DOUBLE NOT NULL,
-                stable BOOL DEFAULT 0,
-                public BOOL DEFAULT 0,
-                done BOOL DEFAULT 0,
-                runname VARCHAR(128),
-                tschange TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-            )""",
-            """CREATE TABLE IF NOT EXISTS profile (
-                itemid BIGINT UNSIGNED,
-                module VARCHAR(128),
-                product VARCHAR(128),
-                addtime DOUBLE,
-                waittime FLOAT DEFAULT 0,
-                processtime FLOAT DEFAULT 0,
-                totaltime FLOAT DEFAULT 0,
-                errors TINYINT DEFAULT 0,
-                timeouts TINYINT DEFAULT 0,
-                cancelled TINYINT DEFAULT 0,
-                state TINYINT DEFAULT 1,
-                worker SMALLINT DEFAULT NULL,
-                node VARCHAR(128) DEFAULT NULL,
-                type TINYINT DEFAULT 1,
-                priority TINYINT DEFAULT -1,
-                datasize BIGINT UNSIGNED DEFAULT 0,
-                memory_max BIGINT UNSIGNED DEFAULT 0,
-                cpu_time FLOAT DEFAULT 0,
-                PRIMARY KEY (itemid, module)
-            )""",
-            """CREATE TABLE IF NOT EXISTS profile_summary (
-                module VARCHAR(128),
-                time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                runs INT,
-                datasize BIGINT UNSIGNED DEFAULT NULL,
-                waittime FLOAT,
-                processtime FLOAT,
-                totaltime FLOAT,
-                cpu_time FLOAT,
-                priority FLOAT,
-                errors INT,
-                timeouts INT,
-                cancelled INT,
-                PRIMARY KEY(module, priority, time)
-            )""",
-            """CREATE TABLE IF NOT EXISTS worker (
-                id VARCHAR(256) PRIMARY KEY,
-                modules VARCHAR(4000) DEFAULT "",
-                last_seen TIMESTAMP DEFAULT NOW() ON UPDATE NOW(),
-                last_job TIMESTAMP NULL
-                )
-            """,
-            "CREATE INDEX job_state ON jobs(state)",
-            "CREATE INDEX job_type ON jobs(type)",
-            "CREATE INDEX profile_module ON profile_summary(module)"
-        ]
+        # How long jobs wait for their preferred nodes, see add_job()
+        self._share_cfg.set_default("locality_grace", 30)
+        self._locality_grace = self._share_cfg["locality_grace"]
 
-        # Minor upgrade-hack
-        try:
-            c = self._execute("SELECT min(cpu_time) FROM jobs LIMIT 1")
-            c.fetchall()
-            c = self._execute("SELECT min(is_blocked) FROM jobs LIMIT 1")
-            c.fetchall()
-        except:
-            try:
-                print("*** Job table is bad, dropping it")
-                self._execute("DROP TABLE jobs")
-            except:
-                pass
+        # Leases of allocated jobs, see renew_leases()
+        self._share_cfg.set_default("lease_time", LEASE_TIME)
+        self.lease_time = float(self._share_cfg["lease_time"])
 
-        try:
-            c = self._execute("SELECT runname FROM filewatch LIMIT 1")
-            c.fetchall()
-        except:
-            try:
-                print("*** Filewatch is bad")
-                self._execute("ALTER TABLE filewatch DROP COLUMN runid")
-                self._execute("ALTER TABLE filewatch ADD runname VARCHAR(128) DEFAULT NULL")
-            except:
-                pass
+        # Priority aging, see AGING_INTERVAL
+        self._share_cfg.set_default("aging_interval", AGING_INTERVAL)
+        self._share_cfg.set_default("aging_step", AGING_STEP)
+        self._share_cfg.set_default("aging_cap", AGING_CAP)
 
-        self._init_sqls(statements)
+        # Retries of failed jobs, see update_job()
+        self._share_cfg.set_default("max_retries", MAX_RETRIES)
+        self._share_cfg.set_default("retry_delay", RETRY_DELAY)
+        self._share_cfg.set_default("retry_max_delay", RETRY_MAX_DELAY)
 
-        try:
-            c = self._execute("SELECT itemid FROM jobs WHERE jobid=0")
-            c.fetchone()
-        except:
-            # Old table, upgrade it
-            print("*** Updating jobdb table")
-            self._execute("ALTER TABLE jobs ADD (itemid BIGINT DEFAULT 0)")
+        # Wake-up hints for idle workers, created when first needed
+        self._notifier = None
+        self._listener = None
 
-        c = self._execute("SELECT runid FROM runs WHERE runname=%s", [self._runname])
-        row = c.fetchone()
-        if row:
-            self._runid = row[0]
-            self._execute("UPDATE runs SET module=%s, steps=%s WHERE runid=%s", [module, steps, self._runid])
-        else:
-            c = self._execute("INSERT INTO runs (runname, module, steps) VALUES (%s, %s, %s)",
-                              [self._runname, module, steps])
-            self._runid = c.lastrowid
+        # Multi-insert
+        self._addlist = []
+        self._deplist = []
+        self._addtimer = None
+        self._addnow = False
+        self._addLock = threading.Lock()
+        self._taskid = 1
+
+        # Write-behind of job and profile updates, see queue_update()
+        self._updatelist = []
+        self._profilelist = []
+        self._updatetimer = None
+        self._updatenow = False
+        self._updateLock = threading.Lock()
+        self._flushLock = threading.Lock()
+
+        # Running profile statistics, see update_profile(). Profiles not yet
+        # finished, our statistics not yet merged and the shared ones
+        self._profile_open = OrderedDict()
+        self._profile_own = {}
+        self._profile_shared = None
+        self._profile_shared_ts = 0
+        self._statstimer = None
+        self._statsLock = threading.Lock()
+        self._estimates = {}
+
+        # Shared (deduplicated) and compressed args and retvals
+        self._argstore = argstore.ArgStore(self, self._BLOB_UPSERT)
+
+        # Worker nodes and what they can run, see update_node()
+        self._registry = noderegistry.NodeRegistry(self, self._NODE_UPSERT, self._NOW_SECONDS)
+
+    def _start_cleanup(self, auto_cleanup):
+        self._archive_cfg = API.get_config("CryoCloud.JobDB")
+        self._archive_cfg.set_default("archive_after", 600)
+        self._archive_cfg.set_default("archive_batch", 500)
+        self._archive_cfg.set_default("history_retention", 7 * 86400)
 
         self._cleanup_thread = None
         if auto_cleanup:
@@ -202,8 +439,8 @@ class JobDB(mysql):
 
     def __del__(self):
         try:
-            if self._cleanup_timer:
-                self._cleanup_timer.cancel()
+            if self._cleanup_thread:
+                self._cleanup_thread.cancel()
         except:
             pass
 
@@ -218,32 +455,77 @@ class JobDB(mysql):
 
     def add_job(self, step, taskid, args, jobtype=TYPE_NORMAL, priority=PRI_NORMAL, node=None,
                 expire_time=3600, module=None, modulepath=None, workdir=None, itemid=None,
-                multiple=True, isblocked=False, retval=None):
+                multiple=True, isblocked=False, retval=None, prefer_nodes=None, depends=None,
+                resources=None, max_retries=None):
         """
-        If retval is given, we assume it was cached and therefore completed
+        If retval is given, we assume it was cached and therefore completed.
+
+        max_retries is how many times the job is retried if it fails with an
+        error that can be retried (see update_job()), default
+        CryoCloud.JobDB.max_retries.
+
+        resources is a map of what the job needs of "cpus", "memory" and
+        "scratch" (MB), missing ones are taken from DEFAULT_RESOURCES.
+
+        prefer_nodes is a list of nodes that should run the job if they can,
+        typically where its input data is. Other nodes can only take it after
+        CryoCloud.JobDB.locality_grace seconds.
+
+        depends is a list of taskids of jobs in this run that must complete
+        before this one can run, and args can use their retvals, see
+        job_retval(). The job is released by whoever completes the last of
+        them. It is cancelled if one of them is cancelled, and fails if one
+        fails (when it has no retries left) or times out, with an error
+        naming that parent.
         """
 
         if not module and not self._module:
             raise Exception("Missing module for job, and no default module!")
 
-        if args is not None:
-            args = json.dumps(args)
+        args = self._argstore.pack(args)
 
         if taskid is None:
             taskid = self._taskid
             self._taskid += 1
 
+        local_until = None
+        if prefer_nodes:
+            local_until = time.time() + float(self._locality_grace)
+            prefer_nodes = ",".join(prefer_nodes)
+        else:
+            prefer_nodes = None
+
+        if depends and not retval:
+            isblocked = BLOCKED_DEPENDS
+            depends = [(taskid, parent) for parent in set(depends)]
+        else:
+            depends = []
+
+        req = dict(DEFAULT_RESOURCES)
+        req.update({r: int(v) for r, v in (resources or {}).items() if r in req and v is not None})
+        if max_retries is None:
+            max_retries = int(self._share_cfg["max_retries"])
+
         if multiple:
             with self._addLock:
-                self._addlist.append([self._runid, step, taskid, jobtype, priority, STATE_PENDING, time.time(), expire_time, node, args, module, modulepath, workdir, itemid, isblocked])
+                self._deplist.extend(depends)
+                self._addlist.append([self._runid, step, taskid, jobtype, priority, STATE_PENDING, time.time(), expire_time, node, args, module, modulepath, workdir, itemid, isblocked, prefer_nodes, local_until, req["cpus"], req["memory"], req["scratch"], max_retries])
                 # Set a timer for commit - if multiple ones have been added, they will be added together
-                if self._addtimer is None:
-                    self._addtimer = threading.Timer(0.5, self.commit_jobs)
+                flush_now = len(self._addlist) >= ADD_FLUSH_ROWS
+                if self._addtimer is None or (flush_now and not self._addnow):
+                    if self._addtimer:
+                        self._addtimer.cancel()
+                    self._addnow = flush_now
+                    self._addtimer = threading.Timer(0 if flush_now else ADD_FLUSH_INTERVAL, self.commit_jobs)
+                    self._addtimer.daemon = True
                     self._addtimer.start()
             return taskid
 
         now = time.time()
+        self._argstore.flush(now)
         if retval:
+            if not isinstance(retval, str):
+                retval = self._argstore.pack(retval, share=False)
             state = STATE_COMPLETED
             isblocked = False  # Can't block it when it's already done
             tsalloc = now
@@ -252,27 +534,73 @@ class JobDB(mysql):
             retval = None
             tsalloc = None
 
-        self._execute("INSERT INTO jobs (runid, step, taskid, type, priority, state, tsadded, tsallocated, expiretime, node, args, module, modulepath, workdir, itemid, is_blocked, retval) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                      [self._runid, step, taskid, jobtype, priority, state, now, tsalloc, expire_time, node, args, module, modulepath, workdir, itemid, isblocked, retval])
+        self._execute("INSERT INTO jobs (runid, step, taskid, type, priority, state, tsadded, tsallocated, expiretime, node, args, module, modulepath, workdir, itemid, is_blocked, retval, prefer_nodes, local_until, req_cpus, req_memory, req_scratch, max_retries) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                      [self._runid, step, taskid, jobtype, priority, state, now, tsalloc, expire_time, node, args, module, modulepath, workdir, itemid, isblocked, retval, prefer_nodes, local_until, req["cpus"], req["memory"], req["scratch"], max_retries])
+        if depends:
+            self._add_dependencies(depends)
+        if state == STATE_PENDING and not isblocked:
+            self._notify([jobtype])
         return taskid
 
+    def _notify(self, jobtypes=None):
+        """
+        Wake up idle workers, jobtypes None means any type
+        """
+        if not self._notifier:
+            self._notifier = JobNotifier()
+        self._notifier.notify(jobtypes)
+
+    def wait_for_jobs(self, timeout=None, type=None):
+        """
+        Block an idle worker until jobs of the given type might be available.
+        Returns True if woken by a notification, False on timeout. Without
+        notifications this is a plain sleep of POLL_INTERVAL
+        """
+        if not self._listener:
+            self._listener = JobListener()
+        if not self._listener.is_listening():
+            time.sleep(POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL))
+            return False
+        return self._listener.wait(NOTIFY_POLL_INTERVAL if timeout is None else timeout, type)
+
     def unblock_jobid(self, jobid):
         c = self._execute("UPDATE jobs SET is_blocked=0 WHERE jobid=%s", [jobid])
+        if c.rowcount:
+            self._notify()
         return c.rowcount
 
-    def unblock_step(self, step, amount=1, max_parallel=None):
-        if max_parallel:
-            c = self._execute("SELECT COUNT(*) FROM jobs WHERE is_blocked=0 AND runid=%s AND step=%s AND STATE<%s",
-                              [self._runid, step, STATE_COMPLETED])
-            num = c.fetchone()[0]
-            # print("MaxParallel is defined as %s, unblocked are: %s" % (max_parallel, num))
-            if num >= max_parallel:
-                print("INTERNAL: ALREADY HAVE ENOUGH UNBLOCKED")
-                return 0
+    def release_gang(self, taskids):
+        """
+        Make the jobs of a gang, added with isblocked=BLOCKED_GANG, available
+        for allocation at the same time. Returns the number released
+        """
+        self.commit_jobs()
+        num = 0
+        for i in range(0, len(taskids), 1000):
+            batch = taskids[i:i + 1000]
+            c = self._execute("UPDATE jobs SET is_blocked=0 WHERE runid=%s AND is_blocked=%s AND taskid IN (" +
+                              ",".join(["%s"] * len(batch)) + ")", [self._runid, BLOCKED_GANG] + batch)
+            num += c.rowcount
+        if num:
+            self._notify()
+        return num
 
-        c = self._execute("UPDATE jobs SET is_blocked=0 WHERE runid=%s AND step=%s AND is_blocked=1 LIMIT %s",
-                          [self._runid, step, amount])
-        return c.rowcount
+    def set_max_parallel(self, step, max_parallel):
+        """
+        Limit how many jobs of a step of this run can be pending with a slot
+        or allocated at the same time. Jobs of the step must be added with
+        isblocked=BLOCKED_PARALLEL, and are given slots when workers claim
+        jobs, see step_slots
+        """
+        self._execute("INSERT INTO step_slots (runid, step, max_parallel) VALUES (%s, %s, %s) " + self._SLOTS_UPSERT,
+                      [self._runid, step, max_parallel])
+        self._notify()
+
+    def unblock_step(self, step, amount=1):
+        num = self._unblock(step, amount)
+        if num:
+            self._notify()
+        return num
 
     def list_steps(self):
         c = self._execute("SELECT DISTINCT(step), module FROM jobs WHERE runid=%s AND (state=%s OR state=%s)",
@@ -287,51 +615,211 @@ class JobDB(mysql):
                       [STATE_DISABLED, STATE_PENDING, self._runid, step])
 
     def enable_step(self, step):
-        self._execute("UPDATE jobs SET STATE=%s WHERE STATE=%s AND runid=%s AND step=%s",
-                      [STATE_PENDING, STATE_DISABLED, self._runid, step])
+        c = self._execute("UPDATE jobs SET STATE=%s WHERE STATE=%s AND runid=%s AND step=%s",
+                          [STATE_PENDING, STATE_DISABLED, self._runid, step])
+        if c.rowcount:
+            self._notify()
 
     def flush(self):
         self.commit_jobs()
+        self.commit_updates()
+        self._commit_profile_stats()
 
     def commit_jobs(self):
         """
         TODO: Could do this more efficient if we held the lock for shorter, but it doesn't seem like a big deal for now
         """
         with self._addLock:
-            self._addtimer = None  # TODO: Should likely have a lock protecting this one
+            if self._addtimer:
+                self._addtimer.cancel()
+                self._addtimer = None
+            self._addnow = False
             if len(self._addlist) == 0:
                 # print("*** WARNING: commit_jobs called but no queued jobs")
                 return
 
-            SQL = "INSERT INTO jobs (runid, step, taskid, type, priority, state, tsadded, expiretime, node, args, module, modulepath, workdir, itemid, is_blocked) VALUES "
+            # Shared args must be in place before the jobs referring to them
+            self._argstore.flush(time.time())
+
+            SQL = "INSERT INTO jobs (runid, step, taskid, type, priority, state, tsadded, expiretime, node, args, module, modulepath, workdir, itemid, is_blocked, prefer_nodes, local_until, req_cpus, req_memory, req_scratch, max_retries) VALUES "
             args = []
             for job in self._addlist:
-                SQL += "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s),"
+                SQL += "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s),"
                 args.extend(job)
 
                 if len(args) > 1000:
                     self._execute(SQL[:-1], args)
-                    SQL = "INSERT INTO jobs (runid, step, taskid, type, priority, state, tsadded, expiretime, node, args, module, modulepath, workdir, itemid, is_blocked) VALUES "
+                    SQL = "INSERT INTO jobs (runid, step, taskid, type, priority, state, tsadded, expiretime, node, args, module, modulepath, workdir, itemid, is_blocked, prefer_nodes, local_until, req_cpus, req_memory, req_scratch, max_retries) VALUES "
                     args = []
             if len(args) > 0:
                 self._execute(SQL[:-1], args)
+            jobtypes = list(set([job[3] for job in self._addlist if not job[14]]))
             self._addlist = []
+            depends, self._deplist = self._deplist, []
+        if depends:
+            self._add_dependencies(depends)
+        if jobtypes:
+            self._notify(jobtypes)
+
+    def _add_dependencies(self, depends):
+        """
+        Record (taskid, parent) dependencies of jobs that have been added, and
+        release the ones whose parents were done already
+        """
+        # Parents that are still queued for adding must be seen
+        self.commit_jobs()
+        for i in range(0, len(depends), UPDATE_FLUSH_ROWS):
+            batch = depends[i:i + UPDATE_FLUSH_ROWS]
+            args = []
+            for taskid, parent in batch:
+                args.extend([self._runid, taskid, parent])
+            self._execute("INSERT INTO job_deps (runid, taskid, parent) VALUES " +
+                          ",".join(["(%s, %s, %s)"] * len(batch)), args)
+        # Parents completed meanwhile did not see them, so check them all
+        self._resolve_dependents(list(set([(self._runid, taskid) for taskid, parent in depends])))
+
+    def _release_dependents(self, jobids):
+        """
+        Called when jobs have been completed or cancelled, resolves the jobs
+        that depend on them
+        """
+        if not jobids:
+            return
+        self.commit_jobs()
+        c = self._execute("SELECT DISTINCT job_deps.runid, job_deps.taskid FROM jobs JOIN job_deps " +
+                          "ON job_deps.runid=jobs.runid AND job_deps.parent=jobs.taskid WHERE jobs.jobid IN (" +
+                          ",".join(["%s"] * len(jobids)) + ")", list(jobids))
+        dependents = c.fetchall()
+        if dependents:
+            self._resolve_dependents(dependents)
+
+    def _resolve_dependents(self, dependents):
+        """
+        Release waiting jobs, given as (runid, taskid), that have all their
+        parents completed, with placeholders in their args filled in, and
+        end the ones with a parent that ended otherwise (see PARENT_ENDED).
+        Parents that do not exist (yet) keep them waiting
+        """
+        runs = {}
+        for runid, taskid in dependents:
+            runs.setdefault(runid, []).append(taskid)
+
+        released = 0
+        for runid, taskids in runs.items():
+            marks = ",".join(["%s"] * len(taskids))
+            parents = {}
+            c = self._execute("SELECT taskid, parent FROM job_deps WHERE runid=%s AND taskid IN (" + marks + ")",
+                              [runid] + taskids)
+            for taskid, parent in c.fetchall():
+                parents.setdefault(taskid, set()).add(parent)
+            states = {}
+            for table in ["jobs", "jobs_history"]:
+                c = self._execute("SELECT DISTINCT job_deps.parent, t.state, t.retval FROM job_deps JOIN " + table +
+                                  " AS t ON t.runid=job_deps.runid AND t.taskid=job_deps.parent " +
+                                  "WHERE job_deps.runid=%s AND job_deps.taskid IN (" + marks + ")", [runid] + taskids)
+                for parent, state, retval in c.fetchall():
+                    if parent not in states:
+                        states[parent] = (state, retval)
+
+            ready = []
+            ended = {}  # taskid -> (parent, state) of a parent that did not complete
+            for taskid in taskids:
+                if taskid not in parents:
+                    continue
+                pstates = [(p, states[p][0]) for p in parents[taskid] if p in states]
+                bad = [(p, s) for p, s in pstates if s in PARENT_ENDED]
+                if bad:
+                    # A cancelled parent cancels, others fail it
+                    bad.sort(key=lambda b: b[1] != STATE_CANCELLED)
+                    ended[taskid] = bad[0]
+                elif len(pstates) == len(parents[taskid]) and all([s == STATE_COMPLETED for p, s in pstates]):
+                    ready.append(taskid)
+            if ended:
+                done = []
+                for taskid, (parent, pstate) in ended.items():
+                    state = STATE_CANCELLED if pstate == STATE_CANCELLED else STATE_FAILED
+                    retval = self._argstore.pack({"error": "Parent task %s %s" % (parent, PARENT_ENDED[pstate])},
+                                                 share=False)
+                    c = self._execute("UPDATE jobs SET state=%s, retval=%s WHERE runid=%s AND taskid=%s AND is_blocked=%s AND state=%s",
+                                      [state, retval, runid, taskid, BLOCKED_DEPENDS, STATE_PENDING])
+                    if c.rowcount:
+                        done.append(taskid)
+                if done:
+                    # And their dependents in turn
+                    c = self._execute("SELECT jobid FROM jobs WHERE runid=%s AND is_blocked=%s AND state IN (%s, %s) AND taskid IN (" +
+                                      ",".join(["%s"] * len(done)) + ")",
+                                      [runid, BLOCKED_DEPENDS, STATE_FAILED, STATE_CANCELLED] + done)
+                    self._release_dependents([row[0] for row in c.fetchall()])
+            if not ready:
+                continue
+
+            c = self._execute("SELECT jobid, taskid, args FROM jobs WHERE runid=%s AND is_blocked=%s AND taskid IN (" +
+                              ",".join(["%s"] * len(ready)) + ")", [runid, BLOCKED_DEPENDS] + ready)
+            rows = c.fetchall()
+            allargs = self._argstore.unpack_many([row[2] for row in rows])
+            retvals = {}
+            for taskid in ready:
+                for p in parents.get(taskid, []):
+                    if p not in retvals:
+                        retvals[p] = self._argstore.unpack(states[p][1])
+            plain = []
+            for (jobid, taskid, packed), args in zip(rows, allargs):
+                filled = fill_retvals(args, retvals)
+                if filled == args:
+                    plain.append(jobid)
+                    continue
+                packed = self._argstore.pack(filled)
+                self._argstore.flush(time.time())
+                c = self._execute("UPDATE jobs SET args=%s, is_blocked=0 WHERE jobid=%s AND is_blocked=%s",
+                                  [packed, jobid, BLOCKED_DEPENDS])
+                released += c.rowcount
+            if plain:
+                c = self._execute("UPDATE jobs SET is_blocked=0 WHERE is_blocked=%s AND jobid IN (" +
+                                  ",".join(["%s"] * len(plain)) + ")", [BLOCKED_DEPENDS] + plain)
+                released += c.rowcount
+        if released:
+            self._notify()
 
     def cancel_job_by_taskid(self, taskid):
-        self._execute("UPDATE jobs SET state=%s WHERE taskid=%s AND state<%s", (STATE_CANCELLED, taskid, STATE_COMPLETED))
+        c = self._execute("UPDATE jobs SET state=%s WHERE taskid=%s AND state<%s", (STATE_CANCELLED, taskid, STATE_COMPLETED))
+        if c.rowcount:
+            c = self._execute("SELECT jobid FROM jobs WHERE taskid=%s AND state=%s", (taskid, STATE_CANCELLED))
+            self._release_dependents([row[0] for row in c.fetchall()])
 
     def cancel_job(self, jobid):
-        self._execute("UPDATE jobs SET state=%s WHERE jobid=%s  AND state<%s", (STATE_CANCELLED, jobid, STATE_COMPLETED))
+        c = self._execute("UPDATE jobs SET state=%s WHERE jobid=%s  AND state<%s", (STATE_CANCELLED, jobid, STATE_COMPLETED))
+        if c.rowcount:
+            self._release_dependents([jobid])
+
+    def release_jobs(self, jobids):
+        """
+        Give allocated jobs that were never started back to the pool, like
+        prefetched jobs that were not used in time. Returns the number released
+        """
+        if not jobids:
+            return 0
+        SQL = "UPDATE jobs SET state=%s, tsallocated=NULL, lease_until=NULL, node=NULL, worker=NULL WHERE state=%s AND jobid IN (" +\
+            ",".join(["%s"] * len(jobids)) + ")"
+        c = self._execute(SQL, [STATE_PENDING, STATE_ALLOCATED] + list(jobids))
+        if c.rowcount:
+            self._notify()
+        return c.rowcount
 
     def force_stopped(self, workerid, node):
-        self._execute("UPDATE jobs SET state=%s, retval='{\"error\":\"Worker killed\"}' WHERE worker=%s AND node=%s AND state=%s",
-                      [STATE_FAILED, workerid, node, STATE_ALLOCATED])
+        c = self._execute("SELECT jobid FROM jobs WHERE worker=%s AND node=%s AND state=%s",
+                          [workerid, node, STATE_ALLOCATED])
+        jobids = [row[0] for row in c.fetchall()]
+        if not jobids:
+            return
+        self._execute("UPDATE jobs SET state=%s, retval='{\"error\":\"Worker killed\"}' WHERE state=%s AND jobid IN (" +
+                      ",".join(["%s"] * len(jobids)) + ")", [STATE_FAILED, STATE_ALLOCATED] + jobids)
+        self._release_dependents(jobids)
 
     def get_job_state(self, jobid):
         """
         Check that the job hasn't been updated, i.e. cancelled or removed
         """
-        c = self._execute("SELECT state FROM jobs WHERE jobid=%s", [jobid])
+        c = self._execute("SELECT state FROM jobs WHERE jobid=%s", [jobid], prepare=True)
         row = c.fetchone()
         if row:
             return row[0]
@@ -347,9 +835,84 @@ class JobDB(mysql):
         # print("PENDING JOBS", SQL, num)
         return num
 
+    def _get_max_priority(self, modules=None):
+        """
+        Highest pending priority for any of the given modules (all if None).
+        Cached for PRIORITY_CACHE_TIME seconds, uses a loose index scan to refresh.
+        """
+        now = time.time()
+        if now - self._max_priority_ts > PRIORITY_CACHE_TIME:
+            c = self._execute("SELECT module, MAX(priority) FROM jobs WHERE state=%s GROUP BY module",
+                              [STATE_PENDING], prepare=True)
+            self._max_priority = {row[0]: row[1] for row in c.fetchall()}
+            self._max_priority_ts = now
+
+        prios = [p for m, p in self._max_priority.items() if modules is None or m in modules]
+        if len(prios) == 0:
+            return None
+        return max(prios)
+
+    def _get_share_run(self):
+        """
+        With fair share, the run that has had the least allocations relative
+        to its weight during the last SHARE_WINDOW seconds, among the runs with
+        pending jobs at the highest pending priority. Run stats are cached for
+        PRIORITY_CACHE_TIME seconds or SHARE_REFRESH_CLAIMS allocations, those
+        made by us meanwhile are counted locally. Returns None if fair share is
+        off or there is no choice to make.
+        """
+        if not self._share_cfg["fair_share"]:
+            return None
+        now = time.time()
+        if now - self._share_ts > PRIORITY_CACHE_TIME or self._share_claims >= SHARE_REFRESH_CLAIMS:
+            runs = {}
+            c = self._execute("SELECT runid, MAX(priority), weight FROM jobs JOIN runs USING (runid) " +
+                              "WHERE state=%s AND is_blocked=0 GROUP BY runid, weight", [STATE_PENDING], prepare=True)
+            for runid, priority, weight in c.fetchall():
+                runs[runid] = {"priority": priority, "weight": weight or 1.0, "allocated": 0}
+            c = self._execute("SELECT runid, COUNT(*) FROM jobs WHERE tsallocated>%s GROUP BY runid",
+                              [now - SHARE_WINDOW], prepare=True)
+            for runid, allocated in c.fetchall():
+                if runid in runs:
+                    runs[runid]["allocated"] = allocated
+            self._share_runs = runs
+            self._share_ts = now
+            self._share_claims = 0
+
+        if len(self._share_runs) < 2:
+            return None
+        top = max([r["priority"] for r in self._share_runs.values()])
+        candidates = [(r["allocated"] / r["weight"], runid) for runid, r in self._share_runs.items()
+                      if r["priority"] == top]
+        return min(candidates)[1]
+
+    def set_share(self, weight):
+        """
+        Set the fair share weight of this run, runs get allocations in proportion
+        to their weights. Defaults to the CryoCloud.JobDB.share.<module> config
+        value, or 1
+        """
+        self._execute("UPDATE runs SET weight=%s WHERE runid=%s", [weight, self._runid])
+
+    def _create_run(self, module, steps):
+        c = self._execute("SELECT runid FROM runs WHERE runname=%s", [self._runname])
+        row = c.fetchone()
+        if row:
+            self._runid = row[0]
+            self._execute("UPDATE runs SET module=%s, steps=%s WHERE runid=%s", [module, steps, self._runid])
+        else:
+            c = self._execute("INSERT INTO runs (runname, module, steps) VALUES (%s, %s, %s)",
+                              [self._runname, module, steps])
+            self._runid = c.lastrowid
+        if module and self._share_cfg["share.%s" % module]:
+            self.set_share(float(self._share_cfg["share.%s" % module]))
+
     def allocate_job(self, workerid, supportedmodules, type=TYPE_NORMAL, node=None,
-                     max_jobs=1, prefermodule=None, preferlevel=100):
+                     max_jobs=1, prefermodule=None, preferlevel=100, budget=None):
         """
+        budget is a map of the "cpus", "memory" and "scratch" (MB) left on
+        the node, only jobs whose requests fit are allocated. Each job fits
+        on its own, callers claiming several must check that they fit together.
 
         Preferlevel is a measure of how lower priority a task can have before
         a preferred job is selected. In other words, 0 disregards preference,
@@ -360,108 +923,59 @@ class JobDB(mysql):
         will limit the possibility of CryoCloud to allocate resources
         effectively, so if load/unload is low, set the prefer level to zero.
 
+        The claim itself is done by the backend in a single transaction, see _claim().
         """
         if workerid > 65000:
             raise Exception("BAD WORKER ID")
 
-        nonce = random.randint(0, 2147483647)
-        args = [STATE_ALLOCATED, time.time(), node, workerid, nonce, type, STATE_PENDING]
-        SQL = "UPDATE jobs SET state=%s, tsallocated=%s, node=%s, worker=%s, nonce=%s WHERE " +\
-              "type=%s AND state=%s AND is_blocked=0 AND "
-        if node:
-            SQL += "(node IS NULL or node=%s) "
-            args.append(node)
-        else:
-            SQL += "node IS NULL "
-
-        BASESQL = SQL
-        BASEARGS = args[:]
-
-        any_module = True
+        modules = None
         if len(supportedmodules) > 0 and "any" not in supportedmodules:
-            any_module = False
-            SQL += "AND (" + " module=%s OR" * len(supportedmodules)
-            SQL = SQL[:-2] + ")"
-            args.extend(supportedmodules)
-        # print(SQL)
+            modules = supportedmodules
+
+        prefer = None
         min_prio = 0
         if prefermodule and preferlevel > 0:
+            prefer = prefermodule
             try:
-                s = "SELECT MAX(priority) FROM jobs"
-                if not any_module:
-                    s += " WHERE " + "module=%s OR " * len(supportedmodules)
-                    s = s[:-3]
-                    c = self._execute(s, supportedmodules)
-                else:
-                    c = self._execute(s)
-
-                min_prio = c.fetchone()[0] - preferlevel
+                max_prio = self._get_max_priority(modules)
+                if max_prio is not None:
+                    min_prio = max_prio - preferlevel
             except:
-                pass
-            original = SQL + " ORDER BY priority DESC, tsadded LIMIT %s"
-            originalargs = args[:]
-            originalargs.append(max_jobs)
-
-            SQL = BASESQL
-            args = BASEARGS
-            SQL += "AND module=%s AND priority>%s"
-            args.append(prefermodule)
-            args.append(min_prio)
-            # print(SQL, args)
-
-            # SQL += "AND module=%s AND priority>%s "
-        SQL += " ORDER BY priority DESC, tsadded LIMIT %s"
-        args.append(max_jobs)
-        c = None
-        for i in range(0, 3):
-            try:
-                # print(SQL, args)
-                c = self._execute(SQL, args)
-                if c.rowcount == 0 and prefermodule:
-                    if preferlevel > 1000:
-                        return []  # We didn't have any suitable jobs
+                self.log.exception("Failed to get max priority, ignoring")
 
-                    # We didn't find any jobs with the preferred module, go generic
-                    SQL = original
-                    args = originalargs
-                    continue
-                break
-            except:
-                self.log.exception("Failed to get job, retrying")
-                self.log.error("SQL statement was: '%s' with args '%s" % (SQL, args))
-        if not c:
-            raise Exception("Failed to get job")
+        share_run = None
+        try:
+            share_run = self._get_share_run()
+        except:
+            self.log.exception("Failed to get fair share, ignoring")
 
-        ex = None
-        if c.rowcount > 0:
-            # We must not fail on this, so loop a few times to try to avoid it being allocated but not returned!
-            for i in range(0, 10):
-                try:
-                    c = self._execute("SELECT jobid, step, taskid, type, priority, args, runname, jobs.module, jobs.modulepath, runs.module, steps, workdir, itemid FROM jobs, runs WHERE runs.runid=jobs.runid AND nonce=%s", [nonce])
-                    jobs = []
-                    for jobid, step, taskid, t, priority, args, runname, jmodule, modulepath, rmodule, steps, workdir, itemid in c.fetchall():
-                        if args:
-                            if isinstance(args, bytes):
-                                args = json.loads(args.decode("utf-8"))
-                            else:
-                                args = json.loads(args)
-                        if jmodule:
-                            module = jmodule
-                        else:
-                            module = rmodule
-                        jobs.append({"id": jobid, "step": step, "taskid": taskid, "type": t, "priority": priority,
-                                     "args": args, "runname": runname, "module": module, "modulepath": modulepath,
-                                     "steps": steps, "workdir": workdir, "itemid": itemid})
-
-                    return jobs
-                except Exception as e:
-                    ex = e
-                    self.log.exception("Problem getting the job that I allocated, trying to get it again in a second")
-                    time.sleep(1.0)
-        if ex:
-            raise ex
-        return []
+        nonce = random.randint(0, 2147483647)
+        budget = budget or {}
+        args = [type, node, ",".join(modules) if modules else None, prefer, min_prio,
+                preferlevel > 1000, workerid, nonce, max_jobs, time.time(), share_run, self.lease_time] +\
+            [int(budget[r]) if budget.get(r) is not None else None for r in RESOURCES] +\
+            [float(self._share_cfg["aging_interval"]), int(self._share_cfg["aging_step"]),
+             int(self._share_cfg["aging_cap"])]
+        rows = self._claim(args)
+        for row in rows:
+            runid = row[13]
+            if runid in self._share_runs:
+                self._share_runs[runid]["allocated"] += 1
+                self._share_claims += 1
 
+        jobs = []
+        allargs = self._argstore.unpack_many([row[5] for row in rows])
+        for row, args in zip(rows, allargs):
+            jobid, step, taskid, t, priority, _, runname, jmodule, modulepath, rmodule, steps, workdir, itemid = row[:13]
+            if jmodule:
+                module = jmodule
+            else:
+                module = rmodule
+            jobs.append({"id": jobid, "step": step, "taskid": taskid, "type": t, "priority": priority,
+                         "args": args, "runname": runname, "module": module, "modulepath": modulepath,
+                         "steps": steps, "workdir": workdir, "itemid": itemid,
+                         "resources": dict(zip(RESOURCES, row[14:17]))})
+        return jobs
 
     def is_all_jobs_done(self):
         """No pending or allocated jobs"""
@@ -469,9 +983,25 @@ class JobDB(mysql):
         c = self._execute(SQL, [self._runid, STATE_ALLOCATED])
         return c.fetchone()[0] == 0 
 
+    _JOB_COLUMNS = "jobs.jobid, step, taskid, type, priority, args, tschange, jobs.state, expiretime, module, " +\
+                   "modulepath, tsallocated, node, worker, retval, workdir, itemid, cpu_time, max_memory, prefer_nodes"
+    _HISTORY_COLUMNS = _JOB_COLUMNS.replace("jobs.", "jobs_history.")
+
+    def _row_to_job(self, row):
+        jobid, step, taskid, t, priority, args, tschange, state, expire_time, module, modulepath, tsallocated, node, worker, retval, workdir, itemid, cpu_time, max_memory, prefer_nodes = row
+        args = self._argstore.unpack(args)
+        retval = self._argstore.unpack(retval)
+        job = {"id": jobid, "step": step, "taskid": taskid, "type": t, "priority": priority,
+               "node": node, "worker": worker, "args": args, "tschange": tschange, "state": state,
+               "expire_time": expire_time, "module": module, "modulepath": modulepath, "retval": retval,
+               "workdir": workdir, "itemid": itemid, "cpu": cpu_time, "mem": max_memory, "run": self._runid,
+               "prefer_nodes": prefer_nodes.split(",") if prefer_nodes else None}
+        if tsallocated:
+            job["runtime"] = time.time() - tsallocated
+        return job
+
     def list_jobs(self, step=None, state=None, notstate=None, since=None):
-        jobs = []
-        SQL = "SELECT jobid, step, taskid, type, priority, args, tschange, state, expiretime, module, modulepath, tsallocated, node, worker, retval, workdir, itemid, cpu_time, max_memory FROM jobs WHERE runid=%s"
+        SQL = "SELECT " + self._JOB_COLUMNS + " FROM jobs WHERE runid=%s"
         args = [self._runid]
         if step:
             SQL += " AND step=%s"
@@ -487,36 +1017,68 @@ class JobDB(mysql):
             args.append(since)
 
         SQL += " ORDER BY tschange"
-        c = self._execute(SQL, args)
-        for jobid, step, taskid, t, priority, args, tschange, state, expire_time, module, modulepath, tsallocated, node, worker, retval, workdir, itemid, cpu_time, max_memory in c.fetchall():
-            if args:
-                if isinstance(args, bytes):
-                    args = json.loads(args.decode("utf-8"))
-                else:
-                    args = json.loads(args)
-            if retval:
-                retval = json.loads(retval)
-            job = {"id": jobid, "step": step, "taskid": taskid, "type": t, "priority": priority,
-                   "node": node, "worker": worker, "args": args, "tschange": tschange, "state": state,
-                   "expire_time": expire_time, "module": module, "modulepath": modulepath, "retval": retval,
-                   "workdir": workdir, "itemid": itemid, "cpu": cpu_time, "mem": max_memory, "run": self._runid}
-            if tsallocated:
-                job["runtime"] = time.time() - tsallocated
+        c = self._execute(SQL, args, prepare=True)
+        return [self._row_to_job(row) for row in c.fetchall()]
+
+    def get_update_cursor(self):
+        """
+        The current position in the change log for this run, get_updates() after this
+        cursor will only return later changes
+        """
+        c = self._execute("SELECT MAX(seq) FROM job_events WHERE runid=%s", [self._runid])
+        row = c.fetchone()
+        if row and row[0]:
+            return row[0]
+        return 0
+
+    def get_updates(self, cursor=0, max_updates=1000):
+        """
+        Get job state changes in this run after the given cursor, in the order
+        they happened. A job is reported once for every state it has been in,
+        with "state" being the state it changed into and "seq" its position
+        in the change log.
+
+        Returns (cursor, jobs), give the returned cursor on the next call.
+        Jobs that have been archived meanwhile are read from jobs_history.
+        """
+        rows = self._get_update_rows(cursor, max_updates)
+        jobs = []
+        for row in rows:
+            cursor = row[0]
+            job = self._row_to_job(row[2:])
+            job["seq"] = row[0]
+            job["state"] = row[1]
             jobs.append(job)
-        return jobs
+        return cursor, jobs
 
     def clear_jobs(self):
         c = self._execute("DELETE FROM jobs WHERE runid=%s", [self._runid], insist_direct=True)
         c.close()
+        c = self._execute("DELETE FROM job_deps WHERE runid=%s", [self._runid], insist_direct=True)
+        c.close()
+        c = self._execute("DELETE FROM jobs_history WHERE runid=%s", [self._runid], insist_direct=True)
+        c.close()
+        c = self._execute("DELETE FROM step_slots WHERE runid=%s", [self._runid], insist_direct=True)
+        c.close()
         print("JOBS CLEARED")
 
     def remove_job(self, jobid):
         self._execute("DELETE FROM jobs WHERE runid=%s AND jobid=%s", [self._runid, jobid])
 
     def update_job(self, jobid, state, step=None, node=None, args=None, priority=None,
-                   expire_time=None, retval=None, cpu=None, memory=None):
-        SQL = "UPDATE jobs SET state=%s"
-        params = [state]
+                   expire_time=None, retval=None, cpu=None, memory=None, retry=False, holder=None):
+        """
+        A job that fails (STATE_FAILED) with retry set goes back to pending
+        after a backoff if it has retries left, see MAX_RETRIES. Workers give
+        holder as (workerid, node), the job is then only updated if it is
+        still allocated to them, not if it timed out and was claimed again
+        """
+        if retry and state == STATE_FAILED and \
+           self._retry_jobs([{"id": jobid, "retval": retval, "cpu": cpu, "memory": memory, "holder": holder}]):
+            return
+
+        SQL = "UPDATE jobs SET state=%s"
+        params = [state]
 
         if node:
             SQL += ",node=%s"
@@ -526,7 +1088,8 @@ class JobDB(mysql):
             params.append(step)
         if args:
             SQL += ",args=%s"
-            params.append(json.dumps(args))
+            params.append(self._argstore.pack(args))
+            self._argstore.flush(time.time())
         if priority:
             SQL += ",priority=%s"
             params.append(priority)
@@ -535,7 +1098,7 @@ class JobDB(mysql):
             params.append(expire_time)
         if retval:
             SQL += ",retval=%s"
-            params.append(json.dumps(retval))
+            params.append(self._argstore.pack(retval, share=False))
         if cpu:
             SQL += ",cpu_time=%s"
             params.append(cpu)
@@ -546,26 +1109,243 @@ class JobDB(mysql):
         SQL += " WHERE jobid=%s"  # AND runid=%s"
         params.append(jobid)
         # params.append(self._runid)
+        if holder:
+            SQL += " AND state=%s AND worker=%s AND node=%s"
+            params.extend([STATE_ALLOCATED, holder[0], holder[1]])
 
-        c = self._execute(SQL, params)
+        c = self._execute(SQL, params, prepare=True)
         if c.rowcount == 0:
             self.log.error("Error: %s(%s)" % (SQL, params))
             raise Exception("Failed to update, does the job exist or did the state change? (job %s -> %s)" % (jobid, state))
+        if STATE_COMPLETED <= state <= STATE_CANCELLED:
+            self._release_dependents([jobid])
 
-    def cleanup(self):
+    def update_jobs(self, updates):
+        """
+        Update many jobs using one statement pr UPDATE_FLUSH_ROWS jobs. Each
+        update is a map with "id" and "state", and optionally "retval", "cpu",
+        "memory", "retry" and "holder" (see update_job()).
+
+        Jobs that were cancelled meanwhile are left as they are. Returns a map
+        of jobid to current state for every job that was not updated, which is
+        STATE_CANCELLED if it was cancelled and None if it no longer exists
+        """
+        failed = {}
+        retried = self._retry_jobs([u for u in updates if u.get("retry") and u["state"] == STATE_FAILED])
+        updates = [u for u in updates if u["id"] not in retried]
+        for batch in self._batches(updates, lambda u: u["id"]):
+            self._update_batch(batch)
+
+            # Find the ones that did not end up in the requested state
+            SQL = "SELECT jobid, state FROM jobs WHERE jobid IN (" + ",".join(["%s"] * len(batch)) + ")"
+            c = self._execute(SQL, [u["id"] for u in batch])
+            states = {row[0]: row[1] for row in c.fetchall()}
+            for u in batch:
+                if states.get(u["id"]) != u["state"]:
+                    failed[u["id"]] = states.get(u["id"])
+            self._release_dependents([u["id"] for u in batch if u["id"] not in failed and
+                                      STATE_COMPLETED <= u["state"] <= STATE_CANCELLED])
+        return failed
+
+    def _retry_jobs(self, updates):
         """
-        Remove done, expired or failed jobs that were completed at least one hour ago
+        Put failed allocated jobs that have retries left back as pending,
+        blocked with BLOCKED_RETRY until their backoff has passed. Returns the
+        ids of the jobs that will be retried
         """
-        self._execute("DELETE FROM jobs WHERE state>=%s AND tschange < NOW() - INTERVAL 1 hour", [STATE_COMPLETED])
+        delay = float(self._share_cfg["retry_delay"])
+        max_delay = float(self._share_cfg["retry_max_delay"])
+        # retries is updated last, MySQL uses the new value in later assignments
+        SQL = "UPDATE jobs SET state=%s, is_blocked=%s, tsallocated=NULL, lease_until=NULL, node=NULL, worker=NULL, " +\
+              "not_before=%s + %s * CASE WHEN %s * (1 << retries) > %s THEN %s ELSE %s * (1 << retries) END, " +\
+              "retval=COALESCE(%s, retval), cpu_time=COALESCE(%s, cpu_time), max_memory=COALESCE(%s, max_memory), " +\
+              "retries=retries + 1 WHERE jobid=%s AND state=%s AND retries<max_retries"
+        retried = set()
+        for u in updates:
+            retval = self._argstore.pack(u["retval"], share=False) if u.get("retval") else None
+            params = [STATE_PENDING, BLOCKED_RETRY, time.time(), random.uniform(0.5, 1.5),
+                      delay, max_delay, max_delay, delay, retval, u.get("cpu") or None,
+                      u.get("memory") or None, u["id"], STATE_ALLOCATED]
+            if u.get("holder"):
+                c = self._execute(SQL + " AND worker=%s AND node=%s", params + list(u["holder"]))
+            else:
+                c = self._execute(SQL, params)
+            if c.rowcount:
+                retried.add(u["id"])
+        if retried:
+            self.log.info("Retrying %d failed jobs later" % len(retried))
+        return retried
+
+    def queue_update(self, jobid, state, retval=None, cpu=None, memory=None, callback=None, retry=False,
+                     holder=None):
+        """
+        Write-behind version of update_job, the update is sent together with
+        other queued updates within UPDATE_FLUSH_INTERVAL seconds. If the job
+        is not updated, callback(jobid, state) is called with its current state
+        (see update_jobs), without a callback it is logged.
+        """
+        self._queue_write(self._updatelist, {"id": jobid, "state": state, "retval": retval,
+                                             "cpu": cpu, "memory": memory, "callback": callback,
+                                             "retry": retry, "holder": holder})
+
+    def _queue_write(self, queue, item):
+        """
+        Queue an update for commit_updates(), which runs in a timer thread, and
+        at once if the queue is full, so callers never wait for the database
+        """
+        with self._updateLock:
+            queue.append(item)
+            flush_now = len(self._updatelist) + len(self._profilelist) >= UPDATE_FLUSH_ROWS
+            if self._updatetimer is None or (flush_now and not self._updatenow):
+                if self._updatetimer:
+                    self._updatetimer.cancel()
+                self._updatenow = flush_now
+                self._updatetimer = threading.Timer(0 if flush_now else UPDATE_FLUSH_INTERVAL, self.commit_updates)
+                self._updatetimer.daemon = True
+                self._updatetimer.start()
+
+    def _batches(self, items, key, kind=None):
+        """
+        Split items into batches of at most UPDATE_FLUSH_ROWS. A multi-row UPDATE
+        only changes a row once, so a repeated key (or a new kind) starts a new batch
+        """
+        batches = []
+        batch = []
+        keys = set()
+        for item in items:
+            k = key(item)
+            if batch and (k in keys or len(batch) >= UPDATE_FLUSH_ROWS or
+                          (kind and kind(item) != kind(batch[0]))):
+                batches.append(batch)
+                batch = []
+                keys = set()
+            batch.append(item)
+            keys.add(k)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def commit_updates(self):
+        """
+        Write all queued job and profile updates
+        """
+        with self._flushLock:
+            with self._updateLock:
+                if self._updatetimer:
+                    self._updatetimer.cancel()
+                    self._updatetimer = None
+                self._updatenow = False
+                updates, self._updatelist = self._updatelist, []
+                profiles, self._profilelist = self._profilelist, []
+
+            if updates:
+                try:
+                    failed = self.update_jobs(updates)
+                except:
+                    # Don't lose them, try one by one instead
+                    self.log.exception("Bulk update of %d jobs failed, updating individually" % len(updates))
+                    failed = {}
+                    for u in updates:
+                        try:
+                            self.update_job(u["id"], u["state"], retval=u["retval"], cpu=u["cpu"], memory=u["memory"],
+                                            retry=u.get("retry"), holder=u.get("holder"))
+                        except:
+                            self.log.exception("Failed to update job %s" % u["id"])
+                            failed[u["id"]] = self.get_job_state(u["id"])
+                for u in updates:
+                    if u["id"] not in failed:
+                        continue
+                    if u["callback"]:
+                        try:
+                            u["callback"](u["id"], failed[u["id"]])
+                        except:
+                            self.log.exception("Exception in update callback for job %s" % u["id"])
+                    else:
+                        self.log.warning("Job %s not updated to state %s, it is in state %s" %
+                                         (u["id"], u["state"], failed[u["id"]]))
+
+            if profiles:
+                try:
+                    self._commit_profiles(profiles)
+                except:
+                    self.log.exception("Failed to update profiles")
+
+    def _cleanup_args(self):
+        """
+        Shared args are marked as used whenever a job referring to them is added,
+        so anything not used since the oldest job was added can go
+        """
+        c = self._execute("SELECT MIN(tsadded) FROM (SELECT MIN(tsadded) AS tsadded FROM jobs " +
+                          "UNION ALL SELECT MIN(tsadded) FROM jobs_history) AS oldest")
+        row = c.fetchone()
+        oldest = row[0] if row and row[0] else time.time()
+        self._argstore.cleanup(oldest - 3600)
+
+    def renew_leases(self, jobids, worker=None):
+        """
+        Extend the leases of allocated jobs by lease_time seconds, but not
+        beyond their expire time. Given a worker, the jobs are handed to it,
+        like prefetched jobs are. Returns the number of jobs renewed, jobs
+        that are no longer allocated are not
+        """
+        if len(jobids) == 0:
+            return 0
+        now = time.time()
+        until = now + self.lease_time
+        SQL = "UPDATE jobs SET lease_until=CASE WHEN expiretime IS NOT NULL AND tsallocated + expiretime < %s " +\
+              "THEN tsallocated + expiretime ELSE %s END"
+        params = [until, until]
+        if worker is not None:
+            SQL += ", worker=%s"
+            params.append(worker)
+        SQL += " WHERE state=%s AND jobid IN (" + ",".join(["%s"] * len(jobids)) + ")"
+        c = self._execute(SQL, params + [STATE_ALLOCATED] + list(jobids))
+        return c.rowcount
 
     def update_timeouts(self):
-        self._execute("UPDATE jobs SET state=%s WHERE state=%s AND tsallocated + expiretime < %s", [STATE_TIMEOUT, STATE_ALLOCATED, time.time()])
+        """
+        Time out allocated jobs whose lease has run out, found by the
+        job_lease index
+        """
+        now = time.time()
+        c = self._execute("SELECT jobid FROM jobs WHERE state=%s AND lease_until < %s", [STATE_ALLOCATED, now])
+        jobids = [row[0] for row in c.fetchall()]
+        if not jobids:
+            return
+        self._execute("UPDATE jobs SET state=%s WHERE state=%s AND lease_until < %s AND jobid IN (" +
+                      ",".join(["%s"] * len(jobids)) + ")", [STATE_TIMEOUT, STATE_ALLOCATED, now] + jobids)
+        self._release_dependents(jobids)
+
+    def get_wait_stats(self):
+        """
+        Wait times pr priority the jobs were given (not aged): the number of jobs
+        pending and the longest current wait, and the mean and 95th percentile
+        wait of completed jobs from the profile statistics
+        """
+        now = time.time()
+        stats = {}
+        c = self._execute("SELECT priority, COUNT(*), MIN(tsadded) FROM jobs WHERE state=%s GROUP BY priority",
+                          [STATE_PENDING])
+        for priority, pending, oldest in c.fetchall():
+            stats[priority] = {"pending": pending, "max_wait": now - oldest}
+
+        waits = {}
+        for (module, priority, bucket), s in self._get_profile_stats().items():
+            if priority not in waits:
+                waits[priority] = profilestats.RunningStat()
+            waits[priority].merge(s.stats["waittime"])
+        for priority, w in waits.items():
+            if w.n == 0:
+                continue
+            stat = stats.setdefault(priority, {"pending": 0, "max_wait": 0})
+            stat.update({"completed": w.n, "waittime": w.mean, "waittime_p95": w.quantile(0.95)})
+        return stats
 
     def get_jobstats(self):
 
         steps = {}
         # Find the average processing time for completed on this each step:
-        SQL = "SELECT step, AVG(UNIX_TIMESTAMP(tschange) - tsallocated) FROM jobs WHERE runid=%s AND state=%s GROUP BY step"
+        SQL = "SELECT step, AVG(" + self._TSCHANGE_SECONDS + " - tsallocated) FROM jobs WHERE runid=%s AND state=%s GROUP BY step"
         c = self._execute(SQL, [self._runid, STATE_COMPLETED])
         for step, avg in c.fetchall():
             steps[step] = {"average": avg}
@@ -637,129 +1417,281 @@ class JobDB(mysql):
     def update_profile(self, itemid, module, product=None, addtime=None, type=1,
                        state=None, worker=None, node=None, priority=None, datasize=None,
                        cpu=None, memory=None):
+        """
+        Profiles are written behind together with queued job updates, see
+        commit_updates(). Finished profiles are added to the running
+        statistics used by estimate_resources()
+        """
         if module[0] == "_":
             return  # Ignore "internal" jobs
+
+        # If this is supposedly a new one, the product is specified
+        if product:
+            if not addtime:
+                addtime = time.time()
+            self._queue_write(self._profilelist, ["insert", itemid, module, product, addtime, datasize, priority, type])
+            with self._statsLock:
+                self._profile_open[(itemid, module)] = {"addtime": addtime, "datasize": datasize,
+                                                        "priority": priority, "waittime": None}
+                if len(self._profile_open) > PROFILE_OPEN_MAX:
+                    self._profile_open.popitem(last=False)
+        elif state:
+            now = time.time()
+            self._queue_write(self._profilelist, ["update", itemid, module, state, now, worker, node,
+                                                  memory or None, cpu or None])
+            self._add_profile_stats(itemid, module, state, now, cpu or None, memory or None)
+
+    def _add_profile_stats(self, itemid, module, state, now, cpu, memory):
+        with self._statsLock:
+            profile = self._profile_open.get((itemid, module))
+            if profile is None:
+                return  # Added before we started
+            if state == STATE_ALLOCATED:
+                profile["waittime"] = now - profile["addtime"]
+                return
+            if state not in PROFILE_OUTCOME:
+                return
+            del self._profile_open[(itemid, module)]
+
+            totaltime = now - profile["addtime"]
+            waittime = profile["waittime"] or 0
+            priority = profile["priority"] if profile["priority"] is not None else -1
+            key = (module, priority, profilestats.size_bucket(profile["datasize"]))
+            if key not in self._profile_own:
+                self._profile_own[key] = profilestats.ProfileStats()
+            self._profile_own[key].add(PROFILE_OUTCOME[state], {
+                "waittime": waittime,
+                "processtime": totaltime - waittime,
+                "totaltime": totaltime,
+                "cpu_time": cpu,
+                "memory_max": memory})
+            if self._statstimer is None:
+                self._statstimer = threading.Timer(PROFILE_STATS_INTERVAL, self._commit_profile_stats)
+                self._statstimer.daemon = True
+                self._statstimer.start()
+
+    def _commit_profile_stats(self):
+        """
+        Merge our statistics since the last time into profile_stats
+        """
+        with self._statsLock:
+            if self._statstimer:
+                self._statstimer.cancel()
+                self._statstimer = None
+            own, self._profile_own = self._profile_own, {}
+
+        merged = set()
         try:
-            args = []
+            for key in own:
+                self._merge_profile_stats(key, own[key])
+                merged.add(key)
+        except:
+            self.log.exception("Failed to write profile statistics")
 
-            # If this is supposedly a new one, the product is specified
-            if product:
-                if not addtime:
-                    addtime = time.time()
-                SQL = "INSERT IGNORE INTO profile (itemid, module, product, addtime, datasize, priority, type) "\
-                      "VALUES (%s, %s, %s, %s, %s, %s, %s)"
-                self._execute(SQL, [itemid, module, product, addtime, datasize, priority, type])
-            elif state:
-                SQL = "UPDATE profile SET state=%s,"
-                args.append(state)
-                if state == STATE_ALLOCATED:
-                    SQL += "waittime=%s-addtime,worker=%s,node=%s"
-                    args.append(time.time())
-                    args.append(worker)
-                    args.append(node)
+        with self._statsLock:
+            for key, s in own.items():
+                if key in merged:
+                    target = self._profile_shared
                 else:
-                    SQL += "totaltime=%s-addtime,processtime=%s-addtime-waittime"
-                    args.append(time.time())
-                    args.append(time.time())
-
-                    if state == STATE_FAILED:
-                        SQL += ",errors=errors+1"
-                    elif state == STATE_TIMEOUT:
-                        SQL += ",timeouts=timeouts+1"
-                    elif state == STATE_CANCELLED:
-                        SQL += ",cancelled=cancelled+1"
-
-                if memory:
-                    SQL += ",memory_max=%s"
-                    args.append(memory)
-                if cpu:
-                    SQL += ",cpu_time=%s"
-                    args.append(cpu)
-                SQL += " WHERE itemid=%s AND module=%s"
-                args.append(itemid)
-                args.append(module)
-                self._execute(SQL, args)
-        except Exception as e:
-            print("Exception updating profile:", e)
+                    target = self._profile_own
+                if target is None:
+                    continue  # Will be read
+                if key not in target:
+                    target[key] = profilestats.ProfileStats()
+                target[key].merge(s)
+
+    def _merge_profile_stats(self, key, stats):
+        """
+        Merge stats into the shared row of key (module, priority, size bucket).
+        The row is only written if no other head has changed it since it was
+        read, otherwise it is read again
+        """
+        args = list(key)
+        self._execute("INSERT INTO profile_stats (module, priority, size_bucket, stats, updated, version) " +
+                      "VALUES (%s, %s, %s, %s, %s, 0) " + self._STATS_UPSERT,
+                      args + [profilestats.ProfileStats().to_json(), time.time()])
+        while True:
+            c = self._execute("SELECT stats, version FROM profile_stats WHERE module=%s AND priority=%s " +
+                              "AND size_bucket=%s", args)
+            row, version = c.fetchone()
+            total = profilestats.ProfileStats.from_json(row)
+            total.merge(stats)
+            if total.runs > PROFILE_STATS_MAX_RUNS:
+                total.scale(PROFILE_STATS_MAX_RUNS / total.runs)
+            c = self._execute("UPDATE profile_stats SET stats=%s, updated=%s, version=%s WHERE module=%s " +
+                              "AND priority=%s AND size_bucket=%s AND version=%s",
+                              [total.to_json(), time.time(), version + 1] + args + [version])
+            if c.rowcount:
+                return
+
+    def _get_profile_stats(self, module=None):
+        """
+        Statistics of all heads (for one module or all) as of the last time
+        they were read, and ours not merged into them yet. Only the first read
+        is done while waiting, later ones are done in the background
+        """
+        if self._profile_shared is None:
+            self._read_profile_stats()
+        elif time.time() - self._profile_shared_ts > PROFILE_STATS_REFRESH:
+            self._profile_shared_ts = time.time()
+            t = threading.Thread(target=self._read_profile_stats)
+            t.daemon = True
+            t.start()
+
+        with self._statsLock:
+            stats = {}
+            for source in [self._profile_shared or {}, self._profile_own]:
+                for key, s in source.items():
+                    if module and key[0] != module:
+                        continue
+                    if key not in stats:
+                        stats[key] = profilestats.ProfileStats()
+                    stats[key].merge(s)
+        return stats
+
+    def _read_profile_stats(self):
+        shared = {}
+        try:
+            c = self._execute("SELECT module, priority, size_bucket, stats FROM profile_stats")
+            for module, priority, bucket, stats in c.fetchall():
+                shared[(module, priority, bucket)] = profilestats.ProfileStats.from_json(stats)
+        except:
+            self.log.exception("Failed to read profile statistics")
+        with self._statsLock:
+            self._profile_shared = shared
+            self._profile_shared_ts = time.time()
+
+    def _has_profile_stats(self):
+        """
+        True if the profile_stats table is there, check before creating it
+        """
+        try:
+            self._execute("SELECT 1 FROM profile_stats LIMIT 1").fetchall()
+            return True
+        except:
+            return False
+
+    def _upgrade_profile_stats(self, existed):
+        """
+        Statistics used to be kept in rows of each head (owner), and before
+        that averaged in profile_summary. Merge them into the shared rows once,
+        whichever head gets to rename the old table does it
+        """
+        if existed:
+            try:
+                self._execute("SELECT owner FROM profile_stats LIMIT 1").fetchall()
+            except:
+                return  # Already shared
+            try:
+                self._execute("ALTER TABLE profile_stats RENAME TO profile_stats_owners")
+            except:
+                return  # Another head is upgrading it
+            print("*** Updating profile_stats table")
+            self._execute(profilestats.STATS_SQL)
+
+        stats = {}
+
+        def add(key, s):
+            if key not in stats:
+                stats[key] = profilestats.ProfileStats()
+            stats[key].merge(s)
+
+        if existed:
+            c = self._execute("SELECT module, priority, size_bucket, stats FROM profile_stats_owners")
+            for module, priority, bucket, s in c.fetchall():
+                add((module, priority, bucket), profilestats.ProfileStats.from_json(s))
+
+        c = self._execute("SELECT module, priority, datasize, runs, errors, timeouts, cancelled, " +
+                          "waittime, processtime, totaltime, cpu_time FROM profile_summary")
+        for row in c.fetchall():
+            priority = int(round(row[1])) if row[1] is not None else -1
+            add((row[0], priority, profilestats.size_bucket(row[2])), profilestats.ProfileStats.from_summary(
+                row[3], row[4], row[5], row[6],
+                {"waittime": row[7], "processtime": row[8], "totaltime": row[9], "cpu_time": row[10]}))
+
+        for key in stats:
+            self._merge_profile_stats(key, stats[key])
+        if existed:
+            self._execute("DROP TABLE profile_stats_owners")
+
+    def _prune_profile_stats(self):
+        self._execute("DELETE FROM profile_stats WHERE updated<%s", [time.time() - PROFILE_STATS_MAX_AGE])
+
+    def _summarize(self, stats):
+        """
+        Estimates from merged statistics, empty if nothing has completed
+        """
+        if stats.stats["totaltime"].n == 0:
+            return {}
+        retval = {"runs": stats.runs, "errors": stats.errors, "timeouts": stats.timeouts,
+                  "cancelled": stats.cancelled}
+        for f in ["waittime", "processtime", "totaltime", "cpu_time"]:
+            retval[f] = stats.stats[f].mean if stats.stats[f].n else None
+        for f in ["processtime", "totaltime"]:
+            retval[f + "_std"] = stats.stats[f].std()
+            retval[f + "_p50"] = stats.stats[f].quantile(0.5)
+            retval[f + "_p95"] = stats.stats[f].quantile(0.95)
+        retval["memory_max_p95"] = stats.stats["memory_max"].quantile(0.95) if stats.stats["memory_max"].n else None
+        return retval
 
     def summarize_profiles(self):
-        print("Summarizing")
-        SQL = "SELECT module,NOW(),COUNT(*)"
-        avgs = ["datasize", "waittime", "processtime", "totaltime", "cpu_time", "priority"]
-        sums = ["errors", "timeouts", "cancelled"]
-        mins = []
-        maxes = []
-
-        for a in avgs:
-            SQL += ",AVG(%s)" % a
-        for a in sums:
-            SQL += ",SUM(%s)" % a
-        for a in mins:
-            SQL += ",MIN(%s)" % a
-        for a in maxes:
-            SQL += ",MAX(%s)" % a
-
-        NOERRS = SQL + " FROM profile WHERE state>2 AND errors=0 AND cancelled=0" +\
-                       " AND priority IS NOT NULL" +\
-                       " GROUP BY module, priority, datasize / 1073741824"
-        self._execute("INSERT INTO profile_summary " + NOERRS)
-
-        ERRS = SQL + " FROM profile WHERE state>2 AND errors>0 AND cancelled>0" +\
-                     " AND priority IS NOT NULL" +\
-                     " GROUP BY module, priority, datasize / 1073741824"
-        self._execute("INSERT INTO profile_summary " + ERRS)
-
-        # Cleanup
-        self._execute("DELETE FROM profile WHERE state>2")
+        """
+        Statistics are kept as profiles finish, this only writes ours now
+        """
+        self._commit_profile_stats()
 
     def get_profiles(self):
-        SQL = "SELECT module, AVG(waittime), AVG(processtime), AVG(totaltime), AVG(cpu_time) " + \
-              "FROM profile_summary GROUP BY module"
-        c = self._execute(SQL)
+        modules = {}
+        for (module, priority, bucket), s in self._get_profile_stats().items():
+            if module not in modules:
+                modules[module] = profilestats.ProfileStats()
+            modules[module].merge(s)
         retval = {}
-        for row in c.fetchall():
-            retval[row[0]] = {
-                "waittime": row[1],
-                "processtime": row[2],
-                "totaltime": row[3],
-                "cpu_time": row[4]
-            }
+        for module in modules:
+            summary = self._summarize(modules[module])
+            if summary:
+                retval[module] = summary
         return retval
 
     def estimate_resources(self, module, datasize=None, priority=None):
-
-        c = self._execute("SELECT MAX(time) FROM profile_summary")
-        maxtime = c.fetchone()
-        if not maxtime or maxtime[0] is None:
-            self.summarize_profiles()
-        elif time.time() - maxtime[0].timestamp() > 24*3600:
-            self.summarize_profiles()
-        args = [module]
-        SQL = "SELECT AVG(waittime), AVG(processtime), AVG(totaltime), AVG(cpu_time), " + \
-              "AVG(waittime) FROM profile_summary WHERE module=%s AND "
-        if datasize or priority:
-            if datasize:
-                SQL += "datasize=%s AND "
-                args.append(datasize)
-            if priority:
-                SQL += "priority<=%s AND "
-                args.append(priority)
-        SQL = SQL[:-4] + "GROUP BY module"
-        c = self._execute(SQL, args)
-        retval = {}
-        for row in c.fetchall():
-            retval["waittime"] = row[0]
-            retval["processtime"] = row[1]
-            retval["totaltime"] = row[2]
-            retval["cpu_time"] = row[3]
+        """
+        Average, spread and percentiles of the times of completed jobs of a
+        module, with priority up to the given one and of the given datasize.
+        Estimates are reused for ESTIMATE_CACHE_TIME seconds
+        """
+        key = (module, profilestats.size_bucket(datasize) if datasize else None, priority)
+        cached = self._estimates.get(key)
+        if cached and time.time() - cached[0] < ESTIMATE_CACHE_TIME:
+            return cached[1]
+
+        total = profilestats.ProfileStats()
+        for (m, p, bucket), s in self._get_profile_stats(module).items():
+            if datasize and bucket != profilestats.size_bucket(datasize):
+                continue
+            if priority and p > priority:
+                continue
+            total.merge(s)
+        retval = self._summarize(total)
+        self._estimates[key] = (time.time(), retval)
         return retval
 
-    def update_worker(self, workerid, modules, last_job):
-        SQL = "INSERT INTO worker (id, modules, last_job, last_seen) VALUES(%s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE modules=%s, last_job=%s, last_seen=NOW()"
-        self._execute(SQL, [workerid, modules, last_job, modules, last_job])
+    def update_node(self, node, slots, memory, scratch, modules=None):
+        """
+        Heartbeat of a worker node. slots is a map of worker type to (workers,
+        free workers), memory and scratch are available bytes. modules is a
+        map of worker type to supported modules, give it when it has changed
+        """
+        self._registry.heartbeat(node, slots, memory, scratch, modules)
 
-    def remove_worker(self, workerid):
-        self._execute("DELETE FROM worker WHERE id=%s", [workerid])
+    def remove_node(self, node):
+        self._registry.remove(node)
+
+    def get_nodes(self, seen_since_sec=120):
+        """
+        The nodes seen within seen_since_sec seconds, see
+        noderegistry.NodeRegistry.get_nodes()
+        """
+        return self._registry.get_nodes(seen_since_sec)
 
     def get_admin_worker_nodes(self):
         c = self._execute("SELECT DISTINCT(node) FROM jobs WHERE type=%s", [TYPE_ADMIN])
@@ -769,34 +1701,390 @@ class JobDB(mysql):
         """
         Return a list of all nodes that have workers
         """
-        SQL = "SELECT id, last_seen FROM worker WHERE last_seen> NOW() - INTERVAL %d second" % seen_since_sec
-        c = self._execute(SQL)
-        res = []
-        for id, last_seen in c.fetchall():
-            t, n = id.split("-", 1)
-            n = n[:n.find("_")]
-            if adminsOnly and t != "AdminWorker":
-                continue
-            if n not in res:
-                res.append(n)
-        return res
+        nodes = self._registry.get_nodes(seen_since_sec)
+        return sorted([n for n in nodes if not adminsOnly or nodes[n]["types"].get(TYPE_ADMIN, {}).get("slots")])
 
     def get_workers(self, modules):
         """
-        Get a map of modules and workers. If no worker is available for a module, it will have a blank list
+        Get a map of modules and the nodes with workers for them. If no node
+        is available for a module, it will have a blank list
         """
+        return {m: self._registry.get_module_nodes(m) for m in modules}
 
-        SQL = "SELECT id, modules, last_job, last_seen FROM worker WHERE last_seen> NOW() - INTERVAL 1 MINUTE"
-        c = self._execute(SQL)
 
-        retval = {}
-        for m in modules:
-            retval[m] = []
-        for id, modules, last_job, last_seen in c.fetchall():
-            for m in json.loads(modules):
-                if m in retval:
-                    retval[m].append(id)
-        return retval
+class JobDB(JobDBBase, PooledDB, mysql):
+
+    _TSCHANGE_SECONDS = "UNIX_TIMESTAMP(tschange)"
+    _BLOB_UPSERT = argstore.UPSERT_MYSQL
+    _STATS_UPSERT = profilestats.UPSERT_MYSQL
+    _NODE_UPSERT = noderegistry.UPSERT_MYSQL
+    _SLOTS_UPSERT = SLOTS_UPSERT_MYSQL
+    _NOW_SECONDS = "UNIX_TIMESTAMP(NOW(6))"
+
+    def __init__(self, runname, module, steps=1, auto_cleanup=True):
+        mysql.__init__(self, "JobDB", db_name="JobDB")
+        self._init_pool("CryoCloud.JobDB", db_name="JobDB")
+        JobDBBase.__init__(self, runname, module)
+
+        if not runname and not module:
+            return  # Is a worker, can only allocate/update jobs
+
+        # Add owner, comments, dates etc to run
+        statements = [
+            """CREATE TABLE IF NOT EXISTS runs (
+                runid INT PRIMARY KEY AUTO_INCREMENT,
+                runname VARCHAR(128) UNIQUE,
+                module VARCHAR(256),
+                steps INT DEFAULT 1,
+                weight DOUBLE DEFAULT 1
+            )""",
+            """CREATE TABLE IF NOT EXISTS jobs (
+                    jobid BIGINT PRIMARY KEY AUTO_INCREMENT,
+                    runid INT NOT NULL,
+                    step INT DEFAULT 0,
+                    taskid INT DEFAULT 0,
+                    type TINYINT,
+                    priority INT DEFAULT 50,
+                    state TINYINT,
+                    tsadded DOUBLE,
+                    tsallocated DOUBLE DEFAULT NULL,
+                    expiretime INT,
+                    node VARCHAR(128) DEFAULT NULL,
+                    worker INT UNSIGNED DEFAULT NULL,
+                    retval MEDIUMBLOB DEFAULT NULL,
+                    module VARCHAR(256) DEFAULT NULL,
+                    modulepath TEXT DEFAULT NULL,
+                    workdir TEXT DEFAULT NULL,
+                    args MEDIUMBLOB DEFAULT NULL,
+                    nonce INT DEFAULT 0,
+                    itemid BIGINT DEFAULT 0,
+                    max_memory BIGINT UNSIGNED DEFAULT 0,
+                    cpu_time FLOAT DEFAULT 0,
+                    is_blocked TINYINT DEFAULT 0,
+                    tschange TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+                    prefer_nodes VARCHAR(1024) DEFAULT NULL,
+                    local_until DOUBLE DEFAULT NULL,
+                    lease_until DOUBLE DEFAULT NULL,
+                    req_cpus INT DEFAULT 1,
+                    req_memory INT DEFAULT 0,
+                    req_scratch INT DEFAULT 0,
+                    retries INT DEFAULT 0,
+                    max_retries INT DEFAULT 0,
+                    not_before DOUBLE DEFAULT NULL,
+                    slot TINYINT DEFAULT 0
+            )""",
+            "CREATE TABLE IF NOT EXISTS jobs_history LIKE jobs",
+            """CREATE TABLE IF NOT EXISTS job_events (
+                seq BIGINT PRIMARY KEY AUTO_INCREMENT,
+                runid INT NOT NULL,
+                jobid BIGINT NOT NULL,
+                state TINYINT,
+                ts TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+            )""",
+            """CREATE TABLE IF NOT EXISTS filewatch (
+                fileid INT PRIMARY KEY AUTO_INCREMENT,
+                rootpath VARCHAR(256) NOT NULL,
+                relpath VARCHAR(256) NOT NULL,
+                mtime DOUBLE NOT NULL,
+                stable BOOL DEFAULT 0,
+                public BOOL DEFAULT 0,
+                done BOOL DEFAULT 0,
+                runname VARCHAR(128),
+                tschange TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )""",
+            """CREATE TABLE IF NOT EXISTS profile (
+                itemid BIGINT UNSIGNED,
+                module VARCHAR(128),
+                product VARCHAR(128),
+                addtime DOUBLE,
+                waittime FLOAT DEFAULT 0,
+                processtime FLOAT DEFAULT 0,
+                totaltime FLOAT DEFAULT 0,
+                errors TINYINT DEFAULT 0,
+                timeouts TINYINT DEFAULT 0,
+                cancelled TINYINT DEFAULT 0,
+                state TINYINT DEFAULT 1,
+                worker SMALLINT DEFAULT NULL,
+                node VARCHAR(128) DEFAULT NULL,
+                type TINYINT DEFAULT 1,
+                priority TINYINT DEFAULT -1,
+                datasize BIGINT UNSIGNED DEFAULT 0,
+                memory_max BIGINT UNSIGNED DEFAULT 0,
+                cpu_time FLOAT DEFAULT 0,
+                PRIMARY KEY (itemid, module)
+            )""",
+            """CREATE TABLE IF NOT EXISTS profile_summary (
+                module VARCHAR(128),
+                time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                runs INT,
+                datasize BIGINT UNSIGNED DEFAULT NULL,
+                waittime FLOAT,
+                processtime FLOAT,
+                totaltime FLOAT,
+                cpu_time FLOAT,
+                priority FLOAT,
+                errors INT,
+                timeouts INT,
+                cancelled INT,
+                PRIMARY KEY(module, priority, time)
+            )""",
+            noderegistry.NODES_SQL,
+            noderegistry.MODULES_SQL,
+            profilestats.STATS_SQL,
+            DEPS_SQL,
+            STEP_SLOTS_SQL,
+            argstore.BLOBS_SQL,
+            "CREATE INDEX job_blobs_used ON job_blobs(last_used)",
+            "CREATE INDEX job_state ON jobs(state)",
+            "CREATE INDEX job_type ON jobs(type)",
+            "CREATE INDEX job_claim ON jobs(state, type, is_blocked, node, priority, tsadded)",
+            "CREATE INDEX job_module_prio ON jobs(state, module, priority)",
+            "CREATE INDEX job_run_prio ON jobs(state, runid, priority)",
+            "CREATE INDEX job_allocated ON jobs(tsallocated)",
+            "CREATE INDEX job_lease ON jobs(state, lease_until)",
+            "CREATE INDEX job_retry ON jobs(is_blocked, not_before)",
+            "CREATE INDEX job_step_slot ON jobs(runid, step, is_blocked)",
+            "CREATE INDEX job_nonce ON jobs(nonce)",
+            "CREATE INDEX job_finished ON jobs(state, tschange)",
+            "CREATE INDEX job_run_task ON jobs(runid, taskid)",
+            "CREATE INDEX job_history_task ON jobs_history(runid, taskid)",
+            "CREATE INDEX job_deps_task ON job_deps(runid, taskid)",
+            "CREATE INDEX job_history_ts ON jobs_history(tschange)",
+            "CREATE INDEX job_history_added ON jobs_history(tsadded)",
+            "CREATE INDEX profile_module ON profile_summary(module)",
+            "CREATE INDEX job_events_run ON job_events(runid, seq)",
+            "CREATE INDEX job_events_ts ON job_events(ts)",
+            "CREATE INDEX worker_nodes_seen ON worker_nodes(last_seen)",
+            ALLOCATE_SQL,
+            ARCHIVE_SQL
+        ]
+        statements.extend(["DROP TRIGGER IF EXISTS %s" % t for t in OLD_EVENT_TRIGGERS])
+        statements.extend(EVENT_SQLS)
+
+        # Minor upgrade-hack
+        try:
+            c = self._execute("SELECT min(cpu_time) FROM jobs LIMIT 1")
+            c.fetchall()
+            c = self._execute("SELECT min(is_blocked) FROM jobs LIMIT 1")
+            c.fetchall()
+        except:
+            try:
+                print("*** Job table is bad, dropping it")
+                self._execute("DROP TABLE jobs")
+            except:
+                pass
+
+        try:
+            c = self._execute("SELECT runname FROM filewatch LIMIT 1")
+            c.fetchall()
+        except:
+            try:
+                print("*** Filewatch is bad")
+                self._execute("ALTER TABLE filewatch DROP COLUMN runid")
+                self._execute("ALTER TABLE filewatch ADD runname VARCHAR(128) DEFAULT NULL")
+            except:
+                pass
+
+        stats_existed = self._has_profile_stats()
+        self._init_sqls(statements)
+        self._upgrade_profile_stats(stats_existed)
+
+        try:
+            c = self._execute("SELECT itemid FROM jobs WHERE jobid=0")
+            c.fetchone()
+        except:
+            # Old table, upgrade it
+            print("*** Updating jobdb table")
+            self._execute("ALTER TABLE jobs ADD (itemid BIGINT DEFAULT 0)")
+
+        try:
+            c = self._execute("SELECT prefer_nodes FROM jobs LIMIT 1")
+            c.fetchall()
+        except:
+            print("*** Updating jobs table for locality")
+            for table in ["jobs", "jobs_history"]:
+                self._execute("ALTER TABLE %s ADD (prefer_nodes VARCHAR(1024) DEFAULT NULL, local_until DOUBLE DEFAULT NULL)" % table)
+
+        try:
+            c = self._execute("SELECT lease_until FROM jobs LIMIT 1")
+            c.fetchall()
+        except:
+            print("*** Updating jobs table for leases")
+            for table in ["jobs", "jobs_history"]:
+                self._execute("ALTER TABLE %s MODIFY expiretime INT, ADD (lease_until DOUBLE DEFAULT NULL)" % table)
+            self._execute("UPDATE jobs SET lease_until=tsallocated + expiretime WHERE state=%s", [STATE_ALLOCATED])
+            self._execute("CREATE INDEX job_lease ON jobs(state, lease_until)")
+
+        try:
+            c = self._execute("SELECT req_cpus FROM jobs LIMIT 1")
+            c.fetchall()
+        except:
+            print("*** Updating jobs table for resource requests")
+            for table in ["jobs", "jobs_history"]:
+                self._execute("ALTER TABLE %s ADD (req_cpus INT DEFAULT 1, req_memory INT DEFAULT 0, req_scratch INT DEFAULT 0)" % table)
+
+        try:
+            c = self._execute("SELECT not_before FROM jobs LIMIT 1")
+            c.fetchall()
+        except:
+            print("*** Updating jobs table for retries")
+            for table in ["jobs", "jobs_history"]:
+                self._execute("ALTER TABLE %s ADD (retries INT DEFAULT 0, max_retries INT DEFAULT 0, not_before DOUBLE DEFAULT NULL)" % table)
+            self._execute("CREATE INDEX job_retry ON jobs(is_blocked, not_before)")
+
+        try:
+            c = self._execute("SELECT slot FROM jobs LIMIT 1")
+            c.fetchall()
+        except:
+            print("*** Updating jobs table for max_parallel")
+            for table in ["jobs", "jobs_history"]:
+                self._execute("ALTER TABLE %s ADD (slot TINYINT DEFAULT 0)" % table)
+            self._execute("CREATE INDEX job_step_slot ON jobs(runid, step, is_blocked)")
+
+        try:
+            c = self._execute("SELECT weight FROM runs LIMIT 1")
+            c.fetchall()
+        except:
+            print("*** Updating runs table")
+            self._execute("ALTER TABLE runs ADD (weight DOUBLE DEFAULT 1)")
+
+        self._create_run(module, steps)
+        self._start_cleanup(auto_cleanup)
+
+    def _claim(self, args):
+        """
+        A single call to the allocate procedure, which picks jobs using
+        SELECT ... FOR UPDATE SKIP LOCKED and marks them as allocated in one
+        transaction, returning the allocated jobs.
+        """
+        SQL = "CALL " + ALLOCATE_PROCEDURE + "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+        rows = None
+        ex = None
+        for i in range(0, 3):
+            try:
+                c = self._execute(SQL, args)
+                rows = c.fetchall()
+                break
+            except Exception as e:
+                ex = e
+                self.log.exception("Failed to get job, retrying")
+                self.log.error("SQL statement was: '%s' with args '%s" % (SQL, args))
+        if rows is None:
+            if ex:
+                raise ex
+            raise Exception("Failed to get job")
+        return rows
+
+    def _unblock(self, step, amount):
+        c = self._execute("UPDATE jobs SET is_blocked=0 WHERE runid=%s AND step=%s AND is_blocked=1 LIMIT %s",
+                          [self._runid, step, amount])
+        return c.rowcount
+
+    def _get_update_rows(self, cursor, max_updates):
+        SQL = "(SELECT job_events.seq, job_events.state, " + self._JOB_COLUMNS +\
+              " FROM job_events JOIN jobs USING (jobid) WHERE job_events.runid=%s AND job_events.seq>%s" +\
+              " ORDER BY job_events.seq LIMIT %s) UNION ALL " +\
+              "(SELECT job_events.seq, job_events.state, " + self._HISTORY_COLUMNS +\
+              " FROM job_events JOIN jobs_history USING (jobid) WHERE job_events.runid=%s AND job_events.seq>%s" +\
+              " ORDER BY job_events.seq LIMIT %s) ORDER BY seq LIMIT %s"
+        c = self._execute(SQL, [self._runid, cursor, max_updates, self._runid, cursor, max_updates, max_updates])
+        return c.fetchall()
+
+    def _update_batch(self, batch):
+        SQL = "UPDATE jobs JOIN ("
+        args = []
+        for u in batch:
+            SQL += "SELECT %s AS jobid, %s AS state, %s AS retval, %s AS cpu_time, %s AS max_memory, " +\
+                   "%s AS worker, %s AS node UNION ALL "
+            retval = self._argstore.pack(u["retval"], share=False) if u.get("retval") else None
+            holder = u.get("holder") or (None, None)
+            args.extend([u["id"], u["state"], retval, u.get("cpu") or None, u.get("memory") or None,
+                         holder[0], holder[1]])
+        SQL = SQL[:-len(" UNION ALL ")] + ") AS u USING (jobid) SET jobs.state=u.state, " +\
+            "jobs.retval=IFNULL(u.retval, jobs.retval), jobs.cpu_time=IFNULL(u.cpu_time, jobs.cpu_time), " +\
+            "jobs.max_memory=IFNULL(u.max_memory, jobs.max_memory) WHERE (jobs.state<>%s OR u.state=%s) AND " +\
+            "(u.worker IS NULL OR (jobs.state=%s AND jobs.worker=u.worker AND jobs.node=u.node))"
+        args.extend([STATE_CANCELLED, STATE_CANCELLED, STATE_ALLOCATED])
+        self._execute(SQL, args)
+
+    def _commit_profiles(self, profiles):
+        for batch in self._batches(profiles, lambda p: (p[1], p[2]), lambda p: p[0]):
+            args = []
+            if batch[0][0] == "insert":
+                SQL = "INSERT IGNORE INTO profile (itemid, module, product, addtime, datasize, priority, type) VALUES "
+                SQL += ",".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+                for p in batch:
+                    args.extend(p[1:])
+                self._execute(SQL, args)
+                continue
+
+            SQL = "UPDATE profile JOIN ("
+            for p in batch:
+                SQL += "SELECT %s AS itemid, %s AS module, %s AS state, %s AS ts, %s AS worker, %s AS node, " +\
+                       "%s AS memory_max, %s AS cpu_time UNION ALL "
+                args.extend(p[1:])
+            SQL = SQL[:-len(" UNION ALL ")] + ") AS u USING (itemid, module) SET " + PROFILE_UPDATE_SET
+            self._execute(SQL, args)
+
+    def archive_jobs(self, age=None):
+        """
+        Move done, expired, failed or cancelled jobs that finished more than
+        age (default archive_after) seconds ago to jobs_history, archive_batch
+        jobs pr transaction. Returns the number of jobs moved
+        """
+        if age is None:
+            age = self._archive_cfg["archive_after"]
+        batch = int(self._archive_cfg["archive_batch"])
+        moved = 0
+        while not API.api_stop_event.is_set():
+            c = self._execute("CALL " + ARCHIVE_PROCEDURE + "(%s, %s)",
+                              [int(age), batch])
+            num = c.fetchall()[0][0]
+            moved += num
+            if num < batch:
+                break
+        return moved
+
+    def _delete_batched(self, SQL, args):
+        """
+        Run a DELETE with a LIMIT of archive_batch until nothing more is removed
+        """
+        batch = int(self._archive_cfg["archive_batch"])
+        while not API.api_stop_event.is_set():
+            c = self._execute(SQL + " LIMIT %s", args + [batch])
+            if c.rowcount < batch:
+                break
+
+    def cleanup(self):
+        """
+        Archive finished jobs, and remove history, change log, finished
+        profiles and shared args that are past their retention, and
+        dependencies of archived jobs
+        """
+        self.archive_jobs()
+        self._delete_batched("DELETE FROM jobs_history WHERE tschange < NOW() - INTERVAL %s SECOND",
+                             [int(self._archive_cfg["history_retention"])])
+        self._delete_batched("DELETE FROM job_events WHERE ts < NOW() - INTERVAL 1 hour", [])
+        self._delete_batched("DELETE FROM profile WHERE state>%s AND addtime<%s",
+                             [STATE_ALLOCATED, time.time() - float(self._archive_cfg["history_retention"])])
+        self._delete_batched("DELETE FROM job_deps WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE " +
+                             "jobs.runid=job_deps.runid AND jobs.taskid=job_deps.taskid)", [])
+        self._prune_profile_stats()
+        self._registry.cleanup()
+        self._cleanup_args()
+
+
+def get_jobdb(runname, module, steps=1, auto_cleanup=True):
+    """
+    Open the job db backend configured as CryoCloud.JobDB.backend, either
+    "mysql" (default) or "sqlite" (see jobdb_sqlite)
+    """
+    cfg = API.get_config("CryoCloud.JobDB")
+    cfg.set_default("backend", "mysql")
+    if cfg["backend"] == "sqlite":
+        from CryoCloud.Common import jobdb_sqlite
+        return jobdb_sqlite.JobDB(runname, module, steps=steps, auto_cleanup=auto_cleanup)
+    return JobDB(runname, module, steps=steps, auto_cleanup=auto_cleanup)
 
 if __name__ == "__main__":
     try:
@@ -4,7 +4,11 @@ import random
 import json
 import threading
 import copy
+import heapq
+import itertools
+import collections
 from CryoCore import API
+from CryoCloud.Common.jobdb import fill_retvals, LEASE_TIME, MAX_RETRIES, RETRY_DELAY, RETRY_MAX_DELAY, PARENT_ENDED
 
 PRI_HIGH = 100
 PRI_NORMAL = 50
@@ -22,6 +26,11 @@ STATE_FAILED = 4
 STATE_TIMEOUT = 5
 STATE_CANCELLED = 6
 
+BLOCKED_DEPENDS = 2
+BLOCKED_GANG = 3
+BLOCKED_RETRY = 4
+BLOCKED_PARALLEL = 5
+
 JOBID = 0
 RUNID = 1
 STEP = 2
@@ -42,6 +51,11 @@ TSALLOCATED = 16
 RETVAL = 17
 TSCHANGE = 18
 RUNTIME = 19
+LEASE = 20
+RETRIES = 21
+RETRY_LIMIT = 22
+SLOT = 23
+HOLDER = 24
 
 
 TASK_TYPE = {
@@ -59,6 +73,19 @@ PRI_STRING = {
 
 
 class JobDB:
+    """
+    In-memory job queue with the JobDB interface, used for standalone runs.
+
+    Jobs are indexed so that no operation needs to scan all jobs: pending jobs
+    are in a heap pr (type, module) ordered by priority and age, blocked jobs
+    in a set pr step, failed jobs waiting to be retried in a heap by when they
+    are due, and jobs are looked up by jobid or taskid. Steps with max_parallel
+    count the jobs holding a slot, and hand freed slots on right away. Heap entries
+    are not removed when a job is cancelled, blocked or changed, they are
+    skipped when they come to the top instead. Priorities do not age (see
+    jobdb.AGING_INTERVAL), a heap can't be ordered by something that changes
+    with time, and there are no profile statistics.
+    """
 
     def __init__(self, runname, module, steps=1, auto_cleanup=True):
         self._runname = random.randint(0, 2147483647)  # Just ignore the runname for now
@@ -72,8 +99,27 @@ class JobDB:
         self._taskid = 1
         self._runid = 0
         self._lock = threading.Lock()
-        self._jobs = []
         self._jobid = 0
+        self._jobs_available = threading.Condition(self._lock)
+
+        self._jobs = {}  # jobid -> job
+        self._by_taskid = {}  # taskid -> {jobid: job}
+        self._pending = {}  # (type, module) -> heap of (-priority, tsadded, jobid)
+        self._blocked = {}  # step -> {jobid: job}, in the order they were added
+        self._retrying = []  # heap of (not_before, jobid) of failed jobs waiting to be retried
+        self._slots = {}  # step -> [max_parallel, jobs holding a slot that are not finished]
+        self._changed = collections.OrderedDict()  # jobid -> job, least recently changed first
+        self._allocated = {}  # jobid -> job
+        self._num_active = 0  # Pending or allocated
+        self._waiting = {}  # jobid -> (taskids of parents not completed, all parent taskids)
+        self._dependents = {}  # parent taskid -> {jobid: job}
+        self.lease_time = LEASE_TIME
+        self.retry_delay = RETRY_DELAY
+        self.retry_max_delay = RETRY_MAX_DELAY
+
+        # Change log of (seq, job, state), see get_updates()
+        self._events = collections.deque()
+        self._seq = 0
 
         self._cleanup_thread = None
         if auto_cleanup:
@@ -83,8 +129,8 @@ class JobDB:
 
     def __del__(self):
         try:
-            if self._cleanup_timer:
-                self._cleanup_timer.cancel()
+            if self._cleanup_thread:
+                self._cleanup_thread.cancel()
         except:
             pass
 
@@ -99,50 +145,239 @@ class JobDB:
 
     def add_job(self, step, taskid, args, jobtype=TYPE_NORMAL, priority=PRI_NORMAL, node=None,
                 expire_time=3600, module=None, modulepath=None, workdir=None, itemid=None,
-                multiple=True, isblocked=False):
-
+                multiple=True, isblocked=False, prefer_nodes=None, depends=None, resources=None,
+                max_retries=None):
+        """
+        There is only one node, so prefer_nodes and resources are ignored. Jobs with depends
+        wait for those tasks to complete, and are removed if one of them is
+        (see jobdb.JobDB.add_job())
+        """
         if not module and not self._module:
             raise Exception("Missing module for job, and no default module!")
 
         if taskid is None:
             taskid = self._taskid
             self._taskid += 1
-        self._jobid += 1
-        self._runid += 1
+        now = time.time()
         with self._lock:
-            self._jobs.append(
-                      [self._jobid, self._runid, step, taskid, jobtype, priority,
-                       STATE_PENDING, time.time(), expire_time, node, copy.deepcopy(args),
-                       module, modulepath, workdir, itemid, isblocked,
-                       0, 0, time.time(), 0])
+            self._jobid += 1
+            self._runid += 1
+            # Only the top level is copied, big values are usually shared between jobs anyway
+            job = [self._jobid, self._runid, step, taskid, jobtype, priority,
+                   STATE_PENDING, now, expire_time, node, copy.copy(args),
+                   module, modulepath, workdir, itemid, isblocked,
+                   0, 0, now, 0, None, 0, MAX_RETRIES if max_retries is None else max_retries, False, None]
+            self._jobs[job[JOBID]] = job
+            self._by_taskid.setdefault(taskid, {})[job[JOBID]] = job
+            self._changed[job[JOBID]] = job
+            self._num_active += 1
+            waiting = set()
+            for parent in set(depends or []):
+                # Parents that are not known (yet) keep it waiting too
+                parents = self._by_taskid.get(parent, {}).values()
+                if not parents or any([p[STATE] != STATE_COMPLETED for p in parents]):
+                    waiting.add(parent)
+            if waiting:
+                job[ISBLOCKED] = BLOCKED_DEPENDS
+                self._waiting[job[JOBID]] = (waiting, list(set(depends)))
+                for parent in waiting:
+                    self._dependents.setdefault(parent, {})[job[JOBID]] = job
+            else:
+                if depends:
+                    job[ARGS] = fill_retvals(job[ARGS], self._retvals(depends))
+                if isblocked:
+                    self._blocked.setdefault(step, {})[job[JOBID]] = job
+                    if isblocked == BLOCKED_PARALLEL:
+                        self._grant_slots(step)
+                else:
+                    self._push(job)
+                    self._jobs_available.notify_all()
         # print(" -> Added job", self._jobid)
         return taskid
 
+    def _push(self, job):
+        """
+        Make a pending job available for allocation. Must hold the lock
+        """
+        heapq.heappush(self._pending.setdefault((job[JOBTYPE], job[MODULE]), []),
+                       (-job[PRIORITY], job[TS], job[JOBID]))
+
+    def _is_ready(self, entry):
+        """
+        Is a heap entry still a valid pending job. Must hold the lock
+        """
+        job = self._jobs.get(entry[2])
+        return job is not None and job[STATE] == STATE_PENDING and not job[ISBLOCKED] and \
+            -job[PRIORITY] == entry[0]
+
+    def _peek(self, key):
+        """
+        The first valid entry of a heap, dropping stale ones. Must hold the lock
+        """
+        heap = self._pending.get(key)
+        while heap and not self._is_ready(heap[0]):
+            heapq.heappop(heap)
+        if not heap:
+            self._pending.pop(key, None)
+            return None
+        return heap[0]
+
+    def _touch(self, job, state=None):
+        """
+        Mark a job as changed and log a state change. Must hold the lock
+        """
+        job[TSCHANGE] = time.time()
+        self._changed.move_to_end(job[JOBID])
+        if state is not None and state != job[STATE]:
+            if job[STATE] <= STATE_ALLOCATED and state > STATE_ALLOCATED:
+                self._num_active -= 1
+                if job[SLOT]:
+                    self._slots[job[STEP]][1] -= 1
+                    self._grant_slots(job[STEP])
+            elif job[STATE] > STATE_ALLOCATED and state <= STATE_ALLOCATED:
+                self._num_active += 1
+                if job[SLOT]:
+                    self._slots[job[STEP]][1] += 1
+            job[STATE] = state
+            self._log_event(job)
+            if state == STATE_ALLOCATED:
+                self._allocated[job[JOBID]] = job
+            else:
+                self._allocated.pop(job[JOBID], None)
+            if state == STATE_PENDING and not job[ISBLOCKED]:
+                self._push(job)
+            if state == STATE_COMPLETED and job[TASKID] in self._dependents:
+                self._resolve(job)
+            elif state in (STATE_FAILED, STATE_TIMEOUT) and job[TASKID] in self._dependents:
+                self._fail_dependents(job)
+
+    def _retvals(self, taskids):
+        """
+        Retvals of completed tasks. Must hold the lock
+        """
+        retvals = {}
+        for taskid in taskids:
+            for job in self._by_taskid.get(taskid, {}).values():
+                if job[STATE] == STATE_COMPLETED:
+                    retvals[taskid] = job[RETVAL]
+        return retvals
+
+    def _resolve(self, parent):
+        """
+        A job has completed, release the jobs that were only waiting for it.
+        Must hold the lock
+        """
+        for job in list(self._dependents.pop(parent[TASKID], {}).values()):
+            waiting, parents = self._waiting[job[JOBID]]
+            waiting.discard(parent[TASKID])
+            if waiting:
+                continue
+            del self._waiting[job[JOBID]]
+            job[ARGS] = fill_retvals(job[ARGS], self._retvals(parents))
+            job[ISBLOCKED] = False
+            if job[STATE] == STATE_PENDING:
+                self._push(job)
+                self._jobs_available.notify_all()
+
+    def _fail_dependents(self, parent):
+        """
+        A job failed or timed out, the jobs waiting for it fail too. Must hold
+        the lock
+        """
+        error = {"error": "Parent task %s %s" % (parent[TASKID], PARENT_ENDED[parent[STATE]])}
+        for job in list(self._dependents.pop(parent[TASKID], {}).values()):
+            waiting, parents = self._waiting.pop(job[JOBID])
+            for p in waiting:
+                self._dependents.get(p, {}).pop(job[JOBID], None)
+            job[RETVAL] = error
+            self._touch(job, STATE_FAILED)
+
+    def _unindex_blocked(self, job):
+        """
+        Must hold the lock
+        """
+        blocked = self._blocked.get(job[STEP])
+        if blocked:
+            blocked.pop(job[JOBID], None)
+            if not blocked:
+                del self._blocked[job[STEP]]
+
+    def _unblock(self, job):
+        """
+        Must hold the lock
+        """
+        self._unindex_blocked(job)
+        job[ISBLOCKED] = False
+        if job[STATE] == STATE_PENDING:
+            self._push(job)
+
     def unblock_jobid(self, jobid):
         retval = 0
         with self._lock:
-            for job in self._jobs:
-                if job[JOBID] == jobid:
-                    if job[ISBLOCKED]:
-                        retval = 1
-                    job[ISBLOCKED] = False
+            job = self._jobs.get(jobid)
+            if job and job[ISBLOCKED]:
+                self._unblock(job)
+                retval = 1
+                self._jobs_available.notify_all()
         return retval
 
-    def unblock_step(self, step, amount=1, max_parallel=None):
-        if max_parallel:
-            amount = max_parallel
-
+    def release_gang(self, taskids):
         retval = 0
         with self._lock:
-            for job in self._jobs:
-                if job[STEP] == step:
-                    if job[ISBLOCKED]:
+            for taskid in taskids:
+                for job in list(self._by_taskid.get(taskid, {}).values()):
+                    if job[ISBLOCKED] == BLOCKED_GANG:
+                        self._unblock(job)
                         retval += 1
-                    job[ISBLOCKED] = False
-                if retval >= amount:
-                    break
+            if retval:
+                self._jobs_available.notify_all()
         return retval
 
+    def set_max_parallel(self, step, max_parallel):
+        """
+        Limit how many jobs of a step added with isblocked=BLOCKED_PARALLEL
+        can be pending with a slot or allocated at the same time, see
+        jobdb.JobDB.set_max_parallel()
+        """
+        with self._lock:
+            self._slots.setdefault(step, [0, 0])[0] = max_parallel
+            self._grant_slots(step)
+
+    def _grant_slots(self, step):
+        """
+        Give the free slots of a step to the jobs waiting for them, in the
+        order they were added. Must hold the lock
+        """
+        slots = self._slots.get(step)
+        if not slots or slots[1] >= slots[0]:
+            return
+        waiting = (job for job in self._blocked.get(step, {}).values() if job[ISBLOCKED] == BLOCKED_PARALLEL)
+        granted = list(itertools.islice(waiting, slots[0] - slots[1]))
+        for job in granted:
+            job[SLOT] = True
+            slots[1] += 1
+            self._unblock(job)
+        if granted:
+            self._jobs_available.notify_all()
+
+    def unblock_step(self, step, amount=1):
+        retval = 0
+        with self._lock:
+            blocked = self._blocked.get(step, {})
+            for job in list(itertools.islice(blocked.values(), amount)):
+                self._unblock(job)
+                retval += 1
+            if retval:
+                self._jobs_available.notify_all()
+        return retval
+
+    def wait_for_jobs(self, timeout=None, type=None):
+        """
+        Block an idle worker until jobs are added or unblocked, or timeout
+        """
+        with self._lock:
+            return self._jobs_available.wait(2.5 if timeout is None else timeout)
+
     def flush(self):
         self.commit_jobs()
 
@@ -152,18 +387,60 @@ class JobDB:
         """
         return
 
+    def _remove(self, job):
+        """
+        Forget a job, its heap entry is dropped when it is seen. Must hold the lock
+        """
+        del self._jobs[job[JOBID]]
+        del self._changed[job[JOBID]]
+        tasks = self._by_taskid[job[TASKID]]
+        del tasks[job[JOBID]]
+        if not tasks:
+            del self._by_taskid[job[TASKID]]
+        self._allocated.pop(job[JOBID], None)
+        if job[JOBID] in self._waiting:
+            for parent in self._waiting.pop(job[JOBID])[0]:
+                self._dependents.get(parent, {}).pop(job[JOBID], None)
+        elif job[ISBLOCKED]:
+            self._unindex_blocked(job)
+        if job[STATE] <= STATE_ALLOCATED:
+            self._num_active -= 1
+            if job[SLOT]:
+                self._slots[job[STEP]][1] -= 1
+                self._grant_slots(job[STEP])
+
+        # Jobs waiting for it can't run anymore
+        if job[TASKID] not in self._by_taskid:
+            for dependent in list(self._dependents.pop(job[TASKID], {}).values()):
+                if dependent[JOBID] in self._jobs:
+                    self._remove(dependent)
+
     def cancel_job_by_taskid(self, taskid):
         with self._lock:
-            for job in self._jobs:
-                if job[TASKID] == taskid:
-                    self._jobs.remove(job)
+            for job in list(self._by_taskid.get(taskid, {}).values()):
+                self._remove(job)
 
     def cancel_job(self, jobid):
         with self._lock:
-            for job in self._jobs:
-                if job[JOBID] == jobid:
-                    self._jobs.remove(job)
-                    return
+            if jobid in self._jobs:
+                self._remove(self._jobs[jobid])
+
+    def release_jobs(self, jobids):
+        """
+        Give allocated jobs that were never started back to the pool
+        """
+        released = 0
+        with self._lock:
+            for jobid in jobids:
+                job = self._jobs.get(jobid)
+                if job and job[STATE] == STATE_ALLOCATED:
+                    job[TSALLOCATED] = 0
+                    job[LEASE] = None
+                    self._touch(job, STATE_PENDING)
+                    released += 1
+            if released:
+                self._jobs_available.notify_all()
+        return released
 
     def force_stopped(self, workerid, node):
         pass
@@ -173,32 +450,79 @@ class JobDB:
         Check that the job hasn't been updated, i.e. cancelled or removed
         """
         with self._lock:
-            for job in self._jobs:
-                if job[JOBID] == jobid:
-                    return job[STATE]
+            job = self._jobs.get(jobid)
+            if job:
+                return job[STATE]
         return None
 
     def allocate_job(self, workerid, type=TYPE_NORMAL, node=None,
                      max_jobs=1, prefermodule=None, preferlevel=0,
-                     supportedmodules=None):
+                     supportedmodules=None, budget=None):
         """
-        Preferlevel is currently 0 or over 0, nothing else does anything
+        Allocate the highest priority (then oldest) pending jobs of the given
+        type. Preferlevel is currently 0 or over 0, over 0 takes any job for
+        the preferred module before others. Jobs don't have resource
+        requests here, so budget is ignored.
         """
         # TODO: Check for timeouts here too?
         allocated = []
         with self._lock:
-            for job in self._jobs:
-                if job[JOBTYPE] == type and job[STATE] == STATE_PENDING and \
-                   job[ISBLOCKED] == 0:
-                    allocated.append(self._to_map(job))
-                    job[TSCHANGE] = time.time()
-                    job[TSALLOCATED] = time.time()
-                    job[STATE] = STATE_ALLOCATED
-
-                if len(allocated) >= max_jobs:
+            self._release_retries()
+            # Supported modules are not checked, standalone workers run whatever they are given
+            keys = [key for key in self._pending if key[0] == type]
+            prefer = (type, prefermodule) if prefermodule and preferlevel > 0 and (type, prefermodule) in keys else None
+            while len(allocated) < max_jobs:
+                best = None
+                if prefer:
+                    best = self._peek(prefer)
+                    if best:
+                        key = prefer
+                    else:
+                        prefer = None
+                if not best:
+                    for k in keys:
+                        entry = self._peek(k)
+                        if entry and (best is None or entry < best):
+                            best, key = entry, k
+                if not best:
                     break
+                heapq.heappop(self._pending[key])
+                job = self._jobs[best[2]]
+                job[TSALLOCATED] = time.time()
+                job[LEASE] = self._lease_until(job, job[TSALLOCATED])
+                job[HOLDER] = (workerid, node)
+                self._touch(job, STATE_ALLOCATED)
+                allocated.append(self._to_map(job))
         return allocated
 
+    def _release_retries(self):
+        """
+        Make failed jobs whose backoff has passed available again. Must hold the lock
+        """
+        now = time.time()
+        while self._retrying and self._retrying[0][0] <= now:
+            job = self._jobs.get(heapq.heappop(self._retrying)[1])
+            if job and job[ISBLOCKED] == BLOCKED_RETRY:
+                job[ISBLOCKED] = False
+                if job[STATE] == STATE_PENDING:
+                    self._push(job)
+
+    def _retry(self, job):
+        """
+        Put a failed job back as pending after a backoff if it has retries
+        left, see jobdb.JobDB.update_job(). Must hold the lock
+        """
+        if job[STATE] != STATE_ALLOCATED or job[RETRIES] >= job[RETRY_LIMIT]:
+            return False
+        delay = min(self.retry_max_delay, self.retry_delay * (2 ** job[RETRIES])) * random.uniform(0.5, 1.5)
+        heapq.heappush(self._retrying, (time.time() + delay, job[JOBID]))
+        job[RETRIES] += 1
+        job[ISBLOCKED] = BLOCKED_RETRY
+        job[TSALLOCATED] = 0
+        job[LEASE] = None
+        self._touch(job, STATE_PENDING)
+        return True
+
     def _to_map(self, job):
         return {
                     "id": job[JOBID],
@@ -223,17 +547,26 @@ class JobDB:
 
     def is_all_jobs_done(self):
         """No pending or allocated jobs"""
-
         with self._lock:
-            for job in self._jobs:
-                if job[STATE] <= STATE_ALLOCATED:
-                    return False
-        return True
+            return self._num_active == 0
 
     def list_jobs(self, step=None, state=None, notstate=None, since=None):
+        """
+        List jobs in the order they last changed. With since, only the jobs
+        changed after it are visited
+        """
         jobs = []
         with self._lock:
-            for job in self._jobs:
+            if since:
+                candidates = []
+                for job in reversed(self._changed.values()):
+                    if job[TSCHANGE] <= since:
+                        break
+                    candidates.append(job)
+                candidates.reverse()
+            else:
+                candidates = self._changed.values()
+            for job in candidates:
                 if job[TSALLOCATED]:
                     job[RUNTIME] = time.time() - job[TSALLOCATED]
                 if step and job[STEP] != step:
@@ -242,57 +575,173 @@ class JobDB:
                     continue
                 if notstate and job[STATE] == notstate:
                     continue
-                if since and job[TSCHANGE] <= since:
-                    continue
                 jobs.append(self._to_map(job))
         return jobs
 
+    def _log_event(self, job):
+        """
+        Must hold the lock
+        """
+        self._seq += 1
+        self._events.append((self._seq, job, job[STATE]))
+
+    def get_update_cursor(self):
+        return self._seq
+
+    def get_updates(self, cursor=0, max_updates=1000):
+        """
+        Get job state changes after the given cursor, in the order they
+        happened. Returns (cursor, jobs). As there is only one head, events
+        before the given cursor are dropped.
+        """
+        jobs = []
+        with self._lock:
+            while len(self._events) > 0 and self._events[0][0] <= cursor:
+                self._events.popleft()
+            for seq, job, state in itertools.islice(self._events, max_updates):
+                if job[TSALLOCATED]:
+                    job[RUNTIME] = time.time() - job[TSALLOCATED]
+                j = self._to_map(job)
+                j["seq"] = seq
+                j["state"] = state
+                jobs.append(j)
+                cursor = seq
+        return cursor, jobs
+
     def clear_jobs(self):
         with self._lock:
-            self._jobs = []
+            self._jobs = {}
+            self._by_taskid = {}
+            self._pending = {}
+            self._blocked = {}
+            self._retrying = []
+            self._slots = {}
+            self._changed = collections.OrderedDict()
+            self._allocated = {}
+            self._num_active = 0
+            self._waiting = {}
+            self._dependents = {}
+            self._events = collections.deque()
 
     def remove_job(self, jobid):
         return self.cancel_job(jobid)
 
     def update_job(self, jobid, state, step=None, node=None, args=None, priority=None,
-                   expire_time=None, retval=None, cpu=None, memory=None):
+                   expire_time=None, retval=None, cpu=None, memory=None, retry=False, holder=None):
         with self._lock:
-            for job in self._jobs:
-                if job[JOBID] == jobid:
-                    job[TSCHANGE] = time.time()
-                    job[STATE] = state
-                    if step:
-                        job[STEP] = step
-                    if args:
-                        job[ARGS] = args
-                    if priority:
-                        job[PRIORITY] = priority
-                    if expire_time:
-                        job[EXPIRES] = expire_time
-                    if retval:
-                        job[RETVAL] = retval
-
-                    # print(" -- updated job", jobid, state)
-
-                    return True
-        raise Exception("Failed to update, does the job exist or did the state change? (job %s -> %s)" % (jobid, state))
+            job = self._jobs.get(jobid)
+            if job is None or (holder and (job[STATE] != STATE_ALLOCATED or job[HOLDER] != tuple(holder))):
+                raise Exception("Failed to update, does the job exist or did the state change? (job %s -> %s)" % (jobid, state))
+            if retry and state == STATE_FAILED and self._retry(job):
+                if retval:
+                    job[RETVAL] = retval
+                return True
+            if step and step != job[STEP]:
+                if job[ISBLOCKED]:
+                    self._unindex_blocked(job)
+                    self._blocked.setdefault(step, {})[jobid] = job
+                job[STEP] = step
+            if args:
+                job[ARGS] = args
+            if priority and priority != job[PRIORITY]:
+                job[PRIORITY] = priority
+                if job[STATE] == STATE_PENDING and not job[ISBLOCKED]:
+                    self._push(job)  # The old entry is skipped as the priority differs
+            if expire_time:
+                job[EXPIRES] = expire_time
+            if retval:
+                job[RETVAL] = retval
+            self._touch(job, state)
+
+            # print(" -- updated job", jobid, state)
+            return True
+
+    def update_jobs(self, updates):
+        """
+        Update many jobs, returns a map of jobid to current state for every
+        job that was not updated. Cancelled jobs are removed, so that is None.
+        """
+        failed = {}
+        for u in updates:
+            try:
+                self.update_job(u["id"], u["state"], retval=u.get("retval"),
+                                cpu=u.get("cpu"), memory=u.get("memory"), retry=u.get("retry"),
+                                holder=u.get("holder"))
+            except Exception:
+                failed[u["id"]] = self.get_job_state(u["id"])
+        return failed
+
+    def queue_update(self, jobid, state, retval=None, cpu=None, memory=None, callback=None, retry=False,
+                     holder=None):
+        """
+        Nothing to gain from delaying in memory, updates right away
+        """
+        failed = self.update_jobs([{"id": jobid, "state": state, "retval": retval, "cpu": cpu, "memory": memory,
+                                    "retry": retry, "holder": holder}])
+        if jobid in failed and callback:
+            callback(jobid, failed[jobid])
+
+    def commit_updates(self):
+        return
 
     def cleanup(self):
         """
         Remove done, expired or failed jobs that were completed at least one hour ago
         """
+        before = time.time() - 3600
         with self._lock:
-            for job in self._jobs:
-                if job[STATE] >= STATE_COMPLETED and job[TSCHANGE] < time.time() - 3600:
-                    self._jobs.remove(job)
+            old = []
+            for job in self._changed.values():
+                if job[TSCHANGE] >= before:
+                    break
+                if job[STATE] >= STATE_COMPLETED:
+                    old.append(job)
+            for job in old:
+                self._remove(job)
+
+    def _lease_until(self, job, now):
+        if job[EXPIRES] is not None:
+            return min(now + self.lease_time, job[TSALLOCATED] + job[EXPIRES])
+        return now + self.lease_time
+
+    def renew_leases(self, jobids, worker=None):
+        """
+        Extend the leases of allocated jobs, see jobdb.JobDB.renew_leases()
+        """
+        now = time.time()
+        renewed = 0
+        with self._lock:
+            for jobid in jobids:
+                job = self._allocated.get(jobid)
+                if job:
+                    job[LEASE] = self._lease_until(job, now)
+                    if worker is not None:
+                        job[HOLDER] = (worker, job[HOLDER][1])
+                    renewed += 1
+        return renewed
 
     def update_timeouts(self):
+        now = time.time()
         with self._lock:
-            for job in self._jobs:
-                if job[EXPIRES] is None:
+            for job in list(self._allocated.values()):
+                if job[LEASE] is not None and job[LEASE] < now:
+                    self._touch(job, STATE_TIMEOUT)
+
+    def get_wait_stats(self):
+        """
+        The number of pending jobs and the longest current wait pr priority,
+        there are no profile statistics of completed jobs
+        """
+        now = time.time()
+        stats = {}
+        with self._lock:
+            for job in self._jobs.values():
+                if job[STATE] != STATE_PENDING:
                     continue
-                if job[STATE] == STATE_ALLOCATED and job[TSALLOCATED] + job[EXPIRES] < time.time():
-                    job[STATE] = STATE_TIMEOUT
+                stat = stats.setdefault(job[PRIORITY], {"pending": 0, "max_wait": 0})
+                stat["pending"] += 1
+                stat["max_wait"] = max(stat["max_wait"], now - job[TS])
+        return stats
 
     def list_steps(self):
         return []
@@ -384,8 +833,14 @@ class JobDB:
     def estimate_resources(self, module, datasize=None, priority=None):
         return {}
 
-    def update_worker(self, workerid, modules, last_job):
+    def update_node(self, node, slots, memory, scratch, modules=None):
         pass
 
-    def remove_worker(self, args):
+    def remove_node(self, node):
         pass
+
+    def get_nodes(self, seen_since_sec=120):
+        """
+        There is no node registry, capacity is unknown
+        """
+        return {}
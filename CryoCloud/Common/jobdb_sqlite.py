@@ -0,0 +1,430 @@
+"""
+SQLite backend for the job db, for single node and edge deployments that
+should not need a MySQL server.
+
+The database runs in WAL mode, so readers never block the writer. Every
+process (and thread) gets its own connection, also after a fork. Claims and
+other multi-statement changes use BEGIN IMMEDIATE, which takes the write
+lock up front, so concurrent workers wait their turn instead of deadlocking.
+Select it with CryoCloud.JobDB.backend = "sqlite" and get_jobdb().
+"""
+import os
+import time
+import threading
+import sqlite3
+
+from CryoCore import API
+from CryoCloud.Common import argstore
+from CryoCloud.Common import profilestats
+from CryoCloud.Common import noderegistry
+from CryoCloud.Common.jobdb import *  # Constants and JobDBBase
+
+# Current time as fractional seconds since the epoch, like time.time()
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+JOB_COLUMNS_SQL = """
+                runid INTEGER NOT NULL,
+                step INTEGER DEFAULT 0,
+                taskid INTEGER DEFAULT 0,
+                type INTEGER,
+                priority INTEGER DEFAULT 50,
+                state INTEGER,
+                tsadded REAL,
+                tsallocated REAL DEFAULT NULL,
+                expiretime INTEGER,
+                node TEXT DEFAULT NULL,
+                worker INTEGER DEFAULT NULL,
+                retval BLOB DEFAULT NULL,
+                module TEXT DEFAULT NULL,
+                modulepath TEXT DEFAULT NULL,
+                workdir TEXT DEFAULT NULL,
+                args BLOB DEFAULT NULL,
+                nonce INTEGER DEFAULT 0,
+                itemid INTEGER DEFAULT 0,
+                max_memory INTEGER DEFAULT 0,
+                cpu_time REAL DEFAULT 0,
+                is_blocked INTEGER DEFAULT 0,
+                tschange REAL NOT NULL DEFAULT %s,
+                prefer_nodes TEXT DEFAULT NULL,
+                local_until REAL DEFAULT NULL,
+                lease_until REAL DEFAULT NULL,
+                req_cpus INTEGER DEFAULT 1,
+                req_memory INTEGER DEFAULT 0,
+                req_scratch INTEGER DEFAULT 0,
+                retries INTEGER DEFAULT 0,
+                max_retries INTEGER DEFAULT 0,
+                not_before REAL DEFAULT NULL,
+                slot INTEGER DEFAULT 0""" % NOW
+
+STATEMENTS = [
+    """CREATE TABLE IF NOT EXISTS runs (
+                runid INTEGER PRIMARY KEY AUTOINCREMENT,
+                runname TEXT UNIQUE,
+                module TEXT,
+                steps INTEGER DEFAULT 1,
+                weight REAL DEFAULT 1
+            )""",
+    "CREATE TABLE IF NOT EXISTS jobs (jobid INTEGER PRIMARY KEY AUTOINCREMENT," + JOB_COLUMNS_SQL + ")",
+    "CREATE TABLE IF NOT EXISTS jobs_history (jobid INTEGER PRIMARY KEY," + JOB_COLUMNS_SQL + ")",
+    """CREATE TABLE IF NOT EXISTS job_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                runid INTEGER NOT NULL,
+                jobid INTEGER NOT NULL,
+                state INTEGER,
+                ts REAL NOT NULL DEFAULT %s
+            )""" % NOW,
+    """CREATE TABLE IF NOT EXISTS filewatch (
+                fileid INTEGER PRIMARY KEY AUTOINCREMENT,
+                rootpath TEXT NOT NULL,
+                relpath TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                stable INTEGER DEFAULT 0,
+                public INTEGER DEFAULT 0,
+                done INTEGER DEFAULT 0,
+                runname TEXT,
+                tschange REAL NOT NULL DEFAULT %s
+            )""" % NOW,
+    """CREATE TABLE IF NOT EXISTS profile (
+                itemid INTEGER,
+                module TEXT,
+                product TEXT,
+                addtime REAL,
+                waittime REAL DEFAULT 0,
+                processtime REAL DEFAULT 0,
+                totaltime REAL DEFAULT 0,
+                errors INTEGER DEFAULT 0,
+                timeouts INTEGER DEFAULT 0,
+                cancelled INTEGER DEFAULT 0,
+                state INTEGER DEFAULT 1,
+                worker INTEGER DEFAULT NULL,
+                node TEXT DEFAULT NULL,
+                type INTEGER DEFAULT 1,
+                priority INTEGER DEFAULT -1,
+                datasize INTEGER DEFAULT 0,
+                memory_max INTEGER DEFAULT 0,
+                cpu_time REAL DEFAULT 0,
+                PRIMARY KEY (itemid, module)
+            )""",
+    """CREATE TABLE IF NOT EXISTS profile_summary (
+                module TEXT,
+                time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                runs INTEGER,
+                datasize INTEGER DEFAULT NULL,
+                waittime REAL,
+                processtime REAL,
+                totaltime REAL,
+                cpu_time REAL,
+                priority REAL,
+                errors INTEGER,
+                timeouts INTEGER,
+                cancelled INTEGER,
+                PRIMARY KEY(module, priority, time)
+            )""",
+    noderegistry.NODES_SQL,
+    noderegistry.MODULES_SQL,
+    profilestats.STATS_SQL,
+    DEPS_SQL,
+    STEP_SLOTS_SQL,
+    argstore.BLOBS_SQL,
+    "CREATE INDEX IF NOT EXISTS job_blobs_used ON job_blobs(last_used)",
+    "CREATE INDEX IF NOT EXISTS job_claim ON jobs(state, type, is_blocked, node, priority, tsadded)",
+    "CREATE INDEX IF NOT EXISTS job_module_prio ON jobs(state, module, priority)",
+    "CREATE INDEX IF NOT EXISTS job_run_prio ON jobs(state, runid, priority)",
+    "CREATE INDEX IF NOT EXISTS job_allocated ON jobs(tsallocated)",
+    "CREATE INDEX IF NOT EXISTS job_lease ON jobs(state, lease_until)",
+    "CREATE INDEX IF NOT EXISTS job_retry ON jobs(is_blocked, not_before)",
+    "CREATE INDEX IF NOT EXISTS job_step_slot ON jobs(runid, step, is_blocked)",
+    "CREATE INDEX IF NOT EXISTS job_nonce ON jobs(nonce)",
+    "CREATE INDEX IF NOT EXISTS job_finished ON jobs(state, tschange)",
+    "CREATE INDEX IF NOT EXISTS job_run_step ON jobs(runid, step)",
+    "CREATE INDEX IF NOT EXISTS job_run_task ON jobs(runid, taskid)",
+    "CREATE INDEX IF NOT EXISTS job_history_task ON jobs_history(runid, taskid)",
+    "CREATE INDEX IF NOT EXISTS job_deps_task ON job_deps(runid, taskid)",
+    "CREATE INDEX IF NOT EXISTS job_history_ts ON jobs_history(tschange)",
+    "CREATE INDEX IF NOT EXISTS job_history_added ON jobs_history(tsadded)",
+    "CREATE INDEX IF NOT EXISTS profile_module ON profile_summary(module)",
+    "CREATE INDEX IF NOT EXISTS job_events_run ON job_events(runid, seq)",
+    "CREATE INDEX IF NOT EXISTS job_events_ts ON job_events(ts)",
+    "CREATE INDEX IF NOT EXISTS worker_nodes_seen ON worker_nodes(last_seen)",
+    """CREATE TRIGGER IF NOT EXISTS jobs_events_insert AFTER INSERT ON jobs
+        FOR EACH ROW WHEN NEW.state <> %d
+    BEGIN
+        INSERT INTO job_events (runid, jobid, state) VALUES (NEW.runid, NEW.jobid, NEW.state);
+    END""" % STATE_PENDING,
+    """CREATE TRIGGER IF NOT EXISTS jobs_events_update AFTER UPDATE OF state ON jobs
+        FOR EACH ROW WHEN NEW.state <> OLD.state
+    BEGIN
+        INSERT INTO job_events (runid, jobid, state) VALUES (NEW.runid, NEW.jobid, NEW.state);
+    END""",
+    # Slots of steps with max_parallel are given back when their jobs finish or are removed
+    """CREATE TRIGGER IF NOT EXISTS jobs_slots_update AFTER UPDATE OF state ON jobs
+        FOR EACH ROW WHEN NEW.state <> OLD.state AND OLD.slot
+    BEGIN
+        UPDATE step_slots SET running=running + %s WHERE runid=OLD.runid AND step=OLD.step;
+    END""" % SLOT_CHANGE,
+    """CREATE TRIGGER IF NOT EXISTS jobs_slots_delete AFTER DELETE ON jobs
+        FOR EACH ROW WHEN OLD.slot AND (OLD.state<%d OR OLD.state>=%d)
+    BEGIN
+        UPDATE step_slots SET running=running - 1 WHERE runid=OLD.runid AND step=OLD.step;
+    END""" % (STATE_COMPLETED, STATE_DISABLED),
+    # Like ON UPDATE CURRENT_TIMESTAMP in MySQL
+    """CREATE TRIGGER IF NOT EXISTS jobs_tschange AFTER UPDATE ON jobs
+        FOR EACH ROW WHEN NEW.tschange = OLD.tschange
+    BEGIN
+        UPDATE jobs SET tschange=%s WHERE jobid=NEW.jobid;
+    END""" % NOW
+]
+
+# Uses numbered parameters (itemid, module, state, ts, worker, node, memory_max, cpu_time)
+PROFILE_UPDATE_SQL = """UPDATE profile SET state=?3,
+        waittime=CASE WHEN ?3=%(allocated)d THEN ?4-addtime ELSE waittime END,
+        worker=CASE WHEN ?3=%(allocated)d THEN ?5 ELSE worker END,
+        node=CASE WHEN ?3=%(allocated)d THEN ?6 ELSE node END,
+        totaltime=CASE WHEN ?3=%(allocated)d THEN totaltime ELSE ?4-addtime END,
+        processtime=CASE WHEN ?3=%(allocated)d THEN processtime ELSE ?4-addtime-waittime END,
+        errors=errors+(?3=%(failed)d),
+        timeouts=timeouts+(?3=%(timeout)d),
+        cancelled=cancelled+(?3=%(cancelled)d),
+        memory_max=COALESCE(?7, memory_max),
+        cpu_time=COALESCE(?8, cpu_time)
+    WHERE itemid=?1 AND module=?2""" % {
+    "allocated": STATE_ALLOCATED, "failed": STATE_FAILED, "timeout": STATE_TIMEOUT, "cancelled": STATE_CANCELLED}
+
+
+class JobDB(JobDBBase):
+
+    _TSCHANGE_SECONDS = "tschange"
+    _BLOB_UPSERT = argstore.UPSERT_SQLITE
+    _STATS_UPSERT = profilestats.UPSERT_SQLITE
+    _NODE_UPSERT = noderegistry.UPSERT_SQLITE
+    _SLOTS_UPSERT = SLOTS_UPSERT_SQLITE
+    _NOW_SECONDS = NOW
+
+    def __init__(self, runname, module, steps=1, auto_cleanup=True, path=None):
+        self.log = API.get_log("JobDB")
+        cfg = API.get_config("CryoCloud.JobDB")
+        cfg.set_default("sqlite_path", os.path.expanduser("~/.cryocloud/jobdb.sqlite"))
+        self._path = path if path else cfg["sqlite_path"]
+        if os.path.dirname(self._path) and not os.path.isdir(os.path.dirname(self._path)):
+            os.makedirs(os.path.dirname(self._path))
+        self._local = threading.local()
+        JobDBBase.__init__(self, runname, module)
+
+        if not runname and not module:
+            return  # Is a worker, can only allocate/update jobs
+
+        stats_existed = self._has_profile_stats()
+        for SQL in STATEMENTS:
+            self._connection().execute(SQL)
+        self._upgrade_profile_stats(stats_existed)
+
+        self._create_run(module, steps)
+        self._start_cleanup(auto_cleanup)
+
+    def _connection(self):
+        """
+        One connection pr thread, and a new one if we have been forked
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            # Statements are compiled once pr connection and kept in its statement cache
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False,
+                                   cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _execute(self, SQL, args=None, insist_direct=False, prepare=False):
+        c = self._connection().cursor()
+        c.execute(SQL.replace("%s", "?"), list(args) if args else [])
+        return c
+
+    def _transaction(self, func):
+        """
+        Run func in a BEGIN IMMEDIATE transaction and return what it returns
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            retval = func()
+            conn.execute("COMMIT")
+            return retval
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _claim(self, args):
+        """
+        Pick and allocate jobs in one write transaction
+        """
+        jobtype, node, modules, prefer, min_prio, strict, workerid, nonce, max_jobs, now, share_run, lease = args[:12]
+        aged, aged_args = self._aged_priority(now, *args[15:])
+        SQL = "SELECT jobid FROM jobs WHERE state=%s AND type=%s AND is_blocked=0 AND (node IS NULL OR node=%s)" +\
+              " AND (local_until IS NULL OR local_until<%s OR instr(',' || prefer_nodes || ',', %s) > 0)"
+        params = [STATE_PENDING, jobtype, node, now, ",%s," % node]
+        if modules:
+            modules = modules.split(",")
+            SQL += " AND module IN (" + ",".join(["%s"] * len(modules)) + ")"
+            params.extend(modules)
+        for resource, left in zip(RESOURCES, args[12:15]):
+            if left is not None:
+                SQL += " AND req_%s<=%%s" % resource
+                params.append(left)
+
+        # Same order of attempts as the MySQL procedure, the fair share run is optional
+        attempts = []
+        if prefer:
+            attempts.append((" AND module=%s AND " + aged + ">%s", [prefer] + aged_args + [min_prio]))
+        if not (prefer and strict):
+            attempts.append(("", []))
+
+        def claim():
+            self._execute("UPDATE jobs SET is_blocked=0 WHERE is_blocked=%s AND not_before<=%s", [BLOCKED_RETRY, now])
+            self._grant_slots(aged, aged_args)
+            jobids = []
+            for where, extra in attempts:
+                for run in ([share_run] if share_run else []) + [None]:
+                    run_sql, run_args = (" AND runid=%s", [run]) if run else ("", [])
+                    c = self._execute(SQL + where + run_sql + " ORDER BY " + aged + " DESC, tsadded LIMIT %s",
+                                      params + extra + run_args + aged_args + [max_jobs])
+                    jobids = [row[0] for row in c.fetchall()]
+                    if jobids:
+                        break
+                if jobids:
+                    break
+            if len(jobids) == 0:
+                return []
+            marks = ",".join(["%s"] * len(jobids))
+            self._execute("UPDATE jobs SET state=%s, tsallocated=%s, node=%s, worker=%s, nonce=%s, " +
+                          "lease_until=%s + CASE WHEN expiretime IS NOT NULL AND expiretime<%s THEN expiretime ELSE %s END " +
+                          "WHERE jobid IN (" + marks + ")",
+                          [STATE_ALLOCATED, now, node, workerid, nonce, now, lease, lease] + jobids)
+            c = self._execute("SELECT jobid, step, taskid, type, priority, args, runname, jobs.module, modulepath, " +
+                              "runs.module, steps, workdir, itemid, runid, req_cpus, req_memory, req_scratch " +
+                              "FROM jobs JOIN runs USING (runid) " +
+                              "WHERE jobid IN (" + marks + ")", jobids)
+            return c.fetchall()
+        return self._transaction(claim)
+
+    @staticmethod
+    def _aged_priority(now, interval, step, cap):
+        """
+        SQL and args of the priority jobs are claimed by, see AGING_INTERVAL
+        """
+        if interval <= 0:
+            return "priority", []
+        return "(priority + MIN(%s, CAST((%s - tsadded) / %s AS INTEGER) * %s))", [cap, now, interval, step]
+
+    def _grant_slots(self, aged, aged_args):
+        """
+        Give the free slots of steps with max_parallel to their waiting jobs,
+        like the MySQL procedure does. Must be in a transaction
+        """
+        c = self._execute("SELECT runid, step, max_parallel - running FROM step_slots WHERE running<max_parallel " +
+                          "AND EXISTS (SELECT 1 FROM jobs WHERE jobs.runid=step_slots.runid AND " +
+                          "jobs.step=step_slots.step AND is_blocked=%s AND state=%s)", [BLOCKED_PARALLEL, STATE_PENDING])
+        for runid, step, free in c.fetchall():
+            c = self._execute("UPDATE jobs SET is_blocked=0, slot=1 WHERE jobid IN (SELECT jobid FROM jobs " +
+                              "WHERE runid=%s AND step=%s AND is_blocked=%s AND state=%s " +
+                              "ORDER BY " + aged + " DESC, tsadded LIMIT %s)",
+                              [runid, step, BLOCKED_PARALLEL, STATE_PENDING] + aged_args + [free])
+            self._execute("UPDATE step_slots SET running=running + %s WHERE runid=%s AND step=%s",
+                          [c.rowcount, runid, step])
+
+    def _unblock(self, step, amount):
+        c = self._execute("UPDATE jobs SET is_blocked=0 WHERE jobid IN (SELECT jobid FROM jobs " +
+                          "WHERE runid=%s AND step=%s AND is_blocked=1 LIMIT %s)", [self._runid, step, amount])
+        return c.rowcount
+
+    def _get_update_rows(self, cursor, max_updates):
+        SQL = "SELECT * FROM (SELECT job_events.seq, job_events.state, " + self._JOB_COLUMNS +\
+              " FROM job_events JOIN jobs USING (jobid) WHERE job_events.runid=%s AND job_events.seq>%s" +\
+              " ORDER BY job_events.seq LIMIT %s) UNION ALL " +\
+              "SELECT * FROM (SELECT job_events.seq, job_events.state, " + self._HISTORY_COLUMNS +\
+              " FROM job_events JOIN jobs_history USING (jobid) WHERE job_events.runid=%s AND job_events.seq>%s" +\
+              " ORDER BY job_events.seq LIMIT %s) ORDER BY 1 LIMIT %s"
+        c = self._execute(SQL, [self._runid, cursor, max_updates, self._runid, cursor, max_updates, max_updates])
+        return c.fetchall()
+
+    def _update_batch(self, batch):
+        SQL = "UPDATE jobs SET state=?, retval=COALESCE(?, retval), cpu_time=COALESCE(?, cpu_time), " +\
+              "max_memory=COALESCE(?, max_memory) WHERE jobid=? AND (state<>? OR ?=?) AND " +\
+              "(? IS NULL OR (state=? AND worker=? AND node=?))"
+        rows = []
+        for u in batch:
+            retval = self._argstore.pack(u["retval"], share=False) if u.get("retval") else None
+            holder = u.get("holder") or (None, None)
+            rows.append([u["state"], retval, u.get("cpu") or None, u.get("memory") or None, u["id"],
+                         STATE_CANCELLED, u["state"], STATE_CANCELLED,
+                         holder[0], STATE_ALLOCATED, holder[0], holder[1]])
+        self._transaction(lambda: self._connection().executemany(SQL, rows))
+
+    def _commit_profiles(self, profiles):
+        inserts = [p[1:] for p in profiles if p[0] == "insert"]
+        updates = [p[1:] for p in profiles if p[0] == "update"]
+
+        def commit():
+            # Updates of a new profile always come after its insert, so this order is fine
+            conn = self._connection()
+            conn.executemany("INSERT OR IGNORE INTO profile (itemid, module, product, addtime, datasize, priority, type) " +
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", inserts)
+            conn.executemany(PROFILE_UPDATE_SQL, updates)
+        self._transaction(commit)
+
+    def archive_jobs(self, age=None):
+        """
+        Move done, expired, failed or cancelled jobs that finished more than
+        age (default archive_after) seconds ago to jobs_history, archive_batch
+        jobs pr transaction. Returns the number of jobs moved
+        """
+        if age is None:
+            age = self._archive_cfg["archive_after"]
+        batch = int(self._archive_cfg["archive_batch"])
+
+        def archive():
+            c = self._execute("SELECT jobid FROM jobs WHERE state>=%s AND state<%s AND tschange<%s ORDER BY jobid LIMIT %s",
+                              [STATE_COMPLETED, STATE_DISABLED, time.time() - float(age), batch])
+            jobids = [row[0] for row in c.fetchall()]
+            if jobids:
+                marks = ",".join(["%s"] * len(jobids))
+                self._execute("INSERT OR IGNORE INTO jobs_history SELECT * FROM jobs WHERE jobid IN (" + marks + ")", jobids)
+                self._execute("DELETE FROM jobs WHERE jobid IN (" + marks + ")", jobids)
+            return len(jobids)
+
+        moved = 0
+        while not API.api_stop_event.is_set():
+            num = self._transaction(archive)
+            moved += num
+            if num < batch:
+                break
+        return moved
+
+    def _delete_batched(self, table, key, where, args):
+        """
+        Delete rows matching where, archive_batch at a time
+        """
+        batch = int(self._archive_cfg["archive_batch"])
+        SQL = "DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s LIMIT %%s)" % (table, key, key, table, where)
+        while not API.api_stop_event.is_set():
+            c = self._execute(SQL, args + [batch])
+            if c.rowcount < batch:
+                break
+
+    def cleanup(self):
+        """
+        Archive finished jobs, and remove history, change log, finished
+        profiles and shared args that are past their retention, and
+        dependencies of archived jobs
+        """
+        self.archive_jobs()
+        self._delete_batched("jobs_history", "jobid", "tschange<%s",
+                             [time.time() - float(self._archive_cfg["history_retention"])])
+        self._delete_batched("job_events", "seq", "ts<%s", [time.time() - 3600])
+        self._delete_batched("profile", "rowid", "state>%s AND addtime<%s",
+                             [STATE_ALLOCATED, time.time() - float(self._archive_cfg["history_retention"])])
+        self._delete_batched("job_deps", "rowid", "NOT EXISTS (SELECT 1 FROM jobs WHERE " +
+                             "jobs.runid=job_deps.runid AND jobs.taskid=job_deps.taskid)", [])
+        self._prune_profile_stats()
+        self._registry.cleanup()
+        self._cleanup_args()
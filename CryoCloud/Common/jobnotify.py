@@ -0,0 +1,131 @@
+"""
+Wake-up channel for idle workers.
+
+When jobs are added (or unblocked), the JobDB sends a tiny UDP datagram to a
+multicast group. Idle workers wait on the group instead of sleeping, so new
+jobs are picked up within milliseconds rather than on the next poll.
+
+The notifications are only hints - they may be lost or not routed at all, so
+workers still poll the database, just far less often.
+"""
+from __future__ import print_function
+import socket
+import struct
+import select
+import time
+import json
+
+from CryoCore import API
+
+
+def _get_config():
+    cfg = API.get_config("CryoCloud.JobNotify")
+    cfg.set_default("enabled", True)
+    cfg.set_default("group", "239.255.67.67")
+    cfg.set_default("port", 12867)
+    cfg.set_default("ttl", 1)
+    return cfg
+
+
+class JobNotifier:
+    """
+    Sends "new jobs available" hints to all listeners
+    """
+    def __init__(self):
+        self.cfg = _get_config()
+        self.log = API.get_log("CryoCloud.JobNotify")
+        self._socket = None
+        if not self.cfg["enabled"]:
+            return
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, int(self.cfg["ttl"]))
+            self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        except:
+            self.log.exception("Failed to create job notification socket, workers will poll")
+            self._socket = None
+
+    def notify(self, jobtypes=None):
+        """
+        Tell idle workers that jobs of the given types are available (None for any type)
+        """
+        if not self._socket:
+            return
+        try:
+            msg = json.dumps({"types": jobtypes}).encode("utf-8")
+            self._socket.sendto(msg, (self.cfg["group"], int(self.cfg["port"])))
+        except:
+            pass  # It's just a hint
+
+
+class JobListener:
+    """
+    Waits for hints from a JobNotifier. If we can't listen, wait() just sleeps
+    """
+    def __init__(self):
+        self.cfg = _get_config()
+        self.log = API.get_log("CryoCloud.JobNotify")
+        self._socket = None
+        if not self.cfg["enabled"]:
+            return
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind(("", int(self.cfg["port"])))
+            mreq = struct.pack("4sl", socket.inet_aton(self.cfg["group"]), socket.INADDR_ANY)
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            s.setblocking(False)
+            self._socket = s
+        except:
+            self.log.exception("Failed to listen for job notifications, will poll")
+            self._socket = None
+
+    def is_listening(self):
+        return self._socket is not None
+
+    def _relevant(self, jobtype):
+        """
+        Drain all queued hints, return True if any of them are for the given type
+        """
+        found = False
+        while True:
+            try:
+                data = self._socket.recv(1024)
+            except (BlockingIOError, socket.error):
+                return found
+            try:
+                types = json.loads(data.decode("utf-8"))["types"]
+                if jobtype is None or types is None or jobtype in types:
+                    found = True
+            except:
+                found = True  # Garbled, better check the DB
+
+    def wait(self, timeout, jobtype=None):
+        """
+        Wait for at most timeout seconds for a hint about jobs of the given type.
+        Returns True if we got one, False on timeout
+        """
+        if not self._socket:
+            time.sleep(timeout)
+            return False
+
+        stop_time = time.time() + timeout
+        while True:
+            left = stop_time - time.time()
+            if left <= 0:
+                return False
+            r = select.select([self._socket], [], [], min(left, 1.0))[0]
+            if r and self._relevant(jobtype):
+                return True
+            if API.api_stop_event.is_set():
+                return False
+
+    def close(self):
+        if self._socket:
+            try:
+                self._socket.close()
+            except:
+                pass
+            self._socket = None
@@ -151,6 +151,10 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             self.server.log.exception("Getting JSON post")
             return self.send_error(500, "Bad JSON")
 
+        if self.server.watcher.paused():
+            # Admission control, the client must try again later
+            return self._replyJSON(503, {"error": "Too much work in progress, try again later"})
+
         info["_order"] = uuid.uuid4().hex
 
         # If periodic
@@ -181,9 +185,11 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 
 class NetWatcher(threading.Thread):
     def __init__(self, port, onAdd=None, onError=None, stop_event=None,
-                 schema=None, handler=None, cors=None):
+                 schema=None, handler=None, cors=None, admit=None):
         """
-        Schema must be a JSON schema for validating possible inputs
+        Schema must be a JSON schema for validating possible inputs. If
+        admit is given, it's called before accepting a request, new requests
+        are rejected with 503 while it returns False or we are paused
         """
 
         threading.Thread.__init__(self)
@@ -198,6 +204,8 @@ class NetWatcher(threading.Thread):
             self.onAdd = onAdd
         if onError:
             self.onError = onError
+        self._admit = admit
+        self._paused = threading.Event()
 
         self.handler = handler
         self.webHandler = RequestHandler
@@ -241,6 +249,24 @@ class NetWatcher(threading.Thread):
     def stop(self):
         self._stop_event.set()
 
+    def pause(self):
+        """
+        Reject new requests until resumed
+        """
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def paused(self):
+        if self._paused.is_set():
+            return True
+        try:
+            return bool(self._admit and not self._admit())
+        except:
+            self.log.exception("Admission check failed")
+            return False
+
     def add_callback(self, func):
         self.callbacks.append(func)
 
@@ -296,7 +322,7 @@ class NetWatcher(threading.Thread):
                 with self._periodic_condition:
                     if len(self.periodicals) > 0:
                         p = self.periodicals[0]
-                        if p["next_run"] <= time.time():  # Next run has passed
+                        if p["next_run"] <= time.time() and not self.paused():  # Next run has passed
                             self.log.debug("Reposting periodic ")
                             self.onAdd(p["info"])
 
@@ -0,0 +1,170 @@
+"""
+Registry of worker nodes.
+
+Each node controller sends one heartbeat for the node, with the number of
+workers and free workers of each type, available memory and scratch space.
+The modules a node supports are only written when they change, one row pr
+module, so the primary key of worker_modules is the module to node index.
+Heads keep a view of the registry in memory, refreshed with the nodes that
+have been seen since the last refresh.
+"""
+import time
+import threading
+
+NODES_SQL = """CREATE TABLE IF NOT EXISTS worker_nodes (
+                node VARCHAR(128) NOT NULL,
+                type TINYINT NOT NULL,
+                slots INT DEFAULT 0,
+                free INT DEFAULT 0,
+                memory BIGINT DEFAULT 0,
+                scratch BIGINT DEFAULT 0,
+                last_seen DOUBLE,
+                modules_changed DOUBLE,
+                PRIMARY KEY (node, type)
+            )"""
+
+MODULES_SQL = """CREATE TABLE IF NOT EXISTS worker_modules (
+                module VARCHAR(256) NOT NULL,
+                node VARCHAR(128) NOT NULL,
+                type TINYINT NOT NULL,
+                PRIMARY KEY (module, node, type)
+            )"""
+
+# How a backend writes a heartbeat
+UPSERT_MYSQL = "ON DUPLICATE KEY UPDATE slots=VALUES(slots), free=VALUES(free), memory=VALUES(memory), " +\
+               "scratch=VALUES(scratch), last_seen=VALUES(last_seen)"
+UPSERT_SQLITE = "ON CONFLICT(node, type) DO UPDATE SET slots=excluded.slots, free=excluded.free, " +\
+                "memory=excluded.memory, scratch=excluded.scratch, last_seen=excluded.last_seen"
+
+# Seconds between heartbeats from a node
+HEARTBEAT_INTERVAL = 5
+
+# The view is refreshed at most this often
+REFRESH_INTERVAL = 2.0
+
+# Heartbeats are timed by the database, but may commit a little out of order
+CURSOR_SLACK = 5.0
+
+# Nodes not seen for this long are removed by cleanup
+FORGET_AFTER = 86400
+
+
+class NodeRegistry:
+    """
+    Heartbeats of nodes and the view of them. now_sql is the current time
+    in seconds in the SQL dialect of the backend
+    """
+
+    def __init__(self, db, upsert=UPSERT_MYSQL, now_sql="UNIX_TIMESTAMP(NOW(6))"):
+        self._db = db
+        self._upsert = upsert
+        self._now = now_sql
+        self._lock = threading.Lock()
+        self._nodes = {}  # node -> {"seen", "memory", "scratch", "modules_changed", "types": {type: {"slots", "free"}}}
+        self._modules = {}  # node -> {type: set of modules}
+        self._by_module = {}  # module -> {type: set of nodes}
+        self._cursor = 0
+        self._refreshed = 0
+
+    def heartbeat(self, node, slots, memory, scratch, modules=None):
+        """
+        slots is a map of worker type to (workers, free workers), modules a
+        map of worker type to supported modules, only given if they changed
+        """
+        if modules is not None:
+            self._db._execute("DELETE FROM worker_modules WHERE node=%s", [node])
+            rows = [(m, node, t) for t in modules for m in set(modules[t])]
+            if rows:
+                self._db._execute("INSERT INTO worker_modules (module, node, type) VALUES " +
+                                  ",".join(["(%s, %s, %s)"] * len(rows)), [v for row in rows for v in row])
+
+        args = []
+        for t in slots:
+            args.extend([node, t, slots[t][0], slots[t][1], memory, scratch])
+        values = "(%s, %s, %s, %s, %s, %s, " + self._now + ", " + self._now + ")"
+        self._db._execute("INSERT INTO worker_nodes (node, type, slots, free, memory, scratch, last_seen, modules_changed) " +
+                          "VALUES " + ",".join([values] * len(slots)) + " " + self._upsert, args)
+        if modules is not None:
+            self._db._execute("UPDATE worker_nodes SET modules_changed=last_seen WHERE node=%s", [node])
+
+    def remove(self, node):
+        self._db._execute("DELETE FROM worker_nodes WHERE node=%s", [node])
+        self._db._execute("DELETE FROM worker_modules WHERE node=%s", [node])
+
+    def cleanup(self):
+        self._db._execute("DELETE FROM worker_nodes WHERE last_seen < " + self._now + " - %s", [FORGET_AFTER])
+        self._db._execute("DELETE FROM worker_modules WHERE NOT EXISTS (SELECT 1 FROM worker_nodes " +
+                          "WHERE worker_nodes.node=worker_modules.node)")
+
+    def refresh(self, force=False):
+        """
+        Read the nodes seen since the last refresh, and their modules if
+        they have changed
+        """
+        with self._lock:
+            if not force and time.time() - self._refreshed < REFRESH_INTERVAL:
+                return
+            self._refreshed = time.time()
+            c = self._db._execute("SELECT node, type, slots, free, memory, scratch, last_seen, modules_changed " +
+                                  "FROM worker_nodes WHERE last_seen>%s", [self._cursor - CURSOR_SLACK])
+            rows = c.fetchall()
+            if not rows:
+                return
+
+            # Age the nodes by the database clock, the newest heartbeat is about now
+            newest = max([row[6] for row in rows])
+            changed = set()
+            for node, t, slots, free, memory, scratch, last_seen, modules_changed in rows:
+                info = self._nodes.setdefault(node, {"types": {}, "modules_changed": None})
+                if (modules_changed or 0) != info["modules_changed"]:
+                    changed.add(node)
+                info.update({"seen": self._refreshed - (newest - last_seen), "memory": memory,
+                             "scratch": scratch, "modules_changed": modules_changed or 0})
+                info["types"][t] = {"slots": slots, "free": free}
+            self._cursor = max(self._cursor, newest)
+
+            if changed:
+                changed = list(changed)
+                c = self._db._execute("SELECT module, node, type FROM worker_modules WHERE node IN (" +
+                                      ",".join(["%s"] * len(changed)) + ")", changed)
+                for node in changed:
+                    self._modules[node] = {}
+                for module, node, t in c.fetchall():
+                    self._modules[node].setdefault(t, set()).add(module)
+                self._by_module = {}
+                for node, types in self._modules.items():
+                    for t, modules in types.items():
+                        for module in modules:
+                            self._by_module.setdefault(module, {}).setdefault(t, set()).add(node)
+
+    def get_nodes(self, seen_since_sec=120):
+        """
+        Map of nodes seen within seen_since_sec seconds to their capacity,
+        the free and total slots pr worker type, memory, scratch space and
+        modules pr worker type
+        """
+        self.refresh()
+        since = time.time() - seen_since_sec
+        with self._lock:
+            nodes = {}
+            for node, info in self._nodes.items():
+                if info["seen"] < since:
+                    continue
+                nodes[node] = {"memory": info["memory"], "scratch": info["scratch"],
+                               "types": {t: dict(s) for t, s in info["types"].items()},
+                               "modules": {t: set(m) for t, m in self._modules.get(node, {}).items()}}
+            return nodes
+
+    def get_module_nodes(self, module, type=None, seen_since_sec=60):
+        """
+        Nodes seen within seen_since_sec seconds that support module, with
+        workers of the given type if not None
+        """
+        self.refresh()
+        since = time.time() - seen_since_sec
+        with self._lock:
+            nodes = set()
+            for t, n in self._by_module.get(module, {}).items():
+                if type is None or t == type:
+                    nodes.update(n)
+            return sorted([n for n in nodes if self._nodes[n]["seen"] >= since])
@@ -0,0 +1,216 @@
+"""
+Running statistics of job profiles.
+
+Instead of summarizing the profile table now and then, the head keeps
+statistics pr module, priority and datasize bucket that are updated as jobs
+finish: counts, mean and variance, and a log bucket sketch for quantiles.
+They can be merged, so every head merges what it has seen since it last
+wrote into the shared rows in profile_stats, and reads them for estimates.
+Rows are weighed down as they grow so old runs count less, and rows that
+are not updated are removed after a while.
+"""
+import json
+import math
+
+# Relative accuracy of quantiles is about (SKETCH_GAMMA - 1) / 2
+SKETCH_GAMMA = 1.1
+
+# Datasizes are grouped in buckets of this many bytes, like the old summaries
+SIZE_BUCKET = 1073741824
+
+# Values that are timed or measured for completed jobs
+FIELDS = ["waittime", "processtime", "totaltime", "cpu_time", "memory_max"]
+
+STATS_SQL = """CREATE TABLE IF NOT EXISTS profile_stats (
+                module VARCHAR(128),
+                priority INT,
+                size_bucket INT,
+                stats MEDIUMTEXT,
+                updated DOUBLE,
+                version INT,
+                PRIMARY KEY (module, priority, size_bucket)
+            )"""
+
+# How a backend creates a row to merge into unless it is there, version
+# is then bumped by every merge
+UPSERT_MYSQL = "ON DUPLICATE KEY UPDATE version=version"
+UPSERT_SQLITE = "ON CONFLICT(module, priority, size_bucket) DO NOTHING"
+
+
+def size_bucket(datasize):
+    return int((datasize or 0) // SIZE_BUCKET)
+
+
+class RunningStat:
+    """
+    Count, mean and variance (Welford) of a value, and a sketch of its
+    distribution with buckets growing by SKETCH_GAMMA
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sketch = {}
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        b = self._bucket(x)
+        self.sketch[b] = self.sketch.get(b, 0) + 1
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        for b, count in other.sketch.items():
+            self.sketch[b] = self.sketch.get(b, 0) + count
+
+    def scale(self, factor):
+        """
+        Count every value as factor of one, mean and spread are kept
+        """
+        self.n *= factor
+        self.m2 *= factor
+        self.sketch = {b: count * factor for b, count in self.sketch.items()}
+
+    def std(self):
+        if self.n < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.n - 1))
+
+    def quantile(self, q):
+        """
+        The value below which a fraction q of the values are, None if no values
+        """
+        if self.n == 0:
+            return None
+        rank = q * (self.n - 1)
+        seen = 0
+        for b in sorted(self.sketch):
+            seen += self.sketch[b]
+            if seen > rank:
+                return self._value(b)
+        return self._value(max(self.sketch))
+
+    @staticmethod
+    def _bucket(x):
+        if x <= 0:
+            return 0  # Bucket 0 is for anything not positive, buckets for values start at 1
+        return max(1, int(math.floor(math.log(x) / math.log(SKETCH_GAMMA))) + 2**20)
+
+    @staticmethod
+    def _value(b):
+        if b == 0:
+            return 0.0
+        # Midpoint of the bucket
+        return SKETCH_GAMMA ** (b - 2**20) * (1 + SKETCH_GAMMA) / 2
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2,
+                "sketch": {str(b): c for b, c in self.sketch.items()}}
+
+    @staticmethod
+    def from_mean(n, mean):
+        """
+        n values known only by their mean, as in the old summaries
+        """
+        s = RunningStat()
+        if n > 0 and mean is not None:
+            s.n = n
+            s.mean = float(mean)
+            s.sketch = {RunningStat._bucket(mean): n}
+        return s
+
+    @staticmethod
+    def from_dict(d):
+        s = RunningStat()
+        s.n = d["n"]
+        s.mean = d["mean"]
+        s.m2 = d["m2"]
+        s.sketch = {int(b): c for b, c in d["sketch"].items()}
+        return s
+
+
+class ProfileStats:
+    """
+    Statistics of finished jobs for one module, priority and size bucket.
+    Times are only counted for completed jobs
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.stats = {f: RunningStat() for f in FIELDS}
+
+    def add(self, outcome, values):
+        """
+        outcome is one of "completed", "errors", "timeouts" and "cancelled",
+        values a map of FIELDS, missing ones are not counted
+        """
+        self.runs += 1
+        if outcome != "completed":
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            return
+        for f in FIELDS:
+            if values.get(f) is not None:
+                self.stats[f].add(values[f])
+
+    def merge(self, other):
+        self.runs += other.runs
+        self.errors += other.errors
+        self.timeouts += other.timeouts
+        self.cancelled += other.cancelled
+        for f in FIELDS:
+            self.stats[f].merge(other.stats[f])
+
+    def scale(self, factor):
+        self.runs *= factor
+        self.errors *= factor
+        self.timeouts *= factor
+        self.cancelled *= factor
+        for f in FIELDS:
+            self.stats[f].scale(factor)
+
+    @staticmethod
+    def from_summary(runs, errors, timeouts, cancelled, means):
+        """
+        Statistics of a row of the old profile_summary table, means is a map
+        of FIELDS to averages of the jobs that were not errors, timeouts or
+        cancelled
+        """
+        p = ProfileStats()
+        p.runs = runs or 0
+        p.errors = errors or 0
+        p.timeouts = timeouts or 0
+        p.cancelled = cancelled or 0
+        completed = p.runs - p.errors - p.timeouts - p.cancelled
+        for f, mean in means.items():
+            p.stats[f] = RunningStat.from_mean(completed, mean)
+        return p
+
+    def to_json(self):
+        return json.dumps({"runs": self.runs, "errors": self.errors, "timeouts": self.timeouts,
+                           "cancelled": self.cancelled,
+                           "stats": {f: self.stats[f].to_dict() for f in FIELDS}})
+
+    @staticmethod
+    def from_json(text):
+        d = json.loads(text)
+        p = ProfileStats()
+        p.runs = d["runs"]
+        p.errors = d["errors"]
+        p.timeouts = d["timeouts"]
+        p.cancelled = d["cancelled"]
+        for f in FIELDS:
+            if f in d["stats"]:
+                p.stats[f] = RunningStat.from_dict(d["stats"][f])
+        return p
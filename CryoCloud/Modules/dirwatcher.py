@@ -42,5 +42,9 @@ def start(handler, args, stop_event):
         info["datasize"] = s.st_size
         handler.onAdd(info)
 
-    handler.dir_monitor = handler.head.makeDirectoryWatcher(src, onAdd, recursive=recursive)
+    def admit():
+        # Pause discovery while the workflow is full
+        return handler.admit(args["__name__"])
+
+    handler.dir_monitor = handler.head.makeDirectoryWatcher(src, onAdd, recursive=recursive, admit=admit)
     handler.dir_monitor.start()
@@ -74,5 +74,6 @@ def start(handler, args, stop_event):
                                      schema=schema,
                                      stop_event=stop_event,
                                      handler=handler,
-                                     cors=cors)
+                                     cors=cors,
+                                     admit=lambda: handler.admit(args["__name__"]))
     nw.start()
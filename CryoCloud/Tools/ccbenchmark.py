@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+"""
+Throughput and latency benchmark for the job db backends
+
+A head adds jobs and follows get_updates() like the real head does, while a
+number of workers claim jobs with allocate_job() and complete them with
+queue_update(). The head keeps the given number of jobs queued by adding a
+new job for every completed one. For every queue depth this reports jobs/s,
+how long claims and head loops take, and how many statements were run pr job.
+
+Results are written as JSON so runs can be compared, use --baseline to
+compare with an earlier run.
+"""
+from __future__ import print_function
+
+import sys
+import os
+import time
+import json
+import random
+import socket
+import tempfile
+import shutil
+import threading
+import platform
+import subprocess
+from argparse import ArgumentParser
+
+try:
+    import argcomplete
+except:
+    pass
+
+from CryoCore import API
+from CryoCloud.Common import jobdb
+
+# Metrics where lower is better, the rest are better when higher
+LOWER_IS_BETTER = ["claim_p50", "claim_p95", "claim_p99", "head_loop_mean", "head_loop_p95",
+                   "statements_pr_job", "add_time", "list_jobs_time", "archive_time", "cleanup_time"]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StatementCounter:
+    """
+    Counts the statements a db instance runs. SQLite connections report every
+    statement they run, also the rows of executemany() and transaction
+    control, for MySQL the calls to _execute() are counted
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _add(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+    def attach(self, db):
+        if not hasattr(db, "_execute"):
+            return  # In memory, no statements
+        if hasattr(db, "_connection"):
+            traced = set()
+            connection = db._connection
+
+            def traced_connection():
+                conn = connection()
+                if id(conn) not in traced:
+                    conn.set_trace_callback(self._add)
+                    traced.add(id(conn))
+                return conn
+            db._connection = traced_connection
+        else:
+            execute = db._execute
+
+            def counted_execute(*args, **kwargs):
+                self._add()
+                return execute(*args, **kwargs)
+            db._execute = counted_execute
+
+
+class Backend:
+    """
+    Opens the head and worker db instances of a backend
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._dir = None
+        self._path = None
+        self.head = None
+
+    def open_head(self):
+        if self.name == "sqlite":
+            from CryoCloud.Common import jobdb_sqlite
+            self._dir = tempfile.mkdtemp(prefix="ccbenchmark")
+            self._path = os.path.join(self._dir, "jobdb.sqlite")
+            self.head = jobdb_sqlite.JobDB("ccbenchmark", None, auto_cleanup=False, path=self._path)
+        elif self.name == "queue":
+            from CryoCloud.Common import jobdb_queue
+            self.head = jobdb_queue.JobDB("ccbenchmark", None, auto_cleanup=False)
+        else:
+            self.head = jobdb.JobDB("ccbenchmark", None, auto_cleanup=False)
+            self.head.clear_jobs()
+        return self.head
+
+    def open_worker(self):
+        if self.name == "sqlite":
+            from CryoCloud.Common import jobdb_sqlite
+            return jobdb_sqlite.JobDB(None, None, path=self._path)
+        if self.name == "queue":
+            return self.head  # Only reachable in this process
+        return jobdb.JobDB(None, None)
+
+    def close(self):
+        if self.name == "mysql" and self.head:
+            self.head.clear_jobs()
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+        self.head = None
+
+
+class BenchmarkWorker(threading.Thread):
+    """
+    Claims up to max_jobs jobs at a time and completes them right away
+    """
+
+    def __init__(self, workerid, db, max_jobs, stop_event):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._workerid = workerid
+        self._db = db
+        self._max_jobs = max_jobs
+        self._stop_event = stop_event
+        self.claims = []  # Seconds pr claim that got jobs
+        self.empty_claims = 0
+        self.completed = 0
+
+    def run(self):
+        node = "%s.bench%d" % (socket.gethostname(), self._workerid)
+        while not self._stop_event.is_set():
+            t = time.time()
+            jobs = self._db.allocate_job(self._workerid, supportedmodules=["any"], node=node,
+                                         max_jobs=self._max_jobs)
+            if not jobs:
+                self.empty_claims += 1
+                self._db.wait_for_jobs(timeout=0.1)
+                continue
+            self.claims.append(time.time() - t)
+            for job in jobs:
+                self._db.queue_update(job["id"], jobdb.STATE_COMPLETED, retval={"ok": True})
+            self._db.commit_updates()
+            self.completed += len(jobs)
+
+
+def add_jobs(db, rnd, first, num, modules):
+    for taskid in range(first, first + num):
+        db.add_job(1, taskid, {"src": "/data/item%d" % taskid, "n": taskid},
+                   module=rnd.choice(modules), itemid=taskid,
+                   priority=rnd.choice([jobdb.PRI_LOW, jobdb.PRI_NORMAL, jobdb.PRI_HIGH]))
+
+
+def run_depth(options, depth):
+    """
+    Run one benchmark with depth jobs queued, returns the metrics
+    """
+    rnd = random.Random(options.seed)
+    modules = ["bench%d" % i for i in range(options.modules)]
+    backend = Backend(options.backend)
+    counter = StatementCounter()
+    stop_event = threading.Event()
+    try:
+        head = backend.open_head()
+        counter.attach(head)
+
+        # Fill the queue
+        t = time.time()
+        add_jobs(head, rnd, 1, depth, modules)
+        head.commit_jobs()
+        add_time = time.time() - t
+
+        workers = []
+        for i in range(options.workers):
+            db = backend.open_worker()
+            if db is not head:
+                counter.attach(db)
+            workers.append(BenchmarkWorker(i + 1, db, options.max_jobs, stop_event))
+        counter.reset()
+
+        start = time.time()
+        for w in workers:
+            w.start()
+
+        # The head loop, add a job for every completed one
+        cursor = 0
+        done = 0
+        next_taskid = depth + 1
+        loops = []
+        while done < options.jobs and time.time() - start < options.timeout:
+            t = time.time()
+            cursor, updates = head.get_updates(cursor)
+            completed = len([u for u in updates if u["state"] == jobdb.STATE_COMPLETED])
+            done += completed
+            if completed:
+                add_jobs(head, rnd, next_taskid, completed, modules)
+                next_taskid += completed
+                head.commit_jobs()
+            loops.append(time.time() - t)
+            time.sleep(options.head_interval)
+        elapsed = time.time() - start
+        stop_event.set()
+        for w in workers:
+            w.join(2.0)
+        statements = counter.count
+
+        t = time.time()
+        head.list_jobs()
+        list_jobs_time = time.time() - t
+        t = time.time()
+        if hasattr(head, "archive_jobs"):
+            head.archive_jobs(age=0)
+        archive_time = time.time() - t
+        t = time.time()
+        head.cleanup()
+        cleanup_time = time.time() - t
+
+        claims = []
+        for w in workers:
+            claims.extend(w.claims)
+        return {
+            "depth": depth,
+            "completed": done,
+            "elapsed": elapsed,
+            "timed_out": done < options.jobs,
+            "jobs_pr_sec": done / elapsed if elapsed else None,
+            "add_time": add_time,
+            "add_jobs_pr_sec": depth / add_time if add_time else None,
+            "claims": len(claims),
+            "empty_claims": sum([w.empty_claims for w in workers]),
+            "claim_p50": percentile(claims, 0.50),
+            "claim_p95": percentile(claims, 0.95),
+            "claim_p99": percentile(claims, 0.99),
+            "head_loops": len(loops),
+            "head_loop_mean": sum(loops) / len(loops) if loops else None,
+            "head_loop_p95": percentile(loops, 0.95),
+            "statements": statements if hasattr(head, "_execute") else None,
+            "statements_pr_job": statements / float(done) if done and hasattr(head, "_execute") else None,
+            "list_jobs_time": list_jobs_time,
+            "archive_time": archive_time,
+            "cleanup_time": cleanup_time
+        }
+    finally:
+        stop_event.set()
+        backend.close()
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print the relative change of every metric from the baseline run
+    """
+    old = {r["depth"]: r for r in baseline["results"]}
+    for r in results["results"]:
+        if r["depth"] not in old:
+            continue
+        print("Depth %d compared to %s:" % (r["depth"], baseline.get("revision") or baseline["started"]))
+        for key in ["jobs_pr_sec", "add_jobs_pr_sec"] + LOWER_IS_BETTER:
+            before, now = old[r["depth"]].get(key), r.get(key)
+            if not before or now is None:
+                continue
+            change = (now - before) / before
+            worse = change > 0 if key in LOWER_IS_BETTER else change < 0
+            print("  %-20s %12.6g -> %12.6g  %+7.1f%%%s" % (key, before, now, change * 100,
+                                                            "  WORSE" if worse and abs(change) > 0.1 else ""))
+
+
+def print_results(results):
+    print("%-8s %10s %10s %10s %10s %10s %10s" % ("depth", "jobs/s", "claim p50", "claim p95", "claim p99",
+                                                  "head loop", "stmt/job"))
+    for r in results["results"]:
+        def fmt(value, scale=1):
+            return "%10.4g" % (value * scale) if value is not None else "%10s" % "-"
+        print("%-8d %s %s %s %s %s %s" % (r["depth"], fmt(r["jobs_pr_sec"]), fmt(r["claim_p50"], 1000),
+                                          fmt(r["claim_p95"], 1000), fmt(r["claim_p99"], 1000),
+                                          fmt(r["head_loop_mean"], 1000), fmt(r["statements_pr_job"])))
+    print("(times in ms)")
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Benchmark job db throughput and latency")
+    parser.add_argument("-b", "--backend", dest="backend", default="sqlite", choices=["sqlite", "queue", "mysql"],
+                        help="Backend to benchmark, mysql uses the configured database (default sqlite)")
+    parser.add_argument("-n", "--num-workers", dest="workers", type=int, default=4,
+                        help="Number of workers claiming jobs (default 4)")
+    parser.add_argument("-d", "--depth", dest="depths", default="100,1000,10000",
+                        help="Comma separated list of queue depths to run at (default 100,1000,10000)")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=2000,
+                        help="Jobs to complete at each depth (default 2000)")
+    parser.add_argument("--max-jobs", dest="max_jobs", type=int, default=1,
+                        help="Jobs claimed at a time by each worker (default 1)")
+    parser.add_argument("--modules", dest="modules", type=int, default=4,
+                        help="Number of modules the jobs are spread over (default 4)")
+    parser.add_argument("--head-interval", dest="head_interval", type=float, default=0.05,
+                        help="Seconds between head loops (default 0.05)")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=600,
+                        help="Give up a depth after this many seconds (default 600)")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed for job modules and priorities (default 1)")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="Write results as JSON to this file (default stdout)")
+    parser.add_argument("--baseline", dest="baseline", default=None,
+                        help="Compare with the JSON results of an earlier run")
+
+    if "argcomplete" in sys.modules:
+        argcomplete.autocomplete(parser)
+    options = parser.parse_args()
+
+    try:
+        results = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": get_revision(),
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "options": vars(options),
+            "results": []
+        }
+        for depth in [int(d) for d in options.depths.split(",")]:
+            print("Running depth %d on %s with %d workers" % (depth, options.backend, options.workers),
+                  file=sys.stderr)
+            results["results"].append(run_depth(options, depth))
+
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print_results(results)
+        else:
+            print(json.dumps(results, indent=2))
+
+        if options.baseline:
+            with open(options.baseline, "r") as f:
+                compare(results, json.load(f))
+    finally:
+        API.shutdown()
@@ -18,6 +18,7 @@ import uuid
 import random
 import tempfile
 import hashlib
+import math
 
 from argparse import ArgumentParser
 try:
@@ -53,6 +54,38 @@ sys.path.append(stubdir)
 
 DEBUG = False
 
+# Estimated time left from a task is reused this many seconds for pebbles that have gotten
+# equally far, status polls would otherwise walk the graph every time
+ESTIMATE_CACHE_TIME = 10.0
+
+# Workflows with "speculative" set run split sub-jobs again on another node with a free
+# worker when they have run SPECULATE_FACTOR times the 95th percentile processing time of
+# the module, if at least SPECULATE_MIN_RUNS have finished. The first result is used and
+# the other job is cancelled. "speculative" can be a map with "factor" and "min_runs".
+SPECULATE_FACTOR = 1.5
+SPECULATE_MIN_RUNS = 20
+SPECULATE_INTERVAL = 30
+
+# Admission control. Workflows with "max_pebbles" keep at most that many pebbles from inputs
+# in flight, nodes with "max_pending" at most that many unfinished jobs of their module.
+# onAdd waits for room, input modules check handler.admit() to pause discovery. Job counts
+# are read from the database at most every ADMISSION_POLL seconds.
+ADMISSION_POLL = 1.0
+
+# Nodes with "gang" set keep the jobs of a split back until there are free workers for a
+# fraction of them (true is GANG_FRACTION), and then release them together. Gangs of the
+# same module are released in order, a gang is released anyway after GANG_MAX_WAIT seconds.
+GANG_FRACTION = 1.0
+GANG_MAX_WAIT = 600
+GANG_INTERVAL = 1.0
+
+# Jobs reserve cpus, memory and scratch space (MB) on the worker node while they run. Nodes
+# and modules can give "resources", otherwise memory is the 95th percentile of what the
+# module has used times RESOURCE_HEADROOM and cpus its average cpu time pr second, once at
+# least RESOURCE_MIN_RUNS jobs of the module have finished.
+RESOURCE_HEADROOM = 1.2
+RESOURCE_MIN_RUNS = 10
+
 global global_disable_cache
 global_disable_cache = False
 
@@ -137,6 +170,10 @@ class Task:
         self._downstreams = []
         self.priority = 50
         self.max_parallel = None
+        self.max_pending = None
+        self.gang = None
+        self.resources = None
+        self.max_retries = None
         self.type = "normal"
         self.args = {}
         self.runOn = "always"
@@ -163,8 +200,7 @@ class Task:
         self.is_input = False
         self.ccnode = []
         self.is_global = False
-        self._mp_unblocked = 0
-        self._mp_blocked = 0
+        self._mp_step = None  # The step max_parallel has been set for
         self.lock = threading.Lock()
         self.level = None
         self.runOnHead = False
@@ -172,6 +208,7 @@ class Task:
         self.pip = None
         self.serviceURL = None
         self.cache = False
+        self._estimates = {}
 
     def __str__(self):
         return "[%s (%s), %s, %s]: priority %d, args: %s\n" %\
@@ -338,6 +375,19 @@ class Task:
         """
         Estimate processing time from this node and down the graph
         """
+        progress = None
+        if pebble:
+            progress = (frozenset(pebble.retval_dict), frozenset(pebble._stop_on))
+        return self._estimate_time_left(jobdb, pebble, progress)
+
+    def _estimate_time_left(self, jobdb, pebble, progress):
+        now = time.time()
+        cached = self._estimates.get(progress)
+        if cached and now - cached[0] < ESTIMATE_CACHE_TIME:
+            return cached[1]
+        if len(self._estimates) > 1000:
+            self._estimates = {k: v for k, v in self._estimates.items() if now - v[0] < ESTIMATE_CACHE_TIME}
+
         run_time = 0
 
         # DB Lookup of typical time for this module
@@ -372,7 +422,7 @@ class Task:
             if pebble and node.name in pebble._stop_on:
                 continue  # These should not be run, no children will either
 
-            times = node.estimate_time_left(jobdb, pebble)
+            times = node._estimate_time_left(jobdb, pebble, progress)
             subnodes += times["time_left"]
             subnodes_parallel = max(subnodes_parallel, times["time_left_parallel"])
             subnodes_process_time = max(subnodes_process_time, times["process_time_left"])
@@ -384,6 +434,7 @@ class Task:
         info = {"runtime": run_time, "steptime": step_time,
                 "time_left": time_left, "time_left_parallel": time_left_parallel,
                 "process_time_left": process_time_left, "steps": steps}
+        self._estimates[progress] = (now, info)
         return info
 
     def get_max_priority(self):
@@ -408,6 +459,8 @@ class Workflow:
     handler = None
     description = None
     options = []
+    speculative = False
+    max_pebbles = None
     messages = {}
     message_callbacks = {}
     messages_completed = {}
@@ -459,6 +512,8 @@ class Workflow:
                 if "cache" in mod.ccmodule["defaults"]:
                     # Defaults
                     task.cache = mod.ccmodule["defaults"]["cache"]
+                if "resources" in mod.ccmodule["defaults"]:
+                    task.resources = dict(mod.ccmodule["defaults"]["resources"])
 
             if "pip" in mod.ccmodule:
                 task.pip = mod.ccmodule["pip"]
@@ -480,6 +535,20 @@ class Workflow:
                 task.priority = int(child["priority"])
             if "max_parallel" in child:
                 task.max_parallel = int(child["max_parallel"])
+            if "max_pending" in child:
+                task.max_pending = int(child["max_pending"])
+            if "max_retries" in child:
+                task.max_retries = int(child["max_retries"])
+            if child.get("gang"):
+                task.gang = GANG_FRACTION if child["gang"] is True else float(child["gang"])
+                if task.max_parallel:
+                    raise Exception("Can't use gang and max_parallel for the same node")
+            if "resources" in child:
+                task.resources = dict(task.resources or {})
+                task.resources.update(child["resources"])
+                unknown = set(task.resources) - set(jobdb.RESOURCES)
+                if unknown:
+                    raise Exception("Unknown resources %s, use %s" % (list(unknown), jobdb.RESOURCES))
             if "provides" in child:
                 task.provides.extend(child["provides"])
             if "outputs" in child:
@@ -582,6 +651,10 @@ class Workflow:
             wf.description = workflow["description"]
         if "options" in workflow:
             wf.options = workflow["options"]
+        if "speculative" in workflow:
+            wf.speculative = workflow["speculative"]
+        if "max_pebbles" in workflow:
+            wf.max_pebbles = int(workflow["max_pebbles"])
 
         wf.handler = handler
         wf.entry = EntryTask(wf)
@@ -952,6 +1025,17 @@ class CryoCloudTask(Task):
         info["priority"] = self.priority
         info["workdir"] = self._map(self.dir, pebble, parent)
 
+        # Files from the parent are copied from where it ran, so prefer running there too
+        info["prefer_nodes"] = None
+        if not info["node"] and parent and parent.name in pebble.stats and \
+           any([isinstance(a, dict) and a.get("type") == "file" for a in self.args.values()]):
+            stats = pebble.stats[parent.name]
+            if isinstance(stats.get("nodes"), list):
+                nodes = stats["nodes"]
+            else:
+                nodes = [stats.get("node")]
+            info["prefer_nodes"] = [n for n in nodes if n and n != "localhost"] or None
+
         return info
 
     def _build_args(self, pebble, parent):
@@ -1207,11 +1291,31 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
         workflow.handler = self
         self._jobdb = _jobdb
         if not _jobdb:
-            self._jobdb = jobdb.JobDB("Ignored", self.workflow.name)
+            self._jobdb = jobdb.get_jobdb("Ignored", self.workflow.name)
         self.orders = {}  # Orders from interactive sources - let them resolve info here
         self.statusDB = None
         self._is_restricted = False
 
+        # Speculative re-execution, see _speculate()
+        self._spec_lock = threading.Lock()
+        self._running = {}  # taskid -> (started, job) of split sub-jobs
+        self._twins = {}  # taskid -> taskid of the other job, both ways
+        self._losers = set()  # taskids of jobs whose twin won
+        self._duplicates = set()  # taskids of the speculative jobs
+        self._speculation = {"launched": 0, "won": 0, "lost": 0, "wasted_time": 0.0}
+
+        # Admission control, see admit()
+        self._admission = threading.Condition()
+        self._admitted = set()  # gids of pebbles from inputs that are not cleaned up
+        self._pending_jobs = {}  # module -> (checked, unfinished jobs)
+        self._admission_waits = 0
+        self._head_thread = None  # Ident of the head thread, which must never wait, set in onReady()
+
+        # Gang scheduling of splits, see _release_gangs()
+        self._gang_lock = threading.Lock()
+        self._gangs = []  # Splits waiting to be released, in order
+        self._gangs_released = 0
+
     def get_pebble(self, pebbleid):
         if pebbleid in self._pebbles:
             return self._pebbles[pebbleid]
@@ -1242,6 +1346,7 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
         self.log = API.get_log(self.workflow.name)
         self.status = API.get_status(self.workflow.name)
         self.options = options
+        self._head_thread = threading.get_ident()  # The head calls us from its thread
 
         self._cleanup = []  # Pebbles that should be cleaned up (we do it lazily to ensure that we finish all tasks)
 
@@ -1257,6 +1362,224 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
         t = threading.Thread(target=self.workflow.entry.resolve)
         t.start()
 
+        if self.workflow.speculative:
+            t = threading.Thread(target=self._speculation_loop)
+            t.daemon = True
+            t.start()
+
+        if any([n.gang for n in self.workflow.nodes.values()]):
+            t = threading.Thread(target=self._gang_loop)
+            t.daemon = True
+            t.start()
+
+    def _speculation_loop(self):
+        while not API.api_stop_event.wait(SPECULATE_INTERVAL):
+            try:
+                self._speculate()
+            except:
+                self.log.exception("Speculative execution failed")
+
+    def _speculate(self):
+        """
+        Run split sub-jobs that have taken much longer than usual again on
+        another node with a free worker for the module
+        """
+        opts = self.workflow.speculative if isinstance(self.workflow.speculative, dict) else {}
+        factor = float(opts.get("factor", SPECULATE_FACTOR))
+        min_runs = int(opts.get("min_runs", SPECULATE_MIN_RUNS))
+        now = time.time()
+        with self._spec_lock:
+            candidates = [(started, job) for taskid, (started, job) in self._running.items()
+                          if taskid not in self._twins and taskid not in self._losers]
+        nodes = None
+        for started, job in candidates:
+            pebble = self.get_pebble(job["itemid"])
+            if not pebble or job["taskid"] not in pebble.nodename:
+                with self._spec_lock:
+                    self._running.pop(job["taskid"], None)  # Cleaned up
+                continue
+            name = pebble.nodename[job["taskid"]]
+            estimate = self._jobdb.estimate_resources(name)
+            if not estimate or estimate["runs"] < min_runs or not estimate.get("processtime_p95"):
+                continue
+            if now - started < factor * estimate["processtime_p95"]:
+                continue
+
+            if nodes is None:
+                nodes = self._jobdb.get_nodes(seen_since_sec=60)
+            target = self._idle_node(nodes, job)
+            if not target:
+                continue
+            taskid = _genrandom()
+            pebble.nodename[taskid] = name
+            with self._spec_lock:
+                self._twins[taskid] = job["taskid"]
+                self._twins[job["taskid"]] = taskid
+                self._duplicates.add(taskid)
+            self.log.info("%s job %s has run for %d seconds (p95 %d), running it on %s too" %
+                          (name, job["taskid"], now - started, estimate["processtime_p95"], target))
+            self.head.add_job(job["step"], taskid, job["args"], module=job["module"], jobtype=job["type"],
+                              itemid=job["itemid"], workdir=job["workdir"], priority=job["priority"],
+                              node=target, resources=job.get("resources"),
+                              isblocked=jobdb.BLOCKED_PARALLEL if self.workflow.nodes[name].max_parallel else 0)
+            self._count_speculation("launched")
+
+    @staticmethod
+    def _idle_node(nodes, job):
+        """
+        A node other than the one running job with a free worker for it
+        """
+        for name, info in nodes.items():
+            if name == job["node"]:
+                continue
+            slots = info["types"].get(job["type"])
+            if not slots or slots["free"] < 1:
+                continue
+            modules = info["modules"].get(job["type"], set())
+            if "any" not in modules and job["module"] not in modules:
+                continue
+            slots["free"] -= 1  # Don't pick it twice in one round
+            return name
+        return None
+
+    def _gang_loop(self):
+        while not API.api_stop_event.wait(GANG_INTERVAL):
+            try:
+                self._release_gangs()
+            except:
+                self.log.exception("Releasing gangs failed")
+
+    @staticmethod
+    def _free_slots(nodes, module, jobtype):
+        """
+        Free and total workers of the given type for a module
+        """
+        free = total = 0
+        for info in nodes.values():
+            slots = info["types"].get(jobtype)
+            modules = info["modules"].get(jobtype, set())
+            if slots and ("any" in modules or module in modules):
+                free += slots["free"]
+                total += slots["slots"]
+        return free, total
+
+    def _release_gangs(self):
+        """
+        Release waiting gangs when there are enough free workers for them,
+        so the jobs of a split run at the same time instead of interleaving
+        with other work
+        """
+        with self._gang_lock:
+            if not self._gangs:
+                return
+            nodes = self._jobdb.get_nodes(60)
+            free = {}
+            waiting = []
+            for gang in self._gangs:
+                key = (gang["module"], gang["type"])
+                if key in waiting:
+                    continue  # An earlier gang of the module is waiting
+                if key not in free:
+                    free[key] = self._free_slots(nodes, gang["module"], gang["type"])
+                slots, total = free[key]
+                need = min(math.ceil(gang["fraction"] * len(gang["taskids"])), total)
+                waited = time.time() - gang["added"]
+                if nodes and slots < need and waited < GANG_MAX_WAIT:
+                    waiting.append(key)
+                    continue
+                gang["released"] = self._jobdb.release_gang(gang["taskids"])
+                free[key] = (slots - len(gang["taskids"]), total)
+                self._gangs_released += 1
+                self.status["gang.released"] = self._gangs_released
+                self.status["gang.wait"] = waited
+                self.log.debug("Released gang of %d jobs of %s after %.1f seconds" %
+                               (len(gang["taskids"]), gang["module"], waited))
+            self._gangs = [g for g in self._gangs if "released" not in g]
+            self.status["gang.waiting"] = len(self._gangs)
+
+    def _count_speculation(self, what, value=1):
+        with self._spec_lock:
+            self._speculation[what] += value
+            value = self._speculation[what]
+        self.status["speculative.%s" % what] = value
+
+    def _track_running(self, task, node):
+        if self.workflow.speculative and self.workflow.nodes[node].splitOn:
+            with self._spec_lock:
+                self._running[task["taskid"]] = (time.time() - task.get("runtime", 0), task)
+
+    def _is_speculation_loser(self, task, completed):
+        """
+        Called when a job has finished. True if its result should be ignored,
+        as its twin completed first or is still running. The first of two
+        twins to complete wins and the other is cancelled
+        """
+        with self._spec_lock:
+            started = self._running.pop(task["taskid"], (None,))[0]
+            duplicate = task["taskid"] in self._duplicates
+            self._duplicates.discard(task["taskid"])
+            if task["taskid"] in self._losers:
+                self._losers.remove(task["taskid"])
+                loser = True
+            else:
+                twin = self._twins.pop(task["taskid"], None)
+                if twin is None:
+                    return False
+                del self._twins[twin]
+                loser = not completed
+                if completed:
+                    self._losers.add(twin)
+
+        if loser:
+            if started:
+                self._count_speculation("wasted_time", time.time() - started)
+            return True
+
+        self._jobdb.cancel_job_by_taskid(twin)
+        self._count_speculation("won" if duplicate else "lost")
+        return False
+
+    def admit(self, caller=None):
+        """
+        True if the limits of the workflow allow another pebble
+        """
+        if self.workflow.max_pebbles and len(self._admitted) >= self.workflow.max_pebbles:
+            return False
+        for node in list(self.workflow.nodes.values()):
+            if node.max_pending and self._num_pending_jobs(node.module) >= node.max_pending:
+                return False
+        return True
+
+    def _num_pending_jobs(self, module):
+        checked, num = self._pending_jobs.get(module, (0, 0))
+        if time.time() - checked > ADMISSION_POLL:
+            num = self._jobdb.num_pending_jobs(module)
+            self._pending_jobs[module] = (time.time(), num)
+        return num
+
+    def _admit_pebble(self, pebble):
+        """
+        Wait until the limits allow the pebble, then count it as in flight
+        """
+        waiting = False
+        with self._admission:
+            while not self.admit() and not API.api_stop_event.is_set():
+                if threading.get_ident() == self._head_thread:
+                    # Waiting here would stop pebbles from completing
+                    self.log.warning("Admission limits reached, but can't wait on the head thread")
+                    break
+                if not waiting:
+                    waiting = True
+                    self._admission_waits += 1
+                    self.status["admission.waits"] = self._admission_waits
+                    self.status["admission.paused"] = True
+                    self.log.info("Admission limits reached, waiting")
+                self._admission.wait(ADMISSION_POLL)
+            self._admitted.add(pebble.gid)
+            self.status["admission.in_flight"] = len(self._admitted)
+        if waiting:
+            self.status["admission.paused"] = False
+
     def onCleanup(self):
         while len(self._cleanup) > 0:
             pbl = self._cleanup.pop(0)
@@ -1330,6 +1653,7 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             time.sleep(0.1)
 
         print("CREATED PEBBLE", pebble)
+        self._admit_pebble(pebble)
         # self._jobdb.update_profile(pebble.gid, self.workflow.name, product=self.workflow.name, type=0)  # The whole job
 
         pebble.resolved.append(task["caller"])
@@ -1395,7 +1719,8 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
         return _cacheargs
 
     def _addJob(self, n, lvl, taskid, args, module, jobtype,
-                itemid, workdir, priority, node, parent=None, log_prefix=None):
+                itemid, workdir, priority, node, parent=None, log_prefix=None, prefer_nodes=None,
+                gang=False):
 
         self.log.debug("_addJob %s, prefix: %s" % (json.dumps(args), log_prefix))
 
@@ -1422,14 +1747,14 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
 
         blocked = 0
         if n.max_parallel:
-            # We must ensure that we don't go OVER this
+            # The job db hands out the slots as workers claim jobs
             with n.lock:
-                # print("ADDING %s Unblocked: %s, max parallel %s" % (lvl, n._mp_unblocked, n.max_parallel))
-                if n._mp_unblocked < n.max_parallel:
-                    n._mp_unblocked += 1
-                else:
-                    n._mp_blocked += 1
-                    blocked = 1
+                if n._mp_step != lvl:
+                    self._jobdb.set_max_parallel(lvl, n.max_parallel)
+                    n._mp_step = lvl
+            blocked = jobdb.BLOCKED_PARALLEL
+        if gang:
+            blocked = jobdb.BLOCKED_GANG
 
         if self.options.kubernetes:
             print("Checking if we have workers")
@@ -1468,10 +1793,31 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
         if global_disable_cache:
             args["__nocache__"] = true
 
+        # Jobs are added when their upstreams have completed, not up front with
+        # depends (see jobdb.add_job()): runIf, runOn, splitOn, merges and the
+        # pebble's progress need the results here before the next job exists
         return self.head.add_job(lvl, taskid, args, module=module, jobtype=jobtype,
                                  itemid=itemid, workdir=workdir,
                                  priority=priority,
-                                 node=node, isblocked=blocked)
+                                 node=node, isblocked=blocked, prefer_nodes=prefer_nodes,
+                                 resources=self._job_resources(n, module), max_retries=n.max_retries)
+
+    def _job_resources(self, n, module):
+        """
+        What a job of node n reserves on a worker node, as given for the node
+        or module, or else what jobs of the module have used so far
+        """
+        if n.resources:
+            return n.resources
+        estimate = self._jobdb.estimate_resources(module)
+        if not estimate or estimate["runs"] < RESOURCE_MIN_RUNS:
+            return None
+        resources = {}
+        if estimate.get("memory_max_p95"):
+            resources["memory"] = int(estimate["memory_max_p95"] * RESOURCE_HEADROOM / (1024 * 1024))
+        if estimate.get("cpu_time") and estimate.get("processtime"):
+            resources["cpus"] = max(1, int(round(estimate["cpu_time"] / estimate["processtime"])))
+        return resources
 
     def _addTask(self, node, args, runtime_info, pebble, parent):
         if node.taskid not in self._levels:
@@ -1570,6 +1916,7 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             pebble._num_subtasks = len(origargs)
             pebble._sub_tasks = {}
             log_prefix = pebble.gid
+            gang = []
             for x in range(len(origargs)):
                 args[node.splitOn] = origargs[x]
                 self._updateProgress(pebble, lvl, {"total": 1, "queued": 1, "pending": 1})
@@ -1591,7 +1938,8 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
                                      itemid=subpebble.gid, workdir=runtime_info["workdir"],
                                      priority=runtime_info["priority"],
                                      node=runtime_info["node"], parent=parent,
-                                     log_prefix=pebble.gid)
+                                     prefer_nodes=runtime_info["prefer_nodes"],
+                                     log_prefix=pebble.gid, gang=bool(node.gang))
                     subpebble.jobid = i
                 else:
                     pebble._sub_tasks[x] = pebble.gid
@@ -1601,8 +1949,14 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
                                      itemid=pebble.gid, workdir=runtime_info["workdir"],
                                      priority=runtime_info["priority"],
                                      node=runtime_info["node"], parent=parent,
-                                     log_prefix=pebble.gid)
+                                     prefer_nodes=runtime_info["prefer_nodes"],
+                                     log_prefix=pebble.gid, gang=bool(node.gang))
                     pebble.jobid = i
+                gang.append(taskid)
+            if node.gang and gang:
+                with self._gang_lock:
+                    self._gangs.append({"taskids": gang, "module": mod, "type": jobt,
+                                        "fraction": node.gang, "added": time.time()})
             if not node.name.startswith("_"):
                 self.status["%s.pending" % node.name].inc(len(origargs))
             return
@@ -1622,6 +1976,7 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
                          itemid=pebble.gid, workdir=runtime_info["workdir"],
                          priority=runtime_info["priority"],
                          node=runtime_info["node"], parent=parent,
+                         prefer_nodes=runtime_info["prefer_nodes"],
                          log_prefix=pebble.gid)
         pebble.jobid = i
         # pebble._sub_pebbles[i] = {"x": None, "y": None, "node": node, "done": False}
@@ -1649,6 +2004,11 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             return
 
         pebble = self._pebbles[task["itemid"]]
+        self._track_running(task, pebble.nodename[task["taskid"]])
+        with self._spec_lock:
+            if task["taskid"] in self._duplicates:
+                return  # The job it duplicates is already counted
+
         self._updateProgress(pebble, task["step"], {"queued": -1, "allocated": 1, "pending": -1})
 
         if not task["node"] in pebble._involved_nodes:
@@ -1664,28 +2024,6 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
                                    worker=task["worker"],
                                    node=task["node"])
 
-    def _unblock_step(self, node):
-        unblock = None
-        n = self.workflow.nodes[node]
-        if n._mp_unblocked > 0:
-            n._mp_unblocked -= 1
-
-        with n.lock:
-            if n._mp_blocked > 0:
-                # n._mp_blocked -= 1
-                unblock = self._levels.index(n.taskid) + 1
-            # if n.max_parallel:
-            #    n._mp_unblocked += 1  # One task is done
-
-        if unblock:
-            # print("max_parallel is", n.max_parallel, "unblocked is now", n._mp_unblocked, "blocked is", n._mp_blocked)
-            b = self._jobdb.unblock_step(unblock, max_parallel=n.max_parallel)
-            n._mp_unblocked += b
-            n._mp_blocked -= b
-            # print("* unblock", n.max_parallel, "unblocked is now", n._mp_unblocked, "blocked is", n._mp_blocked)
-
-        return 0
-
     def onCompleted(self, task):
 
         if "itemid" not in task:
@@ -1700,13 +2038,13 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
                 self.log.error("Got completed task for unknown Pebble %s" % task)
             return
 
+        if self._is_speculation_loser(task, True):
+            return
+
         pebble = self._pebbles[task["itemid"]]
         node = pebble.nodename[task["taskid"]]
         self._updateProgress(pebble, task["step"], {"allocated": -1, "completed": 1})
 
-        # If we have any blocked processes at this level, unblock ASAP
-        self._unblock_step(node)
-
         if not pebble.nodename[task["taskid"]].startswith("_"):
             self.status["%s.processing" % pebble.nodename[task["taskid"]]].dec()
 
@@ -1720,6 +2058,15 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             "priority": task["priority"]
         }
 
+        # Did we get to run where the input data was?
+        if task.get("prefer_nodes"):
+            pebble.stats[node]["local"] = task["node"] in task["prefer_nodes"]
+            if not node.startswith("_"):
+                if pebble.stats[node]["local"]:
+                    self.status["%s.local" % node].inc()
+                else:
+                    self.status["%s.remote" % node].inc()
+
         for i, nick in [("runtime", "runtime"), ("cpu_time", "cpu"), ("max_memory", "mem")]:
             if nick in task:
                 pebble.stats[node][i] = task[nick]
@@ -1938,6 +2285,11 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             if pebble.gid in self._pebbles:
                 del self._pebbles[pebble.gid]
 
+            with self._admission:
+                self._admitted.discard(pebble.gid)
+                self.status["admission.in_flight"] = len(self._admitted)
+                self._admission.notify_all()
+
     def onError(self, task):
 
         # print("*** ERROR", task)
@@ -1951,6 +2303,9 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             # self.log.error("Got error task for unknown Pebble %s" % task)
             return
 
+        if self._is_speculation_loser(task, False):
+            return
+
         pebble = self._pebbles[task["itemid"]]
 
         self._updateProgress(pebble, task["step"], {"allocated": -1, "failed": 1})
@@ -1961,14 +2316,14 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             parent = self._pebbles[pebble._master_task]
             for p in parent._sub_tasks.values():
                 self._jobdb.cancel_job_by_taskid(self._pebbles[p].jobid)
+                twin = self._twins.get(self._pebbles[p].jobid)
+                if twin:
+                    self._jobdb.cancel_job_by_taskid(twin)
 
         node = pebble.nodename[task["taskid"]]
         if not node.startswith("_"):
             self.status["%s.failed" % node].inc()
 
-        # If we have any blocked processes at this level, unblock ASAP
-        self._unblock_step(node)
-
         # Add the results
         # node = pebble._sub_pebbles[task["taskid"]]["node"]
         if "error" not in task["retval"]:
@@ -2031,12 +2386,12 @@ class WorkflowHandler(CryoCloud.DefaultHandler):
             # Expected if cleaned up
             return
 
+        if self._is_speculation_loser(task, False):
+            return
+
         pebble = self._pebbles[task["itemid"]]
         node = pebble.nodename[task["taskid"]]
 
-        # If we have any blocked processes at this level, unblock ASAP
-        self._unblock_step(node)
-
         if not node.startswith("_"):
             self.status["%s.failed" % node].inc()
 
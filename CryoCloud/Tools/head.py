@@ -126,7 +126,7 @@ class HeadNode(threading.Thread):
 
     def makeDirectoryWatcher(self, directory, onAdd=None, onModify=None,
                              onRemove=None, onError=None, onIdle=None,
-                             stabilize=5, recursive=True):
+                             stabilize=5, recursive=True, admit=None):
             return CryoCloud.Common.DirectoryWatcher(self._jobdb._actual_runname,
                                                      directory,
                                                      onAdd=onAdd,
@@ -135,20 +135,22 @@ class HeadNode(threading.Thread):
                                                      onError=onError,
                                                      onIdle=onIdle,
                                                      stabilize=stabilize,
-                                                     recursive=recursive)
+                                                     recursive=recursive,
+                                                     admit=admit)
 
-    def makeNetWatcher(self, port, onAdd=None, onError=None, schema=None):
+    def makeNetWatcher(self, port, onAdd=None, onError=None, schema=None, admit=None):
             if schema is None:
                 print("*** WARNING: NetWatcher made without schema, REALLY should have one")
             return CryoCloud.Common.NetWatcher(port,
                                                onAdd=onAdd,
                                                onError=onError,
                                                schema=schema,
-                                               stop_event=API.api_stop_event)
+                                               stop_event=API.api_stop_event,
+                                               admit=admit)
 
     def add_job(self, step, taskid, args, jobtype=jobdb.TYPE_NORMAL, priority=jobdb.PRI_NORMAL,
                 node=None, expire_time=None, module=None, modulepath=None, workdir=None, itemid=None,
-                isblocked=0):
+                isblocked=0, prefer_nodes=None, depends=None, resources=None, max_retries=None):
         if 0:
             # FAKE COMPLETED IMMEDIATELY
             job = {
@@ -172,7 +174,9 @@ class HeadNode(threading.Thread):
             expire_time = self.options.max_task_time
         tid = self._jobdb.add_job(step, taskid, args, expire_time=expire_time, module=module, node=node,
                                   priority=priority, modulepath=modulepath, workdir=workdir,
-                                  jobtype=jobtype, itemid=itemid, isblocked=isblocked)
+                                  jobtype=jobtype, itemid=itemid, isblocked=isblocked,
+                                  prefer_nodes=prefer_nodes, depends=depends, resources=resources,
+                                  max_retries=max_retries)
         self._pending.append(tid)
         # if self.options.steps > 0 and self.options.tasks > 0:
         #     if step > self.status["progress"].size[0]:
@@ -220,7 +224,7 @@ class HeadNode(threading.Thread):
         self.status["eta_total"] = 0
 
         if not self._jobdb:
-            self._jobdb = jobdb.JobDB(self.options.name, self.options.module, auto_cleanup=True)
+            self._jobdb = jobdb.get_jobdb(self.options.name, self.options.module, auto_cleanup=True)
         self.update_profile = self._jobdb.update_profile
 
         # TODO: Option for this (and for clear_jobs on cleanup)?
@@ -242,11 +246,11 @@ class HeadNode(threading.Thread):
         # print("Progress status parameter thingy with size", self.options.steps, "x", self.options.tasks)
         self.start_step(1)
         failed = False
+        cursor = 0  # Position in the job change log, it's a new run
         while not API.api_stop_event.is_set():
             try:
                 # Wait for all tasks to complete
                 # TODO: Add timeouts to re-queue tasks that were incomplete
-                last_run = 0
                 notified = False
                 while not API.api_stop_event.is_set():
                     # Any queued new jobs we should deliver?
@@ -261,9 +265,8 @@ class HeadNode(threading.Thread):
                             self.handler.onCleanup()
                             break
 
-                    updates = self._jobdb.list_jobs(since=last_run, notstate=jobdb.STATE_PENDING)
+                    updates = self._jobdb.get_updates(cursor)[1]
                     for job in updates:
-                        last_run = job["tschange"]  # Just in case, we seem to get some strange things here
                         if job["state"] == jobdb.STATE_ALLOCATED:
                             # self.status["progress"].set_value((job["step"] - 1, job["taskid"]), 3)
                             if job["taskid"] in self._pending:
@@ -305,6 +308,7 @@ class HeadNode(threading.Thread):
                                 self.handler.onAllocated(job)
                             # self.status["progress"].set_value((job["step"] - 1, job["taskid"]), 0)
                             self.handler.onTimeout(job)
+                        cursor = job["seq"]  # Handled
 
                     # Still incomplete jobs?
                     if 0:  # Disabled onstepcompleted - it's confusing
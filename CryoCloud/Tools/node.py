@@ -11,8 +11,8 @@ import re
 import json
 import signal
 import copy
+import tempfile
 
-import datetime
 from urllib.parse import urlparse
 
 try:
@@ -33,7 +33,7 @@ except:
 
 
 from CryoCore import API
-from CryoCloud.Common import jobdb, fileprep, MicroService
+from CryoCloud.Common import jobdb, fileprep, MicroService, noderegistry
 from CryoCloud.Common.cache import CryoCache
 
 import multiprocessing
@@ -44,6 +44,20 @@ DEBUG = False
 
 modules = {}
 
+# Workers of each type are numbered from 0, so they claim and hold jobs with a worker id
+# that is unique on the node, see worker_id()
+WORKERID_TYPE_STEP = 1000
+
+# Jobs prefetched by the node are claimed with this worker id, and get the id of the
+# worker they are handed to
+PREFETCH_WORKERID = 65000
+
+# Prefetched jobs not handed to a worker within this many seconds go back to the pool
+PREFETCH_LEASE = 30.0
+
+# Idle workers get an empty answer after this many seconds, so they can report in
+PREFETCH_IDLE_TIME = 5.0
+
 CC_DIR = os.getcwd()
 if "CC_DIR" in os.environ:
     CC_DIR = os.environ["CC_DIR"]
@@ -51,6 +65,29 @@ else:
     print("Missing CC_DIR, assuming", CC_DIR)
 
 
+# Jobs that fail with these errors are retried later if they have retries left (see
+# jobdb.MAX_RETRIES), as are errors with a true "retryable" attribute. Errors from
+# libraries that are not necessarily installed are recognized by name, and S3 by code.
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, EOFError)
+RETRYABLE_NAMES = ["ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout",  # requests
+                   "EndpointConnectionError", "ConnectTimeoutError", "ReadTimeoutError", "ConnectionClosedError"]
+RETRYABLE_S3_CODES = ["SlowDown", "ServiceUnavailable", "InternalError", "RequestTimeout", "Throttling"]
+
+
+def is_retryable(e):
+    """
+    Is the error a job failed with likely to go away if it is run again
+    """
+    if hasattr(e, "retryable"):
+        return bool(e.retryable)
+    if isinstance(e, RETRYABLE_ERRORS) or type(e).__name__ in RETRYABLE_NAMES:
+        return True
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in RETRYABLE_S3_CODES
+    return False
+
+
 def get_default_paths():
     return [
         os.path.join(CC_DIR, "CryoCloud/Modules/"),
@@ -184,10 +221,95 @@ def detect_modules(paths=[], modules=None, exceptmodules=[], testload=True):
     return mods
 
 
+class ResourceBudget:
+    """
+    What is left of the cpus, memory and scratch space (MB) of the node,
+    shared by its workers. Jobs reserve what they request (see
+    jobdb.add_job()) while they run
+    """
+
+    def __init__(self, cpus, memory, scratch):
+        self._lock = multiprocessing.Lock()
+        self._left = {}
+        for resource, total in zip(jobdb.RESOURCES, [cpus, memory, scratch]):
+            self._left[resource] = multiprocessing.Value("q", int(total), lock=False)
+
+    def available(self):
+        with self._lock:
+            return {r: v.value for r, v in self._left.items()}
+
+    @staticmethod
+    def _requests(job):
+        req = job.get("resources") or {}
+        return {r: int(req.get(r) or 0) for r in jobdb.RESOURCES}
+
+    def reserve(self, job):
+        """
+        Reserve what the job needs, False if it doesn't fit
+        """
+        req = self._requests(job)
+        with self._lock:
+            if any([req[r] > self._left[r].value for r in req]):
+                return False
+            for r in req:
+                self._left[r].value -= req[r]
+        return True
+
+    def release(self, job):
+        req = self._requests(job)
+        with self._lock:
+            for r in req:
+                self._left[r].value += req[r]
+
+
+class LeaseRenewer(threading.Thread):
+    """
+    Renews the leases of the jobs a worker or prefetcher holds every quarter
+    lease time, from when they are claimed until they are done or given back.
+    Jobs that wait their turn or have files prepared for a long time are then
+    not timed out and claimed by someone else meanwhile
+    """
+
+    def __init__(self, db, log):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._jobdb = db
+        self.log = log
+        self._jobids = set()
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add(self, jobids):
+        with self._lock:
+            self._jobids.update(jobids)
+
+    def remove(self, jobids):
+        with self._lock:
+            self._jobids.difference_update(jobids)
+
+    def stop(self):
+        self._done.set()
+
+    def run(self):
+        while not self._done.wait(self._jobdb.lease_time / 4):
+            with self._lock:
+                jobids = list(self._jobids)
+            if not jobids:
+                continue
+            try:
+                self._jobdb.renew_leases(jobids)
+            except:
+                self.log.exception("Failed to renew leases of jobs %s" % jobids)
+
+
+def worker_id(jobtype, workernum):
+    return jobtype * WORKERID_TYPE_STEP + workernum
+
+
 class Worker(multiprocessing.Process):
 
     def __init__(self, workernum, stopevent, type=jobdb.TYPE_NORMAL, module_paths=[], modules=[], name=None,
-                 options=None, softstopevent=None, _jobdb=None):
+                 options=None, softstopevent=None, _jobdb=None, prefetch=None, budget=None):
         super(Worker, self).__init__(daemon=True)
         API.api_auto_init = False  # Faster startup
 
@@ -199,6 +321,7 @@ class Worker(multiprocessing.Process):
             self._softstopevent = softstopevent
         self._manager = None
         self.workernum = workernum
+        self.workerid = worker_id(type, workernum)
         self._name = None
         self._jobid = None
         self.module = None
@@ -210,7 +333,12 @@ class Worker(multiprocessing.Process):
         self._type = type
         self._module = None
         self._jobdb = _jobdb
+        self._prefetch = prefetch
+        self._budget = budget
         self._modules = modules
+        self._leases = None
+        self._holder = None
+        self.busy = multiprocessing.Value("b", 0)  # Read by the node controller for its heartbeats
         self._module_paths = module_paths
         self.options = options
         self._cache = CryoCache()
@@ -437,21 +565,26 @@ class Worker(multiprocessing.Process):
         self.log = API.get_log(self.wid)
         self.status = API.get_status(self.wid)
         if not self._jobdb:
-            self._jobdb = jobdb.JobDB(None, None)
+            self._jobdb = jobdb.get_jobdb(None, None)
+        # Our updates are ignored if the jobs were timed out and claimed again
+        self._holder = (self.workerid, socket.gethostname())
+        self._leases = LeaseRenewer(self._jobdb, self.log)
+        self._leases.start()
         self.status["state"].set_expire_time(600)
         self.cfg = API.get_config("CryoCloud.Worker")
         self.cfg.set_default("datadir", "/")
         self.cfg.set_default("tempdir", "/tmp")
 
         last_reported = 0  # We force periodic updates of state as we might be idle for a long time
-        last_job_time = None
         jobs_executed = 0
+        jobs = []
         while not self._softstopevent.is_set() and not self._stop_event.is_set():
             if self.options:
                 if self.options.maxruns and self.options.maxruns >= jobs_executed:
                     self._stop_event.set()
                     continue
 
+            unprocessed = []  # Jobs of this round still reserved in the budget
             try:
                 if self._type == jobdb.TYPE_ADMIN:
                     max_jobs = 5
@@ -460,27 +593,47 @@ class Worker(multiprocessing.Process):
                 prefermodule = None
                 if self._current_job:
                     prefermodule = self._current_job[0]
-                jobs = self._jobdb.allocate_job(self.workernum, node=socket.gethostname(),
-                                                supportedmodules=self._modules, max_jobs=max_jobs,
-                                                type=self._type, prefermodule=prefermodule)
+                if self._prefetch:
+                    # The node claims for us, and waits for jobs too. They are reserved in the budget
+                    jobs = self._prefetch.get_jobs(max_jobs, prefermodule)
+                else:
+                    jobs = self._jobdb.allocate_job(self.workerid, node=socket.gethostname(),
+                                                    supportedmodules=self._modules, max_jobs=max_jobs,
+                                                    type=self._type, prefermodule=prefermodule,
+                                                    budget=self._budget.available() if self._budget else None)
+                    if self._budget:
+                        # Each job fits, but maybe not together or with what other workers just got
+                        fits = [job for job in jobs if self._budget.reserve(job)]
+                        if len(fits) < len(jobs):
+                            self._jobdb.release_jobs([job["id"] for job in jobs if job not in fits])
+                        jobs = fits
                 if len(jobs) == 0:
-                    self._jobdb.update_worker(self.wid, json.dumps(self._modules), last_job_time)
-
-                    time.sleep(2.5)
+                    # Sleep until we're told there are new jobs (or poll again)
+                    if not self._prefetch:
+                        self._jobdb.wait_for_jobs(type=self._type)
                     if last_reported + 300 > time.time():
                         self.status["state"] = "Idle"
                     else:
                         self.status["state"].set_value("Idle", force_update=True)
                         last_reported = time.time()
                     continue
+                self._leases.add([job["id"] for job in jobs])
+                if self._budget:
+                    unprocessed = list(jobs)
                 jobs_executed += len(jobs)
                 self.log.debug("Got %d jobs" % len(jobs))
+                self.busy.value = 1
                 for job in jobs:
-                    last_job_time = datetime.datetime.utcnow()
                     self.status["current_job"] = job["id"]
                     self._job_in_progress = job
                     self._switchJob(job)
                     if not self._is_ready:
+                        # Give it back rather than have it sit out its lease
+                        self._leases.remove([job["id"]])
+                        self._jobdb.release_jobs([job["id"]])
+                        if job in unprocessed:
+                            unprocessed.remove(job)
+                            self._budget.release(job)
                         time.sleep(0.1)
                         continue
 
@@ -494,7 +647,12 @@ class Worker(multiprocessing.Process):
                     else:
                         loop = None
                     
-                    self._process_task(job, loop)
+                    try:
+                        self._process_task(job, loop)
+                    finally:
+                        if job in unprocessed:
+                            unprocessed.remove(job)
+                            self._budget.release(job)
 
 
             except Empty:
@@ -506,7 +664,7 @@ class Worker(multiprocessing.Process):
             except ImportError as e:
                 ret = {"error": "Failed due to import error: %s" % e}
                 try:
-                    self._jobdb.update_job(job["id"], jobdb.STATE_FAILED, retval=ret)
+                    self._jobdb.update_job(job["id"], jobdb.STATE_FAILED, retval=ret, holder=self._holder)
                 except:
                     self.log.exception("Failed to update job after import error")
             except Exception as e:
@@ -515,18 +673,20 @@ class Worker(multiprocessing.Process):
                 self.status["state"] = "Error (DB?)"
                 ret = {"error": "Unexpected exception: %s" % str(e)}
                 try:
-                    self._jobdb.update_job(job["id"], jobdb.STATE_FAILED, retval=ret)
+                    self._jobdb.update_job(job["id"], jobdb.STATE_FAILED, retval=ret, holder=self._holder)
                 except:
                     self.log.exception("Failed to update job after unknown error")
                 time.sleep(5)
                 continue
             finally:
+                # Done with them, or they are left to time out
+                self._leases.remove([job["id"] for job in jobs])
+                for job in unprocessed:
+                    self._budget.release(job)
                 self._job_in_progress = None
+                self.busy.value = 0
 
-        try:
-            self._jobdb.remove_worker(self.wid)
-        except Exception as e:
-            print("Failed to remove worker:", e)
+        self._leases.stop()
         self._stop_event.set()
         # print(self._worker_type, self.wid, "stopping")
         # self._stop_event.set()
@@ -534,7 +694,8 @@ class Worker(multiprocessing.Process):
         self.status["state"] = "Stopped"
 
         # If we were not done we should update the DB
-        self._jobdb.force_stopped(self.workernum, node=socket.gethostname())
+        self._jobdb.flush()
+        self._jobdb.force_stopped(self.workerid, node=socket.gethostname())
 
         print(self._worker_type, self.wid, "stopped", self._softstopevent.is_set(), self._stop_event.is_set())
 
@@ -578,8 +739,8 @@ class Worker(multiprocessing.Process):
             if r:
                 self.status["progress"] = 100
                 self.status["last_processing_time"] = 0
-                self._jobdb.update_job(task["id"], jobdb.STATE_COMPLETED,
-                                       retval=r["retval"], cpu=0, memory=0)
+                self._jobdb.queue_update(task["id"], jobdb.STATE_COMPLETED, retval=r["retval"],
+                                         callback=self._update_failed, holder=self._holder)
                 task["state"] = "Stopped"
                 task["processing_time"] = 0
                 return
@@ -707,16 +868,18 @@ class Worker(multiprocessing.Process):
         stop_monitor = threading.Event()
 
         def monitor():
+            # The lease is renewed by self._leases from when we got the job
             while not self._stop_event.is_set() and not cancel_event.is_set() and not stop_monitor.is_set():
-                status = self._jobdb.get_job_state(task["id"])
-                if stop_monitor.is_set():
-                    break
-                if status == jobdb.STATE_CANCELLED:
-                    self.log.info("Cancelling job on request")
-                    cancel_event.set()
-                elif status is None:
-                    self.log.info("Cancelling job as it was removed from the job db")
-                    cancel_event.set()
+                if canStop:
+                    status = self._jobdb.get_job_state(task["id"])
+                    if stop_monitor.is_set():
+                        break
+                    if status == jobdb.STATE_CANCELLED:
+                        self.log.info("Cancelling job on request")
+                        cancel_event.set()
+                    elif status is None:
+                        self.log.info("Cancelling job as it was removed from the job db")
+                        cancel_event.set()
                 try:
                     self.max_memory = max(self.max_memory, proc.memory_info().rss)
                 except:
@@ -734,14 +897,14 @@ class Worker(multiprocessing.Process):
                     canStop = True
                     break
 
-        if canStop:
-            try:
-                monitor_thread = threading.Thread(target=monitor)
-                monitor_thread.daemon = True
-                monitor_thread.start()
-            except:
-                self.log.exception("Can't start monitoring thread, won't be able to abort")
+        try:
+            monitor_thread = threading.Thread(target=monitor)
+            monitor_thread.daemon = True
+            monitor_thread.start()
+        except:
+            self.log.exception("Can't start monitoring thread, won't be able to abort")
         ret = None
+        retry = False
         try:
             if self._module is None:
                 raise Exception("No module loaded, task was %s" % task)
@@ -811,6 +974,7 @@ class Worker(multiprocessing.Process):
             self.status["state"] = "Failed"
             if not ret:
                 ret = {"error": str(e)}
+            retry = is_retryable(e)
 
         try:
             my_cpu_time = proc.cpu_times().user + proc.cpu_times().system - cpu_time
@@ -835,13 +999,23 @@ class Worker(multiprocessing.Process):
 
         # Update to indicate we're done
         self._update_cache(task, ret)
-        self._jobdb.update_job(task["id"], new_state, retval=ret, cpu=my_cpu_time, memory=self.max_memory)
+        self._jobdb.queue_update(task["id"], new_state, retval=ret, cpu=my_cpu_time, memory=self.max_memory,
+                                 callback=self._update_failed, retry=retry, holder=self._holder)
 
         # Clean up thread
         if monitor_thread:
             stop_monitor.set()  # This should already be done, but be certain!
             monitor_thread.join()
 
+    def _update_failed(self, jobid, state):
+        """
+        Called if a finished job could not be updated in the job db
+        """
+        if state == jobdb.STATE_CANCELLED:
+            self.log.info("Job %s was cancelled while we were processing it" % jobid)
+        else:
+            self.log.error("Failed to update job %s, it is in state %s" % (jobid, state))
+
     def get_fprep(self):
         return fileprep.FilePrepare(self.cfg["datadir"], self.cfg["tempdir"])
 
@@ -891,6 +1065,197 @@ class Worker(multiprocessing.Process):
         return None
 
 
+class PrefetchClient:
+    """
+    A worker's end of a JobPrefetcher
+    """
+
+    def __init__(self, slot, requests, responses):
+        self._slot = slot
+        self._requests = requests
+        self._responses = responses
+
+    def get_jobs(self, max_jobs, prefermodule=None):
+        """
+        Ask the node for up to max_jobs jobs, returns an empty list if there
+        was nothing to do for PREFETCH_IDLE_TIME seconds
+        """
+        self._requests.put((self._slot, max_jobs, prefermodule))
+        try:
+            return self._responses.get(timeout=PREFETCH_IDLE_TIME * 4)
+        except Empty:
+            return []  # The prefetcher is gone
+
+
+class JobPrefetcher(threading.Thread):
+    """
+    Claims jobs for all local workers of one type in bulk, and hands them to
+    the workers when they ask. The node then makes one claim where it used to
+    make one pr worker, and a worker that finishes a job usually gets the next
+    one without waiting for the db.
+
+    A few jobs are kept in a buffer. The buffer grows when workers have to
+    wait for jobs and shrinks when buffered jobs are not used within
+    PREFETCH_LEASE seconds, in which case they are released back to the pool.
+    Jobs are only handed out when they fit in what is left of the node's
+    resource budget. Their leases are renewed while they are in the buffer,
+    and when they are handed out, which also records the worker they went to.
+    Slots are the numbers of the workers.
+    """
+
+    def __init__(self, jobtype, modules, num_workers, stop_event, budget=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._type = jobtype
+        self._modules = modules
+        self._stop_event = stop_event
+        self._budget = budget
+        self._requests = multiprocessing.Queue()
+        self._responses = [multiprocessing.Queue() for i in range(num_workers)]
+        self._max_buffer = num_workers
+        self._target = 1
+        self._buffer = []  # [(claimed, job)], best first
+        self._waiting = []  # [(slot, max_jobs, prefermodule, asked)]
+        self._last_empty = 0
+        self._jobdb = None
+        self._leases = None
+        self.log = None
+
+    def get_client(self, slot):
+        return PrefetchClient(slot, self._requests, self._responses[slot])
+
+    def run(self):
+        self.log = API.get_log("NodeController.Prefetch.%s" % jobdb.TASK_TYPE[self._type])
+        self._jobdb = jobdb.get_jobdb(None, None)
+        self._leases = LeaseRenewer(self._jobdb, self.log)
+        self._leases.start()
+        while not self._stop_event.is_set():
+            try:
+                self._read_requests()
+                self._claim()
+                self._serve()
+                self._expire()
+            except Exception:
+                self.log.exception("Prefetching failed")
+                time.sleep(1)
+
+        # Nothing more will be handed out
+        for slot, max_jobs, prefermodule, asked in self._waiting:
+            self._responses[slot].put([])
+        self._release([job for claimed, job in self._buffer])
+        self._leases.stop()
+
+    def _read_requests(self):
+        try:
+            self._waiting.append(self._requests.get(timeout=0.1 if self._waiting else 1.0) + (time.time(),))
+            while True:
+                self._waiting.append(self._requests.get_nowait() + (time.time(),))
+        except Empty:
+            pass
+
+    def _claim(self):
+        wanted = sum([w[1] for w in self._waiting])
+        need = wanted + self._target - len(self._buffer)
+        if need <= 0:
+            return
+        if self._last_empty and wanted == 0:
+            return  # Don't poll to fill the buffer when there is nothing to get
+        if self._last_empty:
+            if not self._jobdb.wait_for_jobs(timeout=0.5, type=self._type) and \
+               self._last_empty + jobdb.POLL_INTERVAL > time.time():
+                return
+
+        prefermodule = None
+        for w in self._waiting:
+            prefermodule = prefermodule or w[2]
+        jobs = self._jobdb.allocate_job(PREFETCH_WORKERID, node=socket.gethostname(),
+                                        supportedmodules=self._modules, max_jobs=need,
+                                        type=self._type, prefermodule=prefermodule,
+                                        budget=self._budget.available() if self._budget else None)
+        if len(jobs) == 0:
+            self._last_empty = time.time()
+            return
+        self._last_empty = 0
+        if len(self._buffer) < wanted:
+            # Workers had to wait for these, keep more next time
+            self._target = min(self._max_buffer, max(1, self._target * 2))
+        now = time.time()
+        self._leases.add([job["id"] for job in jobs])
+        self._buffer.extend([(now, job) for job in jobs])
+        self._buffer.sort(key=lambda b: -b[1]["priority"])
+
+    def _fits(self, b):
+        return self._budget is None or self._budget.reserve(b[1])
+
+    def _serve(self):
+        still_waiting = []
+        now = time.time()
+        for slot, max_jobs, prefermodule, asked in self._waiting:
+            jobs = []
+            for b in list(self._buffer):
+                if len(jobs) >= max_jobs:
+                    break
+                if b[1]["module"] == prefermodule and self._fits(b):
+                    jobs.append(b[1])
+                    self._buffer.remove(b)
+            for b in list(self._buffer):
+                if len(jobs) >= max_jobs:
+                    break
+                if self._fits(b):
+                    jobs.append(b[1])
+                    self._buffer.remove(b)
+            if jobs or asked + PREFETCH_IDLE_TIME < now:
+                jobs = self._hand_out(slot, jobs)
+                self._responses[slot].put(jobs)
+            else:
+                still_waiting.append((slot, max_jobs, prefermodule, asked))
+        self._waiting = still_waiting
+
+    def _hand_out(self, slot, jobs):
+        """
+        Make the jobs the worker's, it renews their leases from here on.
+        Returns the jobs it can have
+        """
+        if not jobs:
+            return jobs
+        self._leases.remove([job["id"] for job in jobs])
+        try:
+            self._jobdb.renew_leases([job["id"] for job in jobs], worker=worker_id(self._type, slot))
+        except Exception:
+            self.log.exception("Failed to hand out %d jobs to worker %d" % (len(jobs), slot))
+            if self._budget:
+                for job in jobs:
+                    self._budget.release(job)
+            self._release(jobs)
+            return []
+        return jobs
+
+    def _expire(self):
+        now = time.time()
+        expired = [b for b in self._buffer if b[0] + PREFETCH_LEASE < now]
+        if not expired:
+            return
+        self._buffer = [b for b in self._buffer if b[0] + PREFETCH_LEASE >= now]
+        self._release([job for claimed, job in expired])
+        self._target = max(0, self._target // 2)
+
+    def _release(self, jobs):
+        if jobs:
+            self.log.debug("Releasing %d prefetched jobs" % len(jobs))
+            self._leases.remove([job["id"] for job in jobs])
+            self._jobdb.release_jobs([job["id"] for job in jobs])
+
+    def force_stopped(self):
+        """
+        Fail jobs that workers got from us but did not finish, also if they
+        were killed, call when all workers have stopped
+        """
+        if self._jobdb:
+            slots = range(len(self._responses))
+            for workerid in [PREFETCH_WORKERID] + [worker_id(self._type, slot) for slot in slots]:
+                self._jobdb.force_stopped(workerid, node=socket.gethostname())
+
+
 class NodeController(threading.Thread):
 
     def __init__(self, options):
@@ -900,6 +1265,9 @@ class NodeController(threading.Thread):
         self._stop_event = API.api_stop_event
         self._options = options
         self._manager = None
+        self._jobdb = None
+        self._node_modules = {}  # Worker type -> supported modules, for the registry
+        self._registered = False
         self._report_status = not os.path.exists("/.dockerenv")
         if not self._report_status:
             print("Running in Docker, not reporting system status")
@@ -929,11 +1297,29 @@ class NodeController(threading.Thread):
         if len(modules) == 0:
             print("ZERO SUPPORTED MODULES! Looked in", options.paths, "for", options.modules)
 
+        # Jobs reserve cpus, memory and scratch space (MB) from this while they run. One
+        # cpu pr worker unless told otherwise, so jobs that don't say anything run as before
+        self._budget = self._make_budget(options, workers + options.num_gpus + int(options.adminworkers))
+
+        # One prefetcher pr worker type claims jobs for all workers of that type
+        self._prefetchers = []
+
+        def prefetcher(jobtype, modules, num_workers):
+            if options.no_prefetch or num_workers == 0:
+                return None
+            p = JobPrefetcher(jobtype, modules, num_workers, self._stop_event, budget=self._budget)
+            self._prefetchers.append(p)
+            return p
+
+        if workers:
+            self._node_modules[jobdb.TYPE_NORMAL] = modules
+        p = prefetcher(jobdb.TYPE_NORMAL, modules, workers)
         for i in range(0, workers):
             # wid = "%s.%s.Worker-%s_%d" % (self.jobid, self.name, socket.gethostname(), i)
             print("Starting worker %d supporting" % i, modules)
             w = Worker(i, self._stop_event, modules=modules, module_paths=options.paths,
-                       name=options.name, options=options)  # , softstopevent=self._soft_stop_event)
+                       name=options.name, options=options, budget=self._budget,
+                       prefetch=p.get_client(i) if p else None)  # , softstopevent=self._soft_stop_event)
             # w = multiprocessing.Process(target=worker, args=(i, self._options.address,
             #                             self._options.port, AUTHKEY, self._stop_event))
             # args=(wid, self._task_queue, self._results_queue, self._stop_event))
@@ -941,25 +1327,34 @@ class NodeController(threading.Thread):
             self._worker_pool.append(w)
 
         if options.num_gpus > 0:
+            if not options.gpumodules:
+                options.gpumodules = ["any"]
+            self._node_modules[jobdb.TYPE_GPU] = options.gpumodules
+            p = prefetcher(jobdb.TYPE_GPU, options.gpumodules, options.num_gpus)
             for i in range(0, options.num_gpus):
-                if not options.gpumodules:
-                    options.gpumodules = ["any"]
                 print("Starting GPU worker %d supporting" % i, options.gpumodules)
                 w = Worker(i, self._stop_event, type=jobdb.TYPE_GPU, modules=options.gpumodules,
-                           module_paths=options.paths, name=options.name, options=options)
+                           module_paths=options.paths, name=options.name, options=options,
+                           budget=self._budget, prefetch=p.get_client(i) if p else None)
                 w.start()
                 self._worker_pool.append(w)
 
+        if int(options.adminworkers):
+            self._node_modules[jobdb.TYPE_ADMIN] = modules
+        p = prefetcher(jobdb.TYPE_ADMIN, modules, int(options.adminworkers))
         for i in range(0, int(options.adminworkers)):
             print("Starting adminworker %d" % i)
             aw = Worker(i, self._stop_event, type=jobdb.TYPE_ADMIN, modules=modules,
-                        module_paths=options.paths, name=options.name)
+                        module_paths=options.paths, name=options.name, budget=self._budget,
+                        prefetch=p.get_client(i) if p else None)
             aw.start()
             self._worker_pool.append(aw)
 
         self.cfg = API.get_config("NodeController")
         self.cfg.set_default("expire_time", 86400)  # Default one day expire time
         self.cfg.set_default("sample_rate", 5)
+        self._worker_cfg = API.get_config("CryoCloud.Worker")
+        self._worker_cfg.set_default("tempdir", "/tmp")
 
         # My name
         self.name = "NodeController." + socket.gethostname()
@@ -985,6 +1380,27 @@ class NodeController(threading.Thread):
 
         self.log.info("Starting node with supported modules: %s" % str(modules))
 
+    @staticmethod
+    def _make_budget(options, workers):
+        MB = 1024 * 1024
+        cpus = int(options.budget_cpus) if options.budget_cpus else workers
+        if options.budget_memory:
+            memory = int(options.budget_memory)
+        else:
+            try:
+                memory = psutil.virtual_memory().total // MB
+            except:
+                memory = 0
+        if options.budget_scratch:
+            scratch = int(options.budget_scratch)
+        else:
+            try:
+                scratch = psutil.disk_usage(tempfile.gettempdir()).free // MB
+            except:
+                scratch = 0
+        print("Resource budget: %d cpus, %d MB memory, %d MB scratch" % (cpus, memory, scratch))
+        return ResourceBudget(cpus, memory, scratch)
+
     def reload(self, signum, frame):
 
         print("Should reload, sending SIGHUP to all workers")
@@ -999,10 +1415,43 @@ class NodeController(threading.Thread):
 
         self._soft_stop_event.set()
 
+    def _heartbeat(self):
+        """
+        Tell the registry how many workers of each type are free, available
+        memory and scratch space, and the supported modules the first time
+        """
+        slots = {}
+        for w in self._worker_pool:
+            total, free = slots.get(w._type, (0, 0))
+            slots[w._type] = (total + 1, free + (1 if w.is_alive() and not w.busy.value else 0))
+        if not slots:
+            return
+        try:
+            memory = psutil.virtual_memory().available
+            scratch = psutil.disk_usage(self._worker_cfg["tempdir"]).free
+        except:
+            memory = scratch = 0
+        modules = None if self._registered else self._node_modules
+        self._jobdb.update_node(socket.gethostname(), slots, memory, scratch, modules)
+        self._registered = True
+
     def run(self):
+        # Started after the workers are forked, as they use the db
+        for p in self._prefetchers:
+            p.start()
+        self._jobdb = jobdb.get_jobdb(None, None)
+
         if self._report_status:
             self.status["state"] = "Running"
+        last_heartbeat = 0
         while not API.api_stop_event.is_set():
+            if time.time() - last_heartbeat >= noderegistry.HEARTBEAT_INTERVAL:
+                last_heartbeat = time.time()
+                try:
+                    self._heartbeat()
+                except:
+                    self.log.exception("Failed to send heartbeat")
+
             if not self._report_status:
                 time.sleep(1)
                 continue
@@ -1075,6 +1524,15 @@ class NodeController(threading.Thread):
             left -= 1
             self.log.debug("Worker stopped, %d left" % (left))
 
+        for p in self._prefetchers:
+            p.join()
+            p.force_stopped()
+
+        try:
+            self._jobdb.remove_node(socket.gethostname())
+        except Exception as e:
+            print("Failed to remove node:", e)
+
         print("All workers stopped")
 
         if self._manager:
@@ -1128,6 +1586,14 @@ if __name__ == "__main__":
     parser.add_argument("--gpu-modules", dest="gpumodules", default="any",
                         help="GPU based modules in a comma separated list (otherwise 'any') "
                              "- use 'any' for any or 'detect' to force detection")
+    parser.add_argument("--no-prefetch", dest="no_prefetch", action="store_true", default=False,
+                        help="Let every worker claim its own jobs instead of the node claiming for all of them")
+    parser.add_argument("--budget-cpus", dest="budget_cpus", default=None,
+                        help="CPUs jobs can reserve in total (default one pr worker)")
+    parser.add_argument("--budget-memory", dest="budget_memory", default=None,
+                        help="Memory in MB jobs can reserve in total (default all memory)")
+    parser.add_argument("--budget-scratch", dest="budget_scratch", default=None,
+                        help="Scratch space in MB jobs can reserve in total (default free temp space)")
     parser.add_argument("--max-runs", dest="maxruns", default=None,
                         help="If given, the node will exit after a number of runs (resource leaks etc)")
 
@@ -0,0 +1,123 @@
+import time
+import unittest
+import threading
+
+from CryoCore import API
+from CryoCloud.Common.dbpool import ConnectionPool
+
+
+class GoneAway(Exception):
+    errno = 2006
+
+
+class FakeCursor:
+    def __init__(self, conn, prepared):
+        self.conn = conn
+        self.prepared = prepared
+        self.with_rows = False
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, SQL, args=(), multi=False):
+        if self.conn.gone:
+            self.conn.gone = False
+            raise GoneAway("MySQL server has gone away")
+        self.conn.executed.append((SQL, self.prepared))
+        time.sleep(self.conn.delay)
+        self.with_rows = SQL.startswith("SELECT")
+        self.rowcount = 1
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    gone = False
+    delay = 0
+
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self, prepared=False, buffered=False):
+        return FakeCursor(self, prepared)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DBPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+        self.pool = ConnectionPool(connect, size=2, retries=2)
+
+    def testBasic(self):
+        c = self.pool.execute("SELECT state FROM jobs WHERE jobid=%s", [1])
+        self.assertEqual(c.fetchone(), (1,))
+        self.assertEqual(c.fetchone(), None)
+        c = self.pool.execute("UPDATE jobs SET state=%s", [1])
+        self.assertEqual(c.rowcount, 1)
+        self.assertEqual(c.fetchall(), [])
+
+        # One connection is reused
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.pool.get_metrics()["checkouts"], 2)
+
+    def testPrepared(self):
+        for i in range(0, 5):
+            self.pool.execute("SELECT state FROM jobs WHERE jobid=%s", [i], prepare=True)
+        self.assertEqual(self.pool.get_metrics()["prepares"], 1)
+        self.assertEqual(self.connections[0].executed[0], ("SELECT state FROM jobs WHERE jobid=%s", True))
+
+    def testConcurrent(self):
+        FakeConnection.delay = 0.05
+        try:
+            threads = [threading.Thread(target=self.pool.execute, args=("SELECT 1",)) for i in range(0, 6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            FakeConnection.delay = 0
+
+        metrics = self.pool.get_metrics()
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(metrics["checkouts"], 6)
+        self.assertTrue(metrics["waits"] > 0)
+        self.assertEqual(metrics["open"], 2)
+
+    def testReconnect(self):
+        self.pool.execute("SELECT 1")
+        self.connections[0].gone = True
+        c = self.pool.execute("SELECT 1")
+        self.assertEqual(c.fetchall(), [(1,)])
+        self.assertEqual(self.pool.get_metrics()["reconnects"], 1)
+        self.assertEqual(len(self.connections), 2)
+
+        # Bounded retries
+        FakeConnection.gone = True
+        try:
+            self.assertRaises(GoneAway, self.pool.execute, "SELECT 1")
+        finally:
+            FakeConnection.gone = False
+        self.assertEqual(self.pool.get_metrics()["open"], 0)
+
+
+if __name__ == "__main__":
+
+    print("Testing DB connection pool")
+
+    try:
+        unittest.main()
+    finally:
+        API.shutdown()
@@ -0,0 +1,414 @@
+"""
+Tests shared by the job db backends. Test cases mix these in and provide
+make_db(runname), which opens the db of a run, or a worker's db if runname
+is None. Tests of behaviour that differs between backends stay with them.
+"""
+from __future__ import print_function
+
+import time
+import random
+
+from CryoCore import API
+from CryoCloud.Common.jobdb import *
+
+
+class JobDBTests:
+    """
+    Tests for every backend, the in-memory queue too
+    """
+
+    def testFailedParent(self):
+        self.db.lease_time = 0.2
+        self.db.add_job(1, 1, {}, module="noop")
+        self.db.add_job(1, 2, {}, module="noop")
+        self.db.add_job(2, 3, {}, module="noop", depends=[1])
+        self.db.add_job(3, 4, {}, module="noop", depends=[3])
+        self.db.add_job(2, 5, {}, module="noop", depends=[1, 2])
+        self.db.add_job(2, 6, {}, module="noop", depends=[2])
+        self.db.flush()
+        jobs = {job["taskid"]: job["id"] for job in self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)}
+        self.assertEqual(sorted(jobs.keys()), [1, 2])
+
+        # Dependents of a failed job fail, all the way down
+        self.db.update_job(jobs[1], STATE_FAILED)
+        failed = {job["taskid"]: job["retval"] for job in self.db.list_jobs(state=STATE_FAILED)}
+        self.assertEqual(sorted(failed.keys()), [1, 3, 4, 5])
+        self.assertEqual(failed[3], {"error": "Parent task 1 failed"})
+        self.assertEqual(failed[4], {"error": "Parent task 3 failed"})
+
+        # And of a timed out one
+        time.sleep(0.3)
+        self.db.update_timeouts()
+        failed = {job["taskid"]: job["retval"] for job in self.db.list_jobs(state=STATE_FAILED)}
+        self.assertEqual(failed[6], {"error": "Parent task 2 timed out"})
+        self.assertTrue(self.db.is_all_jobs_done())
+
+    def testMaxParallel(self):
+        self.db.set_max_parallel(2, 2)
+        for taskid in range(1, 6):
+            self.db.add_job(2, taskid, {}, module="noop", isblocked=BLOCKED_PARALLEL)
+        self.db.flush()
+
+        # Never more than two, also over several claims
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual(sorted([job["taskid"] for job in jobs]), [1, 2])
+        self.assertEqual(self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10), [])
+        ids = {job["taskid"]: job["id"] for job in jobs}
+
+        # Finished jobs give back their slot right away
+        self.db.update_job(ids[1], STATE_COMPLETED)
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [3])
+        ids[3] = jobs[0]["id"]
+
+        # Released jobs keep theirs
+        self.assertEqual(self.db.release_jobs([ids[2]]), 1)
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [2])
+
+        # Cancelled and removed jobs give them back
+        self.db.cancel_job(ids[3])
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [4])
+        self.db.remove_job(jobs[0]["id"])
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [5])
+
+    def testMissingParent(self):
+        # The parent is still queued for adding when its child goes in
+        self.db.add_job(1, 1, {}, module="noop")
+        self.db.add_job(2, 2, {"input": job_retval(1)}, module="noop", depends=[1], multiple=False)
+        # This one never gets its parent
+        self.db.add_job(2, 3, {}, module="noop", depends=[1, 4], multiple=False)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [1])
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED, retval="/tmp/1")
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [2])
+        self.assertEqual(jobs[0]["args"], {"input": "/tmp/1"})
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED)
+        self.assertEqual(self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10), [])
+
+    def testStaleHolder(self):
+        self.db.lease_time = 0.2
+        self.db.add_job(1, 1, {}, module="noop")
+        self.db.flush()
+        jobid = self.db.allocate_job(1, node="node1", supportedmodules=["any"])[0]["id"]
+        time.sleep(0.3)
+        self.db.update_timeouts()
+
+        # The worker that lost the job can't complete it, not even after it was claimed again
+        failed = self.db.update_jobs([{"id": jobid, "state": STATE_COMPLETED, "holder": (1, "node1")}])
+        self.assertEqual(failed, {jobid: STATE_TIMEOUT})
+        self.db.update_job(jobid, STATE_PENDING)
+        self.db.lease_time = 60
+        self.assertEqual(self.db.allocate_job(2, node="node1", supportedmodules=["any"])[0]["id"], jobid)
+        self.assertRaises(Exception, self.db.update_job, jobid, STATE_COMPLETED, holder=(1, "node1"))
+        self.assertEqual(self.db.update_jobs([{"id": jobid, "state": STATE_FAILED, "holder": (1, "node1"),
+                                               "retry": True}]), {jobid: STATE_ALLOCATED})
+        self.assertEqual(self.db.update_jobs([{"id": jobid, "state": STATE_COMPLETED, "holder": (2, "node1")}]), {})
+
+    def testWaitStats(self):
+        self.db.add_job(1, 1, {}, module="noop", priority=PRI_LOW)
+        self.db.add_job(1, 2, {}, module="noop", priority=PRI_LOW)
+        self.db.add_job(1, 3, {}, module="noop", priority=PRI_HIGH)
+        self.db.flush()
+        self.assertEqual([job["taskid"] for job in self.db.allocate_job(1, supportedmodules=["any"])], [3])
+        time.sleep(0.1)
+        stats = self.db.get_wait_stats()
+        self.assertEqual(stats[PRI_LOW]["pending"], 2)
+        self.assertGreater(stats[PRI_LOW]["max_wait"], 0.1)
+
+
+class SQLJobDBTests(JobDBTests):
+    """
+    Tests for the backends that keep jobs in a database shared by heads and workers
+    """
+
+    def testBatchedAdd(self):
+        # Jobs added together are in well before the old half second commit delay
+        for taskid in range(1, 4):
+            self.db.add_job(1, taskid, {}, module="noop")
+        time.sleep(ADD_FLUSH_INTERVAL * 3)
+        jobs = self.make_db(None).allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual(sorted([job["taskid"] for job in jobs]), [1, 2, 3])
+
+    def testDependencies(self):
+        self.db.add_job(1, 1, {}, module="noop")
+        self.db.add_job(1, 2, {}, module="noop")
+        self.db.add_job(2, 3, {"input": job_retval(1, "fullpath"), "all": job_retval(2), "other": 1},
+                        module="noop", depends=[1, 2])
+        self.db.add_job(3, 4, {}, module="noop", depends=[3])
+        self.db.flush()
+
+        jobs = {job["taskid"]: job for job in self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)}
+        self.assertEqual(sorted(jobs.keys()), [1, 2])
+        self.db.update_job(jobs[1]["id"], STATE_COMPLETED, retval={"fullpath": "/tmp/1"})
+        self.assertEqual(self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10), [])
+
+        # Released by the (queued) update of the last parent, with its args filled in
+        self.db.queue_update(jobs[2]["id"], STATE_COMPLETED, retval={"fullpath": "/tmp/2"})
+        self.db.flush()
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [3])
+        self.assertEqual(jobs[0]["args"], {"input": "/tmp/1", "all": {"fullpath": "/tmp/2"}, "other": 1})
+
+        # Cancelled with its parent
+        self.db.cancel_job(jobs[0]["id"])
+        self.assertEqual([job["taskid"] for job in self.db.list_jobs(state=STATE_CANCELLED)], [3, 4])
+
+        # Parents may be done already
+        self.db.add_job(1, 5, {"input": job_retval(1, "fullpath")}, module="noop", depends=[1])
+        self.db.flush()
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual(jobs[0]["args"], {"input": "/tmp/1"})
+        self.assertFalse(self.db.is_all_jobs_done())
+
+        # Also when cancelled by taskid
+        self.db.add_job(1, 6, {}, module="noop")
+        self.db.add_job(2, 7, {}, module="noop", depends=[6])
+        self.db.flush()
+        self.db.cancel_job_by_taskid(6)
+        self.assertEqual([job["taskid"] for job in self.db.list_jobs(state=STATE_CANCELLED)], [3, 4, 6, 7])
+
+    def testFairShare(self):
+        cfg = API.get_config("CryoCloud.JobDB")
+        cfg["fair_share"] = True
+        other = self.make_db("other")
+        try:
+            self.db.set_share(1)
+            other.set_share(3)
+            # Our jobs are older, so without fair share all would be ours
+            for i in range(0, 400):
+                self.db.add_job(1, i, {}, module="ours", priority=PRI_BULK)
+            self.db.flush()
+            for i in range(0, 400):
+                other.add_job(1, i, {}, module="theirs", priority=PRI_BULK)
+            other.flush()
+
+            worker = self.make_db(None)
+            ours = 0
+            for i in range(0, 200):
+                jobs = worker.allocate_job(1, supportedmodules=["any"])
+                if jobs[0]["module"] == "ours":
+                    ours += 1
+            # Converges to 1:3
+            self.assertTrue(45 <= ours <= 55, "Got %d of 200 jobs, expected 50" % ours)
+
+            # Claims by other workers are seen after SHARE_REFRESH_CLAIMS claims, long before the cache expires
+            seen = sum([r["allocated"] for r in worker._share_runs.values()])
+            other_worker = self.make_db(None)
+            for i in range(0, SHARE_REFRESH_CLAIMS):
+                other_worker.allocate_job(1, supportedmodules=["any"])
+            for i in range(0, SHARE_REFRESH_CLAIMS + 1):
+                worker.allocate_job(1, supportedmodules=["any"])
+            self.assertEqual(sum([r["allocated"] for r in worker._share_runs.values()]),
+                             seen + 2 * SHARE_REFRESH_CLAIMS + 1)
+
+            # Higher priority still goes first
+            self.db.add_job(1, 1000, {}, module="noop", priority=PRI_HIGH)
+            self.db.flush()
+            worker._share_ts = 0
+            jobs = worker.allocate_job(1, supportedmodules=["any"])
+            self.assertEqual(jobs[0]["taskid"], 1000)
+        finally:
+            cfg["fair_share"] = False
+            other.clear_jobs()
+
+    def testGang(self):
+        for taskid in range(1, 4):
+            self.db.add_job(1, taskid, {}, module="noop", isblocked=BLOCKED_GANG)
+        self.db.add_job(1, 4, {}, module="noop", isblocked=1)
+        self.db.flush()
+        self.assertEqual(self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10), [])
+
+        # Released together, also the queued ones, but not jobs blocked for other reasons
+        self.db.add_job(1, 5, {}, module="noop", isblocked=BLOCKED_GANG)
+        self.assertEqual(self.db.release_gang([1, 2, 3, 4, 5]), 4)
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual(sorted([job["taskid"] for job in jobs]), [1, 2, 3, 5])
+        self.assertEqual(self.db.release_gang([1, 2, 3]), 0)
+
+    def testLeases(self):
+        self.db.lease_time = 0.5
+        self.db.add_job(1, 1, {}, module="noop", expire_time=3600)
+        self.db.add_job(1, 2, {}, module="noop", expire_time=3600)
+        self.db.flush()
+        jobs = {job["taskid"]: job["id"] for job in self.db.allocate_job(1, supportedmodules=["any"], max_jobs=2)}
+
+        # Only the renewed job survives its first lease
+        time.sleep(0.3)
+        self.assertEqual(self.db.renew_leases([jobs[1]]), 1)
+        time.sleep(0.3)
+        self.db.update_timeouts()
+        self.assertEqual(self.db.get_job_state(jobs[1]), STATE_ALLOCATED)
+        self.assertEqual(self.db.get_job_state(jobs[2]), STATE_TIMEOUT)
+        self.assertEqual(self.db.renew_leases([jobs[2]]), 0)
+
+        # Renewals stop at the expire time
+        self.db.lease_time = 60
+        self.db.add_job(1, 3, {}, module="noop", expire_time=1)
+        self.db.flush()
+        job = self.db.allocate_job(1, supportedmodules=["any"])[0]
+        self.assertEqual(self.db.renew_leases([job["id"], jobs[1]]), 2)
+        time.sleep(1.1)
+        self.db.update_timeouts()
+        self.assertEqual(self.db.get_job_state(job["id"]), STATE_TIMEOUT)
+        self.assertEqual(self.db.get_job_state(jobs[1]), STATE_ALLOCATED)
+
+    def testLocality(self):
+        cfg = API.get_config("CryoCloud.JobDB")
+        cfg["locality_grace"] = 1
+        db = self.make_db("locality")
+        try:
+            db.add_job(1, 1, {}, module="noop", prefer_nodes=["node1", "node2"])
+            db.add_job(1, 2, {}, module="noop", prefer_nodes=["node1"])
+            db.flush()
+
+            # Other nodes must wait for the grace period
+            self.assertEqual(db.allocate_job(1, supportedmodules=["any"], node="node3", max_jobs=10), [])
+            jobs = db.allocate_job(1, supportedmodules=["any"], node="node2", max_jobs=10)
+            self.assertEqual([job["taskid"] for job in jobs], [1])
+
+            time.sleep(1.5)
+            jobs = db.allocate_job(1, supportedmodules=["any"], node="node3", max_jobs=10)
+            self.assertEqual([job["taskid"] for job in jobs], [2])
+            self.assertEqual(db.list_jobs(state=STATE_ALLOCATED)[-1]["prefer_nodes"], ["node1"])
+        finally:
+            cfg["locality_grace"] = 30
+            db.clear_jobs()
+
+    def testNodes(self):
+        self.db.update_node("unittest-1", {TYPE_NORMAL: (4, 2), TYPE_ADMIN: (1, 1)}, 1000, 2000,
+                            {TYPE_NORMAL: ["a", "b"], TYPE_ADMIN: ["a", "b"]})
+        self.db.update_node("unittest-2", {TYPE_NORMAL: (2, 0)}, 10, 20, {TYPE_NORMAL: ["b"]})
+
+        workers = self.db.get_workers(["a", "b", "unittest-none"])
+        self.assertEqual(workers["a"], ["unittest-1"])
+        self.assertEqual([n for n in workers["b"] if n.startswith("unittest-")], ["unittest-1", "unittest-2"])
+        self.assertEqual(workers["unittest-none"], [])
+        self.assertIn("unittest-1", self.db.get_worker_nodes(adminsOnly=True))
+        self.assertNotIn("unittest-2", self.db.get_worker_nodes(adminsOnly=True))
+
+        # Heartbeats without modules keep the ones we have
+        self.db.update_node("unittest-2", {TYPE_NORMAL: (2, 2)}, 10, 20)
+        time.sleep(noderegistry.REFRESH_INTERVAL)
+        node = self.db.get_nodes()["unittest-2"]
+        self.assertEqual(node["types"], {TYPE_NORMAL: {"slots": 2, "free": 2}})
+        self.assertEqual(node["modules"], {TYPE_NORMAL: set(["b"])})
+        self.assertEqual((node["memory"], node["scratch"]), (10, 20))
+
+        self.db.remove_node("unittest-2")
+        self.db.remove_node("unittest-1")
+        self.assertEqual(self.make_db("nodes").get_workers(["a"]), {"a": []})
+
+    def testPrefetched(self):
+        for taskid in range(1, 4):
+            self.db.add_job(1, taskid, {}, module="noop")
+        self.db.flush()
+        # Claimed like a node's prefetcher does, then handed to workers 1 and 2
+        prefetcher = self.make_db(None)
+        jobs = prefetcher.allocate_job(65000, node="node1", supportedmodules=["any"], max_jobs=3)
+        self.assertEqual(prefetcher.renew_leases([jobs[0]["id"]], worker=1), 1)
+        self.assertEqual(prefetcher.renew_leases([jobs[1]["id"]], worker=2), 1)
+
+        # Worker 1 is killed, its job fails but not the others
+        prefetcher.force_stopped(1, "node1")
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_FAILED)
+        self.assertEqual(self.db.get_job_state(jobs[1]["id"]), STATE_ALLOCATED)
+        self.assertEqual(self.db.get_job_state(jobs[2]["id"]), STATE_ALLOCATED)
+        self.assertEqual(prefetcher.update_jobs([{"id": jobs[1]["id"], "state": STATE_COMPLETED,
+                                                  "holder": (2, "node1")}]), {})
+
+    def testProfileStats(self):
+        module = "stats%d" % random.randint(0, 1000000)
+        now = time.time()
+        for i in range(0, 20):
+            self.db.update_profile(i, module, product="product", addtime=now - 10 - i, priority=PRI_NORMAL, datasize=100)
+            self.db.update_profile(i, module, state=STATE_ALLOCATED)
+            self.db.update_profile(i, module, state=STATE_COMPLETED, cpu=i + 1)
+        self.db.update_profile(20, module, product="product", priority=PRI_NORMAL, datasize=100)
+        self.db.update_profile(20, module, state=STATE_FAILED)
+
+        # Estimates are there at once, without summarizing
+        estimate = self.db.estimate_resources(module, priority=PRI_HIGH)
+        self.assertEqual(estimate["runs"], 21)
+        self.assertEqual(estimate["errors"], 1)
+        self.assertAlmostEqual(estimate["cpu_time"], 10.5)
+        self.assertAlmostEqual(estimate["totaltime"], 19.5, delta=0.5)
+        self.assertAlmostEqual(estimate["totaltime_p95"], 28, delta=2)
+        # and repeated ones are served from the cache
+        self.db.update_profile(21, module, product="product", priority=PRI_NORMAL, datasize=100)
+        self.db.update_profile(21, module, state=STATE_COMPLETED)
+        self.assertIs(self.db.estimate_resources(module, priority=PRI_HIGH), estimate)
+        self.assertEqual(self.db.estimate_resources(module, priority=PRI_LOW), {})
+        self.assertEqual(self.db.estimate_resources(module, datasize=10 * 1073741824), {})
+
+        # Other heads see them once written
+        self.db.flush()
+        other = self.make_db("stats")
+        estimate = other.estimate_resources(module, datasize=100)
+        self.assertEqual(estimate["runs"], 22)
+        self.assertAlmostEqual(estimate["cpu_time"], 10.5)
+        self.assertIn(module, other.get_profiles())
+
+        # and merge theirs into the same rows, not rows of their own
+        other.update_profile(22, module, product="product", priority=PRI_NORMAL, datasize=100)
+        other.update_profile(22, module, state=STATE_COMPLETED)
+        other.flush()
+        c = self.db._execute("SELECT COUNT(*) FROM profile_stats WHERE module=%s", [module])
+        self.assertEqual(c.fetchone()[0], 1)
+        self.db._read_profile_stats()
+        self.assertEqual(self.db.estimate_resources(module, datasize=100)["runs"], 23)
+
+    def testResources(self):
+        self.db.add_job(1, 1, {}, module="noop", resources={"cpus": 4, "memory": 8000})
+        self.db.add_job(1, 2, {}, module="noop", resources={"memory": 1000, "scratch": 500})
+        self.db.add_job(1, 3, {}, module="noop")
+        self.db.flush()
+
+        # Only what fits in the budget, jobs that don't say anything need one cpu
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10,
+                                    budget={"cpus": 2, "memory": 2000, "scratch": None})
+        self.assertEqual(sorted([job["taskid"] for job in jobs]), [2, 3])
+        for job in jobs:
+            if job["taskid"] == 2:
+                self.assertEqual(job["resources"], {"cpus": 1, "memory": 1000, "scratch": 500})
+            else:
+                self.assertEqual(job["resources"], {"cpus": 1, "memory": 0, "scratch": 0})
+        self.assertEqual(self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10,
+                                              budget={"cpus": 8, "memory": 4000}), [])
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [1])
+        self.assertEqual(jobs[0]["resources"]["cpus"], 4)
+
+    def testRetry(self):
+        cfg = API.get_config("CryoCloud.JobDB")
+        cfg["retry_delay"] = 0.5
+        try:
+            self.db.add_job(1, 1, {}, module="noop", max_retries=1)
+            self.db.add_job(1, 2, {}, module="noop")
+            self.db.flush()
+            jobs = {job["taskid"]: job for job in self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)}
+            self.assertEqual(sorted(jobs), [1, 2])
+
+            # Retryable errors wait for a while, others fail right away
+            self.db.update_job(jobs[1]["id"], STATE_FAILED, retval={"error": "timeout"}, retry=True)
+            self.db.update_job(jobs[2]["id"], STATE_FAILED, retval={"error": "bad input"})
+            self.assertEqual(self.db.get_job_state(jobs[1]["id"]), STATE_PENDING)
+            self.assertEqual(self.db.get_job_state(jobs[2]["id"]), STATE_FAILED)
+            self.assertEqual(self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10), [])
+
+            time.sleep(0.8)
+            retried = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+            self.assertEqual([job["taskid"] for job in retried], [1])
+
+            # No retries left
+            self.db.queue_update(retried[0]["id"], STATE_FAILED, retval={"error": "timeout"}, retry=True)
+            self.db.commit_updates()
+            self.assertEqual(self.db.get_job_state(retried[0]["id"]), STATE_FAILED)
+        finally:
+            cfg["retry_delay"] = RETRY_DELAY
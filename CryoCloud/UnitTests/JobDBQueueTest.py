@@ -7,6 +7,8 @@ import os
 
 from CryoCore import API
 from CryoCloud.Common.jobdb_queue import *
+from CryoCloud.Common.jobdb import job_retval
+from JobDBCommon import JobDBTests
 
 stop_event = threading.Event()
 
@@ -33,15 +35,18 @@ class FakeWorker(threading.Thread):
                 self.func(self.db, job)
 
 
-class JobDBTest(unittest.TestCase):
+class JobDBTest(JobDBTests, unittest.TestCase):
     """
     Unit tests for the JobDB
 
     """
     def setUp(self):
-        self.db = JobDB("test", None)
+        self.db = self.make_db("test")
         stop_event.clear()
 
+    def make_db(self, runname):
+        return JobDB(runname, None)
+
     def tearDown(self):
         self.db.flush()
         stop_event.set()
@@ -162,6 +167,151 @@ class JobDBTest(unittest.TestCase):
                 break
         self.assertEqual(len(left), 0, "Timed out, %d left" % len(left))
 
+    def testUpdateCursor(self):
+        self.db.add_job(1, 1, {"one": 1}, module="noop", itemid=1)
+        self.db.add_job(1, 2, {"two": 2}, module="noop", itemid=2)
+        self.db.flush()
+
+        cursor, updates = self.db.get_updates(0)
+        self.assertEqual(updates, [])
+
+        jobs = self.db.allocate_job(1, max_jobs=1)
+        self.assertEqual(len(jobs), 1)
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED)
+
+        cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual([(job["taskid"], job["state"]) for job in updates],
+                         [(jobs[0]["taskid"], STATE_ALLOCATED), (jobs[0]["taskid"], STATE_COMPLETED)])
+
+        # Nothing new after the cursor
+        new_cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual(updates, [])
+        self.assertEqual(new_cursor, cursor)
+
+    def testBulkUpdate(self):
+        for i in range(0, 3):
+            self.db.add_job(1, i, {"jobnr": i}, module="noop", itemid=i)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, max_jobs=3)
+        self.assertEqual(len(jobs), 3)
+        self.db.cancel_job(jobs[2]["id"])
+
+        failed = self.db.update_jobs([{"id": jobs[0]["id"], "state": STATE_COMPLETED, "retval": {"ok": 1}},
+                                      {"id": jobs[1]["id"], "state": STATE_FAILED, "cpu": 1.5},
+                                      {"id": jobs[2]["id"], "state": STATE_COMPLETED}])
+        self.assertEqual(failed, {jobs[2]["id"]: None})
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_COMPLETED)
+        self.assertEqual(self.db.get_job_state(jobs[1]["id"]), STATE_FAILED)
+
+        # Queued updates report failures through the callback
+        reported = []
+        self.db.queue_update(jobs[2]["id"], STATE_COMPLETED, callback=lambda jobid, state: reported.append((jobid, state)))
+        self.db.flush()
+        self.assertEqual(reported, [(jobs[2]["id"], None)])
+
+    def testPriorityAndBlocking(self):
+        self.db.add_job(1, 1, {}, module="a", priority=PRI_LOW)
+        self.db.add_job(1, 2, {}, module="b", priority=PRI_HIGH)
+        self.db.add_job(1, 3, {}, module="a", priority=PRI_HIGH)
+        self.db.add_job(2, 4, {}, module="a", priority=PRI_HIGH, isblocked=True)
+        self.db.add_job(2, 5, {}, module="a", priority=PRI_HIGH, isblocked=True)
+
+        # Highest priority first, oldest first within a priority
+        jobs = self.db.allocate_job(1, max_jobs=2)
+        self.assertEqual([job["taskid"] for job in jobs], [2, 3])
+
+        # Blocked jobs are only handed out once unblocked
+        self.assertEqual(self.db.unblock_step(2, 1), 1)
+        jobs = self.db.allocate_job(1, max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [4, 1])
+
+        # Cancelled jobs are gone, also if they were blocked
+        self.db.cancel_job_by_taskid(5)
+        self.assertEqual(self.db.unblock_step(2, 1), 0)
+        self.assertEqual(self.db.allocate_job(1, max_jobs=10), [])
+        self.assertFalse(self.db.is_all_jobs_done())
+
+        since = time.time()
+        for job in self.db.list_jobs(state=STATE_ALLOCATED):
+            self.db.update_job(job["id"], STATE_COMPLETED)
+        self.assertEqual(len(self.db.list_jobs(since=since)), 4)
+        self.assertTrue(self.db.is_all_jobs_done())
+
+    def testDependencies(self):
+        self.db.add_job(1, 1, {}, module="a")
+        self.db.add_job(1, 2, {}, module="a")
+        self.db.add_job(2, 3, {"input": job_retval(1, "fullpath"), "other": 1}, module="a", depends=[1, 2])
+        self.db.add_job(3, 4, {}, module="a", depends=[3])
+
+        jobs = {job["taskid"]: job for job in self.db.allocate_job(1, max_jobs=10)}
+        self.assertEqual(sorted(jobs.keys()), [1, 2])
+        self.db.update_job(jobs[1]["id"], STATE_COMPLETED, retval={"fullpath": "/tmp/1"})
+        self.assertEqual(self.db.allocate_job(1, max_jobs=10), [])
+        self.db.update_job(jobs[2]["id"], STATE_COMPLETED)
+
+        jobs = self.db.allocate_job(1, max_jobs=10)
+        self.assertEqual([job["taskid"] for job in jobs], [3])
+        self.assertEqual(jobs[0]["args"], {"input": "/tmp/1", "other": 1})
+
+        # Cancelled jobs are gone, and so are the ones waiting for them
+        self.db.cancel_job(jobs[0]["id"])
+        self.assertTrue(self.db.is_all_jobs_done())
+
+        # Parents may be done already
+        self.db.add_job(1, 5, {"input": job_retval(1, "fullpath")}, module="a", depends=[1])
+        jobs = self.db.allocate_job(1, max_jobs=10)
+        self.assertEqual(jobs[0]["args"], {"input": "/tmp/1"})
+
+    def testLeases(self):
+        self.db.lease_time = 0.5
+        self.db.add_job(1, 1, {}, module="a", expire_time=3600)
+        self.db.add_job(1, 2, {}, module="a", expire_time=3600)
+        jobs = {job["taskid"]: job["id"] for job in self.db.allocate_job(1, max_jobs=2)}
+
+        time.sleep(0.3)
+        self.assertEqual(self.db.renew_leases([jobs[1]]), 1)
+        time.sleep(0.3)
+        self.db.update_timeouts()
+        self.assertEqual(self.db.get_job_state(jobs[1]), STATE_ALLOCATED)
+        self.assertEqual(self.db.get_job_state(jobs[2]), STATE_TIMEOUT)
+        self.assertEqual(self.db.renew_leases([jobs[2]]), 0)
+
+    def testGang(self):
+        for taskid in range(1, 4):
+            self.db.add_job(1, taskid, {}, module="a", isblocked=BLOCKED_GANG)
+        self.db.add_job(1, 4, {}, module="a", isblocked=True)
+        self.assertEqual(self.db.allocate_job(1, max_jobs=10), [])
+
+        # Released together, but not jobs blocked for other reasons
+        self.assertEqual(self.db.release_gang([1, 2, 3, 4]), 3)
+        jobs = self.db.allocate_job(1, max_jobs=10)
+        self.assertEqual(sorted([job["taskid"] for job in jobs]), [1, 2, 3])
+        self.assertEqual(self.db.release_gang([1, 2, 3]), 0)
+        self.assertEqual(self.db.unblock_step(1, 1), 1)
+
+    def testRetry(self):
+        self.db.retry_delay = 0.5
+        self.db.add_job(1, 1, {}, module="a", max_retries=1)
+        self.db.add_job(1, 2, {}, module="a")
+        jobs = {job["taskid"]: job for job in self.db.allocate_job(1, max_jobs=10)}
+        self.assertEqual(sorted(jobs), [1, 2])
+
+        # Retryable errors wait for a while, others fail right away
+        self.db.update_job(jobs[1]["id"], STATE_FAILED, retval={"error": "timeout"}, retry=True)
+        self.db.update_job(jobs[2]["id"], STATE_FAILED, retval={"error": "bad input"})
+        self.assertEqual(self.db.get_job_state(jobs[1]["id"]), STATE_PENDING)
+        self.assertEqual(self.db.get_job_state(jobs[2]["id"]), STATE_FAILED)
+        self.assertEqual(self.db.allocate_job(1, max_jobs=10), [])
+
+        time.sleep(0.8)
+        retried = self.db.allocate_job(1, max_jobs=10)
+        self.assertEqual([job["taskid"] for job in retried], [1])
+
+        # No retries left
+        self.db.queue_update(retried[0]["id"], STATE_FAILED, retval={"error": "timeout"}, retry=True)
+        self.assertEqual(self.db.get_job_state(retried[0]["id"]), STATE_FAILED)
+
     def testWorkerMulti(self):
         """
         Run a worker that performs jobs asynchronously
@@ -0,0 +1,276 @@
+from __future__ import print_function
+
+import unittest
+import time
+import threading
+import tempfile
+import shutil
+import os
+import sqlite3
+
+from CryoCore import API
+from CryoCloud.Common.jobdb import *
+from CryoCloud.Common import jobdb_sqlite, profilestats
+from JobDBCommon import SQLJobDBTests
+
+stop_event = threading.Event()
+
+
+class FakeWorker(threading.Thread):
+    def __init__(self, path, func, workertype, max_jobs):
+        super().__init__()
+        self.path = path
+        self.func = func
+        self.workertype = workertype
+        self.max_jobs = max_jobs
+        self.daemon = True
+        self.workerid = random.randint(0, 65000)
+
+    def run(self):
+        db = jobdb_sqlite.JobDB(None, None, path=self.path)
+        while not stop_event.is_set():
+            jobs = db.allocate_job(self.workerid, supportedmodules=["any"], type=self.workertype, max_jobs=self.max_jobs)
+            if len(jobs) == 0:
+                time.sleep(0.1)
+                continue
+
+            for job in jobs:
+                self.func(db, job)
+
+
+class JobDBSqliteTest(SQLJobDBTests, unittest.TestCase):
+    """
+    Unit tests for the SQLite JobDB backend
+
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "jobdb.sqlite")
+        self.db = self.make_db("test")
+        stop_event.clear()
+
+    def make_db(self, runname):
+        if runname is None:
+            return jobdb_sqlite.JobDB(None, None, path=self.path)
+        return jobdb_sqlite.JobDB(runname, None, auto_cleanup=False, path=self.path)
+
+    def tearDown(self):
+        self.db.flush()
+        stop_event.set()
+        time.sleep(0.5)
+        shutil.rmtree(self.dir)
+
+    def testBasic(self):
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=1)
+        self.assertEqual(jobs, [])
+
+        self.db.add_job(1, 1, {"one": 1}, module="noop", itemid=123)
+        self.db.flush()
+
+        jobs = self.db.list_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_PENDING)
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]["module"], "noop")
+        self.assertEqual(jobs[0]["itemid"], 123)
+        self.assertEqual(jobs[0]["args"], {"one": 1})
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_ALLOCATED)
+
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED, retval={"foo": "bar"})
+        jobs = self.db.list_jobs(state=STATE_COMPLETED)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]["retval"], {"foo": "bar"})
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"])
+        self.assertEqual(jobs, [])
+
+    def testModules(self):
+        self.db.add_job(1, 1, {}, module="one", itemid=1)
+        self.db.add_job(1, 2, {}, module="two", itemid=2, priority=PRI_HIGH)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["one"], max_jobs=10)
+        self.assertEqual([job["module"] for job in jobs], ["one"])
+
+        self.db.add_job(1, 3, {}, module="one", itemid=3, priority=PRI_LOW)
+        self.db.flush()
+        # Preferred module even if there is a higher priority job
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], prefermodule="one", preferlevel=100)
+        self.assertEqual([job["taskid"] for job in jobs], [3])
+
+    def testUpdateCursor(self):
+        self.db.add_job(1, 1, {"one": 1}, module="noop", itemid=1)
+        self.db.add_job(1, 2, {"two": 2}, module="noop", itemid=2)
+        self.db.flush()
+
+        cursor, updates = self.db.get_updates(0)
+        self.assertEqual(updates, [])
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=1)
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED)
+
+        cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual([(job["taskid"], job["state"]) for job in updates],
+                         [(jobs[0]["taskid"], STATE_ALLOCATED), (jobs[0]["taskid"], STATE_COMPLETED)])
+
+        new_cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual(updates, [])
+        self.assertEqual(new_cursor, cursor)
+
+    def testBulkUpdate(self):
+        for i in range(0, 3):
+            self.db.add_job(1, i, {"jobnr": i}, module="noop", itemid=i)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=3)
+        self.assertEqual(len(jobs), 3)
+        self.db.cancel_job(jobs[2]["id"])
+
+        failed = self.db.update_jobs([{"id": jobs[0]["id"], "state": STATE_COMPLETED, "retval": {"ok": 1}},
+                                      {"id": jobs[1]["id"], "state": STATE_FAILED, "cpu": 1.5},
+                                      {"id": jobs[2]["id"], "state": STATE_COMPLETED}])
+        self.assertEqual(failed, {jobs[2]["id"]: STATE_CANCELLED})
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_COMPLETED)
+        self.assertEqual(self.db.get_job_state(jobs[1]["id"]), STATE_FAILED)
+
+    def testArchive(self):
+        files = ["/some/rather/long/path/to/file%d.tif" % i for i in range(100)]
+        self.db.add_job(1, 1, {"files": files}, module="noop", itemid=1)
+        self.db.add_job(1, 2, {"files": files}, module="noop", itemid=2)
+        self.db.flush()
+        cursor = self.db.get_update_cursor()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=1)
+        self.assertEqual(jobs[0]["args"], {"files": files})
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED, retval={"done": True})
+        time.sleep(0.1)
+
+        self.assertEqual(self.db.archive_jobs(age=0), 1)
+        self.assertEqual(len(self.db.list_jobs()), 1)
+
+        cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual([(job["taskid"], job["state"]) for job in updates],
+                         [(jobs[0]["taskid"], STATE_ALLOCATED), (jobs[0]["taskid"], STATE_COMPLETED)])
+        self.assertEqual(updates[1]["retval"], {"done": True})
+
+        # Shared args are still in use by the pending job
+        self.db.cleanup()
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=1)
+        self.assertEqual(jobs[0]["args"], {"files": files})
+
+    def testRelease(self):
+        self.db.add_job(1, 1, {}, module="noop", itemid=1)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], node="somenode")
+        self.assertEqual(self.db.release_jobs([jobs[0]["id"]]), 1)
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_PENDING)
+
+        # Only allocated jobs are released
+        jobs = self.db.allocate_job(2, supportedmodules=["any"], node="othernode")
+        self.assertEqual(len(jobs), 1)
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED)
+        self.assertEqual(self.db.release_jobs([jobs[0]["id"]]), 0)
+
+    def testProfileStatsUpgrade(self):
+        path = os.path.join(self.dir, "old.sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute([SQL for SQL in jobdb_sqlite.STATEMENTS if "TABLE IF NOT EXISTS profile_summary" in SQL][0])
+        conn.execute("CREATE TABLE profile_stats (module VARCHAR(128), priority INT, size_bucket INT, owner BIGINT, " +
+                     "stats MEDIUMTEXT, updated DOUBLE, PRIMARY KEY (module, priority, size_bucket, owner))")
+        for owner in [1, 2]:
+            stats = profilestats.ProfileStats()
+            stats.add("completed", {"totaltime": 10 * owner})
+            conn.execute("INSERT INTO profile_stats VALUES ('old', 50, 0, ?, ?, ?)", [owner, stats.to_json(), time.time()])
+        conn.execute("INSERT INTO profile_summary (module, time, runs, datasize, totaltime, priority, errors) " +
+                     "VALUES ('old', '2020-01-01 00:00:00', 3, 100, 40, 50, 1)")
+        conn.commit()
+        conn.close()
+
+        # Owners and summaries are merged once
+        db = jobdb_sqlite.JobDB("upgrade", None, auto_cleanup=False, path=path)
+        estimate = db.estimate_resources("old")
+        self.assertEqual(estimate["runs"], 5)
+        self.assertEqual(estimate["errors"], 1)
+        self.assertAlmostEqual(estimate["totaltime"], 27.5)
+        db = jobdb_sqlite.JobDB("upgrade", None, auto_cleanup=False, path=path)
+        self.assertEqual(db.estimate_resources("old")["runs"], 5)
+
+        # and pruned when they are not updated
+        db._execute("UPDATE profile_stats SET updated=0")
+        db.cleanup()
+        db._read_profile_stats()
+        self.assertEqual(db.get_profiles(), {})
+
+    def testAging(self):
+        cfg = API.get_config("CryoCloud.JobDB")
+        cfg["aging_interval"] = 0.5
+        cfg["aging_step"] = 30
+        db = jobdb_sqlite.JobDB("aging", None, auto_cleanup=False, path=self.path)
+        try:
+            db.add_job(1, 1, {}, module="noop", priority=PRI_BULK)
+            db.flush()
+            time.sleep(0.6)
+
+            # Aged one step, so before newer low priority jobs
+            db.add_job(1, 2, {}, module="noop", priority=PRI_LOW)
+            db.flush()
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [1])
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [2])
+
+            # but no more than AGING_CAP above where it started
+            db.add_job(1, 3, {}, module="noop", priority=PRI_BULK)
+            db.flush()
+            time.sleep(1.1)
+            db.add_job(1, 4, {}, module="noop", priority=PRI_NORMAL + 5)
+            db.flush()
+            stats = db.get_wait_stats()
+            self.assertEqual(stats[PRI_BULK]["pending"], 1)
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [4])
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [3])
+        finally:
+            cfg["aging_interval"] = AGING_INTERVAL
+            cfg["aging_step"] = AGING_STEP
+            db.clear_jobs()
+
+    def testWorkerMulti(self):
+        """
+        Several workers with their own connections claiming from the same db
+        """
+        def process(db, job):
+            if stop_event.is_set():
+                return
+            db.update_job(job["id"], state=STATE_COMPLETED)
+
+        for i in range(0, 4):
+            FakeWorker(self.path, process, TYPE_NORMAL, 5).start()
+
+        numjobs = 200
+        for i in range(0, numjobs):
+            self.db.add_job(1, i, {"jobnr": i}, module="noop", itemid=i)
+        self.db.flush()
+
+        cursor = 0
+        seen = {}
+        force_stop = time.time() + 30
+        while len(seen) < numjobs and time.time() < force_stop:
+            cursor, updates = self.db.get_updates(cursor)
+            for job in updates:
+                if job["state"] == STATE_COMPLETED:
+                    self.assertNotIn(job["taskid"], seen, "Completed twice")
+                    seen[job["taskid"]] = job
+            time.sleep(0.1)
+        self.assertEqual(len(seen), numjobs)
+        self.assertTrue(self.db.is_all_jobs_done())
+
+
+if __name__ == "__main__":
+
+    print("Testing SQLite Job database")
+
+    try:
+        unittest.main()
+    finally:
+        API.shutdown()
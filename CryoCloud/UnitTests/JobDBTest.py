@@ -7,6 +7,7 @@ import os
 
 from CryoCore import API
 from CryoCloud.Common.jobdb import *
+from JobDBCommon import SQLJobDBTests
 
 stop_event = threading.Event()
 
@@ -34,15 +35,18 @@ class FakeWorker(threading.Thread):
                 self.func(db, job)
 
 
-class JobDBTest(unittest.TestCase):
+class JobDBTest(SQLJobDBTests, unittest.TestCase):
     """
     Unit tests for the JobDB
 
     """
     def setUp(self):
-        self.db = JobDB("test", None)
+        self.db = self.make_db("test")
         stop_event.clear()
 
+    def make_db(self, runname):
+        return JobDB(runname, None)
+
     def tearDown(self):
         self.db.flush()
         stop_event.set()
@@ -165,6 +169,118 @@ class JobDBTest(unittest.TestCase):
                 break
         self.assertEqual(len(left), 0, "Timed out, %d left" % len(left))
 
+    def testUpdateCursor(self):
+        self.db.add_job(1, 1, {"one": 1}, module="noop", itemid=1)
+        self.db.add_job(1, 2, {"two": 2}, module="noop", itemid=2)
+        self.db.flush()
+
+        cursor, updates = self.db.get_updates(0)
+        self.assertEqual(updates, [])
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=1)
+        self.assertEqual(len(jobs), 1)
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED)
+
+        cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual([(job["taskid"], job["state"]) for job in updates],
+                         [(jobs[0]["taskid"], STATE_ALLOCATED), (jobs[0]["taskid"], STATE_COMPLETED)])
+
+        # Nothing new after the cursor
+        new_cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual(updates, [])
+        self.assertEqual(new_cursor, cursor)
+
+    def testBulkUpdate(self):
+        for i in range(0, 3):
+            self.db.add_job(1, i, {"jobnr": i}, module="noop", itemid=i)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=3)
+        self.assertEqual(len(jobs), 3)
+        self.db.cancel_job(jobs[2]["id"])
+
+        failed = self.db.update_jobs([{"id": jobs[0]["id"], "state": STATE_COMPLETED, "retval": {"ok": 1}},
+                                      {"id": jobs[1]["id"], "state": STATE_FAILED, "cpu": 1.5},
+                                      {"id": jobs[2]["id"], "state": STATE_COMPLETED}])
+        self.assertEqual(failed, {jobs[2]["id"]: STATE_CANCELLED})
+        self.assertEqual(self.db.get_job_state(jobs[0]["id"]), STATE_COMPLETED)
+        self.assertEqual(self.db.get_job_state(jobs[1]["id"]), STATE_FAILED)
+
+        # Queued updates report failures through the callback
+        reported = []
+        self.db.queue_update(jobs[2]["id"], STATE_COMPLETED, callback=lambda jobid, state: reported.append((jobid, state)))
+        self.db.flush()
+        self.assertEqual(reported, [(jobs[2]["id"], STATE_CANCELLED)])
+
+    def testSharedArgs(self):
+        files = ["/some/rather/long/path/to/file%d.tif" % i for i in range(100)]
+        for i in range(0, 10):
+            self.db.add_job(1, i, {"jobnr": i, "files": files}, module="noop", itemid=i)
+        self.db.flush()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=10)
+        self.assertEqual(len(jobs), 10)
+        for job in jobs:
+            self.assertEqual(job["args"], {"jobnr": job["taskid"], "files": files})
+
+        # Big return values are compressed, but come back the same
+        retval = {"log": "x" * 10000}
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED, retval=retval)
+        job = self.db.list_jobs(state=STATE_COMPLETED)[0]
+        self.assertEqual(job["retval"], retval)
+        self.assertEqual(job["args"]["files"], files)
+
+    def testArchive(self):
+        self.db.add_job(1, 1, {"one": 1}, module="noop", itemid=1)
+        self.db.add_job(1, 2, {"two": 2}, module="noop", itemid=2)
+        self.db.flush()
+        cursor = self.db.get_update_cursor()
+
+        jobs = self.db.allocate_job(1, supportedmodules=["any"], max_jobs=1)
+        self.db.update_job(jobs[0]["id"], STATE_COMPLETED, retval={"done": True})
+        time.sleep(1.0)
+
+        self.assertEqual(self.db.archive_jobs(age=0), 1)
+        self.assertEqual(len(self.db.list_jobs()), 1)
+        self.assertEqual(self.db.list_jobs()[0]["state"], STATE_PENDING)
+
+        # Updates for archived jobs are still available
+        cursor, updates = self.db.get_updates(cursor)
+        self.assertEqual([(job["taskid"], job["state"]) for job in updates],
+                         [(jobs[0]["taskid"], STATE_ALLOCATED), (jobs[0]["taskid"], STATE_COMPLETED)])
+        self.assertEqual(updates[1]["retval"], {"done": True})
+
+    def testAging(self):
+        cfg = API.get_config("CryoCloud.JobDB")
+        cfg["aging_interval"] = 0.5
+        cfg["aging_step"] = 30
+        db = JobDB("aging", None)
+        try:
+            db.add_job(1, 1, {}, module="noop", priority=PRI_BULK)
+            db.flush()
+            time.sleep(0.6)
+
+            # Aged one step, so before newer low priority jobs
+            db.add_job(1, 2, {}, module="noop", priority=PRI_LOW)
+            db.flush()
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [1])
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [2])
+
+            # but no more than AGING_CAP above where it started
+            db.add_job(1, 3, {}, module="noop", priority=PRI_BULK)
+            db.flush()
+            time.sleep(1.1)
+            db.add_job(1, 4, {}, module="noop", priority=PRI_NORMAL + 5)
+            db.flush()
+            stats = db.get_wait_stats()
+            self.assertTrue(stats[PRI_BULK]["pending"] >= 1)  # Other runs may have pending jobs too
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [4])
+            self.assertEqual([job["taskid"] for job in db.allocate_job(1, supportedmodules=["any"])], [3])
+        finally:
+            cfg["aging_interval"] = AGING_INTERVAL
+            cfg["aging_step"] = AGING_STEP
+            db.clear_jobs()
+
     def testWorkerMulti(self):
         """
         Run a worker that performs jobs asynchronously
@@ -102,6 +102,29 @@ class NetWatcherTest(unittest.TestCase):
         time.sleep(0.1)
         self.assertEqual(self.listener.added[0]["string"], "simple string2")
 
+    def testPaused(self):
+        self.nw.pause()
+        try:
+            self.poster.post({"string": "simple string"})
+            self.fail("Should get an error here")
+        except PostException as e:
+            # Expected error code 503
+            self.assertEqual(e.code, 503)
+
+        time.sleep(0.1)
+        self.assertEqual([], self.listener.added)
+
+        self.nw.resume()
+        self.poster.post({"string": "simple string2"})
+        time.sleep(0.1)
+        self.assertEqual(self.listener.added[0]["string"], "simple string2")
+
+        # Admission by callback
+        self.nw._admit = lambda: False
+        self.assertTrue(self.nw.paused())
+        self.nw._admit = lambda: True
+        self.assertFalse(self.nw.paused())
+
     def testAdvancedJSON(self):
         # Post a task
 
@@ -59,6 +59,13 @@ class DefaultHandler:
     def onStopped(self):
         pass
 
+    def admit(self, caller=None):
+        """
+        Input modules check this before adding more work, discovery should
+        pause while it returns False
+        """
+        return True
+
     def onCheckRestrictions(self, step_modules):
         """
         Step_modules is a list of tuples (stepnr, module name)